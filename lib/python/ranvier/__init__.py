@@ -59,11 +59,13 @@ from context import *
 from mapper import *
 from folders import *
 from miscres import *
+from staticres import *
 from respproxy import *
 from pretty import *
 from reporters.reporter import *
 from reporters.callgraph import *
 from reporters.coverage import *
+from reporters.latency import *
 from reporters.tracer import *
 
 
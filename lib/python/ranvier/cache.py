@@ -0,0 +1,100 @@
+# This file is part of the Ranvier package.
+# See http://furius.ca/ranvier/ for license and details.
+
+"""
+Bounded least-recently-used cache.
+"""
+
+
+__all__ = ()
+
+
+
+# Indexes into the links of the cache's circular list.
+PREV, NEXT, KEY, VALUE = 0, 1, 2, 3
+
+class LRUCache(object):
+    """
+    A dict-like cache with a bounded number of entries.  When the cache is full,
+    the least recently used entry is evicted to make room for a new one.  The
+    recency order is kept in a circular doubly-linked list of the entries, so
+    that all operations take constant time.
+
+    The cache is not thread-safe; callers that share it between threads must
+    serialize their accesses with a lock.
+    """
+    def __init__(self, maxsize):
+        assert maxsize > 0
+        self.maxsize = maxsize
+        """The maximum number of entries."""
+
+        self.hits = 0
+        """The number of successful lookups."""
+
+        self.misses = 0
+        """The number of failed lookups."""
+
+        self.links = {}
+        """A dict of the keys to their links in the list."""
+
+        self.root = []
+        self.root[:] = [self.root, self.root, None, None]
+        """The sentinel of the list.  The most recently used entry is at its
+        front."""
+
+    def __len__(self):
+        return len(self.links)
+
+    def get(self, key):
+        """
+        Return the value for the given key, or None if it is not in the cache.
+        """
+        link = self.links.get(key)
+        if link is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+
+        # Move the link to the front of the list.
+        root = self.root
+        if link[PREV] is not root:
+            link[PREV][NEXT] = link[NEXT]
+            link[NEXT][PREV] = link[PREV]
+            first = root[NEXT]
+            link[PREV], link[NEXT] = root, first
+            first[PREV] = root[NEXT] = link
+
+        return link[VALUE]
+
+    def put(self, key, value):
+        """
+        Store the value for the given key.  If the key is already in the cache,
+        its value is replaced and it becomes the most recently used entry.
+        """
+        root = self.root
+
+        # Unlink the existing entry for the key, if any.
+        link = self.links.pop(key, None)
+        if link is not None:
+            link[PREV][NEXT] = link[NEXT]
+            link[NEXT][PREV] = link[PREV]
+
+        # Evict the least recently used entry if the cache is full.
+        if len(self.links) >= self.maxsize:
+            last = root[PREV]
+            last[PREV][NEXT] = root
+            root[PREV] = last[PREV]
+            del self.links[last[KEY]]
+
+        first = root[NEXT]
+        link = [root, first, key, value]
+        first[PREV] = root[NEXT] = link
+        self.links[key] = link
+
+    def clear(self):
+        """
+        Remove all the entries.  This does not reset the counters.
+        """
+        self.links.clear()
+        self.root[:] = [self.root, self.root, None, None]
+
@@ -6,7 +6,7 @@ Path locator class.
 """
 
 # stdlib imports
-import sys, types
+import sys, types, threading
 from os.path import join
 
 
@@ -19,7 +19,16 @@ class HandlerContext(object):
     Handler context.  This is an object meant to contain a locator and for
     clients to put other stuff that should be passed around in the chain of
     handlers.
+
+    The standard attributes that the mapper sets on the context are stored in
+    slots.  Other attributes, e.g. the extra attributes given to
+    UrlMapper.handle_request(), go in a dict that is only created when the
+    first of them is set.
     """
+    __slots__ = ('request_method', 'locator', 'args',
+                 'mapper', 'redirect_data', 'reporters', 'response', 'mapurl',
+                 'resid', 'resource', '__dict__')
+
     def __init__(self, method, uri, args, rootloc=None):
 
         self.request_method = method
@@ -31,6 +40,38 @@ class HandlerContext(object):
         self.args = args
         """Arguments, as they come from the framework."""
 
+    def reset(self, method, uri, args, rootloc=None):
+        """
+        Reinitialize a context for handling a new request.  This is called
+        instead of the constructor when the mapper reuses its contexts (see the
+        'pool_contexts' option of UrlMapper).  It resets the standard
+        attributes, reuses the locator and removes all the other attributes.
+        Subclasses which initialize attributes in their constructor must
+        override this to initialize them again.
+        """
+        self.clear()
+        self.request_method = method
+        self.locator.reset(uri, rootloc)
+        self.args = args
+
+    def clear(self):
+        """
+        Remove the references of the context to the objects of its request,
+        i.e. the arguments, the response proxy, the handled resource and all
+        the other attributes.  This is called when a context is returned to
+        the pool.
+        """
+        self.args = self.response = None
+        self.redirect_data = self.reporters = None
+        for aname in self._reset_slots:
+            if hasattr(self, aname):
+                delattr(self, aname)
+        self.__dict__.clear()
+
+    # The slots that are not set by the constructor or by the mapper on every
+    # request, and which clear() removes.
+    _reset_slots = ('resid', 'resource')
+
     def redirect(self, uri, args=None):
         """
         Internal redirect using a Ranvier exception.
@@ -55,25 +96,125 @@ class HandlerContext(object):
 
 
 
+class ContextPool(threading.local):
+    """
+    Per-thread pool of handler contexts to be reused between requests.  Each
+    thread has free lists of contexts by class.  The contexts in use are not
+    in the pool, so nested requests get their own.
+    """
+    def __init__(self):
+        self.free = {}
+
+        self.returned = None
+        """The context handed back to the caller of the last request of the
+        thread, which is released on the next request.  See release_later()."""
+
+    def acquire(self, ctxt_cls, method, uri, args, rootloc=None):
+        """
+        Get a free context of the given class reset for a new request, or
+        create one if there are none.
+        """
+        if self.returned is not None:
+            self.release(self.returned)
+            self.returned = None
+
+        contexts = self.free.get(ctxt_cls)
+        if contexts:
+            ctxt = contexts.pop()
+            ctxt.reset(method, uri, args, rootloc)
+        else:
+            ctxt = ctxt_cls(method, uri, args, rootloc)
+        return ctxt
+
+    def release(self, ctxt):
+        """
+        Return a context to the pool.  It must not be used after this.  The
+        references of the context to the objects of its request are removed,
+        so that they are not kept alive while it is in the pool.
+        """
+        ctxt.clear()
+        contexts = self.free.get(ctxt.__class__)
+        if contexts is None:
+            contexts = self.free[ctxt.__class__] = []
+        contexts.append(ctxt)
+
+    def release_later(self, ctxt):
+        """
+        Return a context that is handed back to the caller of a request to the
+        pool on the next request of the thread, so that it can be used until
+        then.
+        """
+        if self.returned is not None:
+            self.release(self.returned)
+        self.returned = ctxt
+
+
+
 class PathLocator(object):
     """
     Locator object used to resolve the paths.
+
+    The locator keeps the path as a normalized string, i.e. without leading,
+    trailing or repeated slashes, and the offset of the current component in
+    it, so that consuming the components does not require a list of them.
     """
+    __slots__ = ('rootloc', 'pathstr', 'pos', '_index', 'trailing')
+
     @staticmethod
     def from_uri(uri, rootloc=None):
-        trailing = False
-        if uri.endswith('/'): # remove trailing / if present
-            trailing = True
-        path = [x for x in uri.split('/') if x]
-        p = PathLocator(path, trailing, rootloc)
+        p = PathLocator.__new__(PathLocator)
+        p.reset(uri, rootloc)
         return p
 
     def __init__(self, path, trailing=False, rootloc=None):
+        """
+        'path' is the list of the path components.
+        """
+        self.setpath('/'.join(x for x in path if x), trailing, rootloc)
+
+    def setpath(self, pathstr, trailing=False, rootloc=None):
+        """
+        Initialize the locator from a normalized path string.
+        """
         self.rootloc = rootloc
-        self.path = path
-        self.index = 0
+        self.pathstr = pathstr
+        self.pos = 0
+        self._index = 0
         self.trailing = trailing
 
+    def reset(self, uri, rootloc=None):
+        """
+        Reinitialize the locator for the given URI.
+        """
+        trailing = False
+        if uri.endswith('/'): # remove trailing / if present
+            trailing = True
+        if '//' in uri:
+            pathstr = '/'.join(x for x in uri.split('/') if x)
+        else:
+            pathstr = uri.strip('/')
+        self.setpath(pathstr, trailing, rootloc)
+
+    def getindex(self):
+        return self._index
+
+    def setindex(self, index):
+        # Move the offset to the start of the given component.
+        path = self.path
+        self.pos = len('/'.join(path[:index])) + (0 < index <= len(path))
+        self._index = index
+
+    index = property(getindex, setindex, doc="""
+        The index of the current component in the path.
+        """)
+
+    @property
+    def path(self):
+        """
+        The list of the path components.
+        """
+        return self.pathstr.split('/') if self.pathstr else []
+
     def __str__(self):
         return '<PathLocator %s %s>' % (self.path, self.index)
 
@@ -82,29 +223,39 @@ class PathLocator(object):
         Return the next component to be consumed.
         If the locator is at the leaf, this should fail with a KeyError.
         """
-        return self.path[self.index]
+        pathstr, pos = self.pathstr, self.pos
+        if pos >= len(pathstr):
+            raise IndexError("No more components in locator.")
+        end = pathstr.find('/', pos)
+        return pathstr[pos:end] if end != -1 else pathstr[pos:]
 
     def getnext(self):
-        return self.path[self.index+1]
+        return self.path[self._index+1]
 
     def next(self):
-        self.index += 1
+        end = self.pathstr.find('/', self.pos)
+        self.pos = end + 1 if end != -1 else len(self.pathstr) + 1
+        self._index += 1
         return self
 
     def isleaf(self):
-        return self.index == len(self.path)
+        return self.pos >= len(self.pathstr)
 
     def uri(self, idx=1000):
-        if self.path:
+        if self.pathstr:
             rootloc = self.rootloc or '/'
-            r = join(rootloc, '/'.join(self.path[:idx]))
+            if idx == self._index:
+                prefix = self.pathstr[:max(self.pos - 1, 0)]
+            else:
+                prefix = '/'.join(self.path[:idx])
+            r = join(rootloc, prefix)
         else:
             r = self.rootloc or ''
         r += (self.trailing and '/' or '')
         return r
 
     def current_uri(self):
-        return self.uri(self.index)
+        return self.uri(self._index)
 
 
 
@@ -114,6 +265,10 @@ class InternalRedirect(Exception):
     dealt and handled by the mapper so it's transparent to your application
     framework.
     """
+    # Shadow the 'args' attribute of exceptions, which can only be set to a
+    # tuple, so that the arguments of the redirect can be stored under it.
+    args = None
+
     def __init__(self, uri, args=None):
         Exception.__init__(self, "Internal redirection to '%s'." % uri)
         assert isinstance(uri, str)
@@ -158,6 +313,40 @@ class Tests(unittest.TestCase):
         self.assert_(loc.trailing is True)
         self.assert_(loc.uri() == '/bli/gugu/')
 
+        loc = PathLocator.from_uri('//bli///gugu/')
+        self.assert_(loc.path == ['bli', 'gugu'])
+        self.assert_(loc.uri() == '/bli/gugu/')
+
+    def test_consume(self):
+        loc = PathLocator.from_uri('/bli/gugu/blo', '/root')
+        self.assert_(loc.current() == 'bli')
+        self.assert_(loc.getnext() == 'gugu')
+        self.assert_(loc.current_uri() == '/root/')
+        loc.next()
+        self.assert_(loc.current() == 'gugu')
+        self.assert_(loc.current_uri() == '/root/bli')
+        self.assert_(loc.uri(1) == '/root/bli')
+        loc.next().next()
+        self.assert_(loc.isleaf())
+        self.assert_(loc.index == 3)
+        self.assert_(loc.current_uri() == '/root/bli/gugu/blo')
+        self.assertRaises(IndexError, loc.current)
+
+        loc = PathLocator.from_uri('/')
+        self.assert_(loc.isleaf())
+
+    def test_index(self):
+        loc = PathLocator(['bli', 'gugu', 'blo'], False, '/root')
+        self.assert_(loc.path == ['bli', 'gugu', 'blo'])
+        self.assert_(loc.uri() == '/root/bli/gugu/blo')
+        loc.index = 2
+        self.assert_(loc.current() == 'blo')
+        self.assert_(loc.current_uri() == '/root/bli/gugu')
+        loc.index = 0
+        self.assert_(loc.current() == 'bli')
+        loc.index = 3
+        self.assert_(loc.isleaf())
+
 if __name__ == '__main__':
     unittest.main()
 
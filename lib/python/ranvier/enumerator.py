@@ -138,50 +138,67 @@ class Enumerator(object):
 
     def visit(self, resource, components, optparams, level):
         """
-        Visit a resource node.  This method calls itself recursively.
+        Visit a resource node and accumulate all the paths under it.
         * 'resources' is the resource node to visit.
         * 'components' is the current list of components and variables that this
           visitor is currently at.
         """
-        # Visit the resource and let it declare the properties of its
-        # propagation/search.
-        visitor = EnumVisitor(resource)
-        resource.enum_targets(visitor)
-
-        # Get the accumulated branches.
-        branches = visitor.get_branches()
-
-        # Update the optparams for this node and its branches.
-        new_optparams = optparams + visitor.get_optparams() # Makes a copy.
-
-        # If we have reached a leaf node (i.e. the node has declared itself a
-        # potential leaf), add the components to the list of componentss.
-        if visitor.isleaf():
-
-            # If this resource is a leaf and it does not have any other possible
-            # branches, it is a terminal resource.  This is used later to
-            # determine if we need append a trailing slash or not.
-            isterminal = bool(branches)
-            
-            # Update the list of components for the list.
-            leafres, leafcomp = visitor.leaf
-            leaf_components = list(components)
-            if leafcomp is not None:
-                leaf_components.append(leafcomp)
-
-            # Add the leaf as a valid path.
-            self.accpaths.append(
-                (leafres, leaf_components, new_optparams, isterminal) )
-
-        # Process the possible paths.  This is a breadth-first search.
-        for branch_res, branch_comp in branches:
-            # Update the list of components for the child.
-            child_components = list(components)
-            if branch_comp:
-                child_components.append(branch_comp)
-
-            # Visit the children, recursively.
-            self.visit(branch_res, child_components, new_optparams, level+1)
+        self.accpaths.extend(self.iterpaths(resource, components, optparams))
+
+    def iterpaths(self, resource, components=(), optparams=()):
+        """
+        Generator that visits the resource tree under the given resource node
+        and yields a tuple of (resource, components, optparams, isterminal) for
+        each of the paths, in depth-first order.
+
+        The tree is visited iteratively, so deep trees do not hit the recursion
+        limit.  The components and optional parameters of the nodes being
+        visited are stored as linked lists of (item, parent) pairs that share
+        their prefixes, and the lists of each path are only built when it is
+        yielded.
+        """
+        # The stack of nodes to visit, with their components and optparams.
+        stack = [(resource, tolinked(components), tolinked(optparams))]
+        while stack:
+            resource, comps, opts = stack.pop()
+
+            # Visit the resource and let it declare the properties of its
+            # propagation/search.
+            visitor = EnumVisitor(resource)
+            resource.enum_targets(visitor)
+
+            # Get the accumulated branches.
+            branches = visitor.get_branches()
+
+            # Update the optparams for this node and its branches.
+            for optparam in visitor.get_optparams():
+                opts = (optparam, opts)
+
+            # If we have reached a leaf node (i.e. the node has declared itself
+            # a potential leaf), yield its path.
+            if visitor.isleaf():
+
+                # If this resource is a leaf and it does not have any other
+                # possible branches, it is a terminal resource.  This is used
+                # later to determine if we need append a trailing slash or not.
+                isterminal = bool(branches)
+
+                # Build the list of components for the leaf.
+                leafres, leafcomp = visitor.leaf
+                leaf_components = fromlinked(comps)
+                if leafcomp is not None:
+                    leaf_components.append(leafcomp)
+
+                yield (leafres, leaf_components, fromlinked(opts), isterminal)
+
+            # Process the possible paths.  The branches are pushed in reverse
+            # order so that they get visited in their declared order.
+            for branch_res, branch_comp in reversed(branches):
+                if branch_comp:
+                    child_comps = (branch_comp, comps)
+                else:
+                    child_comps = comps
+                stack.append( (branch_res, child_comps, opts) )
 
     def getpaths(self):
         """
@@ -191,6 +208,28 @@ class Enumerator(object):
 
 
 
+def tolinked(items):
+    """
+    Convert a sequence to a linked list of (item, parent) pairs.
+    """
+    linked = None
+    for item in items:
+        linked = (item, linked)
+    return linked
+
+def fromlinked(linked):
+    """
+    Convert a linked list of (item, parent) pairs to a new list.
+    """
+    items = []
+    while linked is not None:
+        item, linked = linked
+        items.append(item)
+    items.reverse()
+    return items
+
+
+
 
 class Component(object):
     """
@@ -207,6 +246,11 @@ class FixedComponent(Component):
     def __cmp__(self, other):
         return cmp(self.name, other.name)
 
+# Functions used to convert the matched values of variable components to their
+# target type, by the conversion type of their format.
+format_converters = {'d': int,
+                     'f': float}
+
 class VarComponent(Component):
     """
     A variable component.
@@ -220,6 +264,13 @@ class VarComponent(Component):
 
         self.format = format
 
+        # Function to convert matched values to the target type, guessed using
+        # the format, or None if the values are strings.
+        if format:
+            self.converter = format_converters.get(format[-1])
+        else:
+            self.converter = None
+
     def __cmp__(self, other):
         c = cmp(self.varname, other.varname)
         if c != 0:
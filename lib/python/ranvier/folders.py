@@ -13,7 +13,7 @@ import types
 # ranvier imports
 import ranvier.template
 from ranvier import _verbosity, RanvierError
-from ranvier.resource import Resource
+from ranvier.resource import Resource, is_deferred
 
 
 __all__ = ('Folder', 'FolderWithMenu')
@@ -84,7 +84,17 @@ class FolderBase(Resource, dict):
             ctxt.response.log("resolver: child %s found, calling it" % name)
 
         # Let the folder do some custom handling.
-        if Resource.handle_base(self, ctxt):
+        rcode = Resource.handle_base(self, ctxt)
+        if is_deferred(rcode):
+            return rcode.addCallback(self.forward_child, child, ctxt)
+        return self.forward_child(rcode, child, ctxt)
+
+    def forward_child(self, rcode, child, ctxt):
+        """
+        Forward to the given child resource, given the return value of the
+        folder's handler.
+        """
+        if rcode:
             return True
 
         ctxt.locator.next()
@@ -187,7 +197,7 @@ class Folder(FolderBase):
             return ctxt.response.errorNotFound()
         else:
             # Default is a Resource, delegate to it.
-            self.delegate(default, ctxt)
+            return self.delegate(default, ctxt)
 
 
 
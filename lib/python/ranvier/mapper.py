@@ -6,17 +6,24 @@ URL mapper and enumerator classes.
 """
 
 # stdlib imports
-import __builtin__, os, re, types, copy, urllib, urlparse
+import __builtin__, os, re, time, types, copy, urllib, urlparse, marshal
+import gzip, email.utils, threading
+from hashlib import md5
+from StringIO import StringIO
 from itertools import chain
 
 # ranvier imports
 import ranvier
 from ranvier import rodict, RanvierError, RanvierBadRoot, respproxy
-from ranvier.resource import Resource
-from ranvier.miscres import LeafResource
-from ranvier.context import HandlerContext, InternalRedirect
+from ranvier.resource import Resource, is_deferred
+from ranvier.miscres import LeafResource, VarVarResource, VarDelegatorResource
+from ranvier.folders import FolderBase
+from ranvier.context import HandlerContext, InternalRedirect, ContextPool
 from ranvier.enumerator import \
-    Enumerator, FixedComponent, VarComponent
+    Enumerator, FixedComponent, VarComponent, OptParam
+from ranvier.routes import RouteTrie, TypedRouteTrie
+from ranvier.cache import LRUCache
+from ranvier import urlfetch
 
 
 __all__ = ('UrlMapper', 'EnumResource', 'getresid',)
@@ -36,7 +43,8 @@ class UrlMapper(rodict.ReadOnlyDict):
     that are always valid.
     """
     def __init__(self, root_resource=None, rootloc=None,
-                 render_trailing=True):
+                 render_trailing=True, compile_routes=False, cache_size=0,
+                 pool_contexts=False):
         rodict.ReadOnlyDict.__init__(self)
 
         self.root_resource = root_resource
@@ -59,6 +67,43 @@ class UrlMapper(rodict.ReadOnlyDict):
         """If this is true, automatically render a trailing slash for resources
         that are not leafs."""
 
+        self.compile_routes = compile_routes
+        """If this is true, the requests are resolved through the compiled
+        routes of the resource tree, which skip the plain folders and variable
+        delegators at the top of the path.  See route_request()."""
+
+        self.routes = None
+        """A trie of the paths of the resource tree to the resources from which
+        their requests are handled, built on demand when the routes are
+        compiled and discarded when mappings are added.  See
+        compile_routes_trie()."""
+
+        self.matcher = None
+        """A dict of (scheme, netloc) pairs to tries of the paths of the
+        mappings, used for finding which resource-id a URL belongs to.  This is
+        built on demand and discarded when mappings are added.  See
+        match_any()."""
+
+        self.urlcache = None
+        """A bounded cache of the URLs rendered by mapurl(), or None if
+        disabled.  Only the URLs rendered from scalar arguments are cached."""
+
+        self.urlcache_lock = threading.Lock()
+        """A lock serializing the accesses to the URL cache, which is shared by
+        the threads that render URLs."""
+        self.set_cache_size(cache_size)
+
+        if pool_contexts:
+            self.ctxtpool = ContextPool()
+        else:
+            self.ctxtpool = None
+        """A per-thread pool of the contexts reused by handle_request(), or None
+        if a new context is created for every request.  A context that is
+        reused is reinitialized with its reset() method.  Note that the
+        context returned by handle_request() is only valid until the next
+        request of the same thread, and that the contexts of the requests
+        which are internally redirected are released immediately."""
+
         if root_resource is not None:
             self.initialize(root_resource)
 
@@ -72,10 +117,8 @@ class UrlMapper(rodict.ReadOnlyDict):
         self.root_resource = root_resource
 
         enumrator = Enumerator()
-        enumrator.visit_root(root_resource)
-
         for (resource, components, optparams,
-             isterminal) in enumrator.getpaths():
+             isterminal) in enumrator.iterpaths(root_resource):
 
             # Calculate the resource-id from the resource at the leaf.
             resid = getresid(resource)
@@ -97,15 +140,9 @@ class UrlMapper(rodict.ReadOnlyDict):
         assert root_resource
 
         enumrator = Enumerator()
-        enumrator.visit_root(root_resource)
-
-        resids = []
-        for (resource, components, optparams,
-             isterminal) in enumrator.getpaths():
-
-            resids.append(getresid(resource))
-
-        return resids
+        return [getresid(resource)
+                for (resource, components, optparams,
+                     isterminal) in enumrator.iterpaths(root_resource)]
 
     def inject_builtins(self, mapname=None):
         """
@@ -136,8 +173,45 @@ class UrlMapper(rodict.ReadOnlyDict):
                      mapping.render_pattern(self.rootloc))
             raise RanvierError(os.linesep.join(lines))
 
-        # Store the mapping.
+        # Store the mapping and compile its renderer for our root location.
         self.mappings[resid] = mapping
+        mapping.compile_renderer(self.rootloc)
+
+        # Invalidate the routes, the matcher and the cached URLs.
+        self.routes = self.matcher = None
+        self.clear_cache()
+
+    def set_cache_size(self, cache_size):
+        """
+        Set the maximum number of URLs kept in the mapurl() cache.  A size of 0
+        disables the cache.  This discards the cached URLs and the counters.
+        """
+        if cache_size:
+            self.urlcache = LRUCache(cache_size)
+        else:
+            self.urlcache = None
+
+    def clear_cache(self):
+        """
+        Discard the URLs in the mapurl() cache, if enabled.  This is done
+        automatically when mappings are added.
+        """
+        if self.urlcache is not None:
+            self.urlcache_lock.acquire()
+            try:
+                self.urlcache.clear()
+            finally:
+                self.urlcache_lock.release()
+
+    def cache_info(self):
+        """
+        Return a tuple of (hits, misses, maximum size, current size) for the
+        mapurl() cache, or None if it is disabled.
+        """
+        cache = self.urlcache
+        if cache is None:
+            return None
+        return cache.hits, cache.misses, cache.maxsize, len(cache)
 
     def add_static(self, resid, urlpattern):
         """
@@ -170,6 +244,7 @@ class UrlMapper(rodict.ReadOnlyDict):
 
         new_mapping = copy.copy(mapping)
         new_mapping.resid = new_resid
+        new_mapping.alias_of = mapping.alias_of or existing_resid
         self._add_mapping(new_mapping)
 
     def _get_mapping(self, res):
@@ -206,6 +281,38 @@ class UrlMapper(rodict.ReadOnlyDict):
         this object to fill in the missing values.  You can combine this with
         keyword arguments as well.
         """
+        url = None
+        cache = self.urlcache
+        if cache is not None:
+            key = cache_key(resid, args, kwds)
+            if key is not None:
+                lock = self.urlcache_lock
+                lock.acquire()
+                try:
+                    url = cache.get(key)
+                finally:
+                    lock.release()
+                if url is None:
+                    url = self._mapurl(resid, args, kwds)
+                    lock.acquire()
+                    try:
+                        cache.put(key, url)
+                    finally:
+                        lock.release()
+        if url is None:
+            url = self._mapurl(resid, args, kwds)
+
+        # Register the target in the call graph, if enabled.
+        if self.reporters:
+            for rep in self.reporters:
+                rep.register_rendered(resid)
+
+        return url
+
+    def _mapurl(self, resid, args, kwds):
+        """
+        Implementation of mapurl(), without the cache.
+        """
         mapping = self._get_mapping(resid)
 
         # Create a dict of the required positional arguments.
@@ -273,13 +380,93 @@ class UrlMapper(rodict.ReadOnlyDict):
 
         optargs = kwds
 
-        # Register the target in the call graph, if enabled.
-        for rep in self.reporters:
-            rep.register_rendered(resid)
-
         # Perform the substitution.
         return mapping.render(posargs, optargs, self.rootloc)
 
+    def mapurl_many(self, resid, rows, **kwds):
+        """
+        Map a resource-id to the URLs for many sets of arguments.  This is
+        meant for rendering lists of links to the same resource and returns an
+        iterator over the rendered URLs, in the order of the rows.  The mapping
+        is looked up and the arguments are validated only once, and the
+        reporters are notified once for the entire batch.
+
+        Each of the 'rows' can be either
+
+        1. a tuple or list of the positional arguments
+        2. a single string or integer, for mappings with a single positional
+           argument
+        3. an instance or a dict to fetch the positional arguments from
+
+        The keyword arguments are common to all the rows, and may provide some
+        of the positional arguments and the optional parameters, like for
+        mapurl().  Each row must provide all of the remaining positional
+        arguments.
+        """
+        mapping = self._get_mapping(resid)
+
+        # Separate the common positional arguments from the optional
+        # parameters.
+        fixed, optargs = {}, {}
+        for name, value in kwds.iteritems():
+            if name in mapping.posmap:
+                fixed[name] = value
+            elif name in mapping.optparams:
+                optargs[name] = value
+            else:
+                raise RanvierError("Error: Resource '%s' got an "
+                                   "unexpected optional parameter '%s'" %
+                                   (mapping.resid, name))
+
+        # The names of the positional arguments that each row must provide.
+        varnames = tuple(comp.varname for comp in mapping.positional
+                         if comp.varname not in fixed)
+
+        return self._mapurl_many(mapping, rows, varnames, fixed, optargs)
+
+    def _mapurl_many(self, mapping, rows, varnames, fixed, optargs):
+        """
+        Generator for mapurl_many().
+        """
+        nbvars = len(varnames)
+        render, rootloc = mapping.render, self.rootloc
+        count = 0
+        try:
+            for row in rows:
+                if isinstance(row, (tuple, list)):
+                    if len(row) != nbvars:
+                        raise RanvierError(
+                            "Error: Resource '%s' takes %d arguments "
+                            "(%d given)." % (mapping.resid, nbvars, len(row)))
+                    posargs = dict(zip(varnames, row))
+
+                elif isinstance(row, (str, unicode, int, long)):
+                    if nbvars != 1:
+                        raise RanvierError(
+                            "Error: Resource '%s' takes %d arguments "
+                            "(1 given)." % (mapping.resid, nbvars))
+                    posargs = {varnames[0]: row}
+
+                else:
+                    if not isinstance(row, dict):
+                        row = row.__dict__
+                    try:
+                        posargs = dict((name, row[name]) for name in varnames)
+                    except KeyError, e:
+                        raise RanvierError(
+                            "Error: Resource '%s' had no value supplied for "
+                            "positional argument '%s'" %
+                            (mapping.resid, e.args[0]))
+
+                posargs.update(fixed)
+                yield render(posargs, optargs, rootloc)
+                count += 1
+        finally:
+            # Register the rendered targets in the call graph, if enabled.
+            if count:
+                for rep in self.reporters:
+                    rep.register_rendered_many(mapping.resid, count)
+
     def mapurl_noerror(self, resid, *args, **kwds):
         """
         Same as mapurl(), except that we just return None if there is an error.
@@ -339,13 +526,15 @@ class UrlMapper(rodict.ReadOnlyDict):
 
 
     @staticmethod
-    def urlload(url):
+    def urlload(url, cachedir=None):
         """
         Load and create a URL mapper by fetching the specified url via the
-        network.
+        network.  If 'cachedir' is specified, the fetched list of resources is
+        kept in that directory and only transferred again if it has changed on
+        the server.  See EnumResource.
         """
         try:
-            enumres_text = urllib.urlopen(url).read()
+            enumres_text = urlfetch.fetch(url, cachedir)
         except IOError:
             raise RanvierError(
                 "Error: Fetching contents of mapper from URL '%s'." % url)
@@ -360,35 +549,184 @@ class UrlMapper(rodict.ReadOnlyDict):
         See render() for more details.
         """
         mapper = UrlMapper()
-        inpat_re = re.compile('([^:\s]+)\s*:\s*(.*)\s*$')
+        mappings = mapper.mappings
 
-        for line in lines:
-            if not line:
-                continue
+        # The mappings and components parsed so far, by URL pattern and
+        # component string.  Identical patterns (e.g. those of aliases) share
+        # their mapping contents.
+        patterns, compcache = {}, {}
 
+        for line in lines:
             # Split the id and urlpattern.
-            try:
-                mo = inpat_re.match(line.strip())
-                if not mo:
-                    raise ValueError
-                resid, urlpattern = mo.groups()
-            except ValueError:
+            resid, sep, urlpattern = line.partition(':')
+            resid, urlpattern = resid.strip(), urlpattern.strip()
+            if not sep or not resid or len(resid.split()) != 1:
+                if not line.strip():
+                    continue
                 raise RanvierError("Warning: Error parsing line '%s' on load." %
                                    line)
 
+            if resid in mappings:
+                raise RanvierError("Error: Duplicate resource id '%s' on "
+                                   "load." % resid)
+
             # Note: we do not have defaults when loading from the rendered
             # representation.
 
-            # Parse the loaded line.
-            unparsed, isterminal = urlpattern_to_components(urlpattern)
+            try:
+                mapping = copy.copy(patterns[urlpattern])
+                mapping.resid = resid
+            except KeyError:
+                # Parse the loaded line.
+                unparsed, isterminal = urlpattern_to_components(urlpattern,
+                                                                compcache)
+                mapping = Mapping(resid, unparsed, isterminal)
+                patterns[urlpattern] = mapping
+
+            # Add the new mapping.  Its renderer gets compiled on first use.
+            mappings[resid] = mapping
+
+        return mapper
+
 
-            # Create and add the new mapping.
-            mapping = Mapping(resid, unparsed, isterminal)
-            mapper._add_mapping(mapping)
+    def dump_snapshot(self, filename):
+        """
+        Save the compiled mappings to a binary snapshot file, from which a
+        mapper can be recreated quickly with load_snapshot(), without
+        enumerating the resource tree and parsing URL patterns.  This is meant
+        to cut the startup time of processes which create their mapper on every
+        request (e.g. CGI programs) or in every worker process.
+        """
+        records = [mapping.snapshot() for mapping in self.itervalues()]
+        data = (snapshot_version, self.rootloc, records)
+        try:
+            f = open(filename, 'wb')
+            try:
+                f.write(snapshot_magic)
+                marshal.dump(data, f, 2)
+            finally:
+                f.close()
+        except IOError, e:
+            raise RanvierError("Error: Writing snapshot '%s': %s" %
+                               (filename, e))
+
+    @staticmethod
+    def load_snapshot(filename, root_resource=None, resources=None, **kwds):
+        """
+        Load and create a URL mapper from a snapshot file created with
+        dump_snapshot().  The root location is that of the dumped mapper.
+
+        'root_resource' is the root of the resource tree that the mapper
+        handles requests with.  It is not enumerated, so it must be the same
+        tree as that of the dumped mapper.  'resources' is an optional iterable
+        of the resource objects of the tree, which are reattached to their
+        mappings by resource-id.  The other keyword arguments are passed on to
+        the UrlMapper constructor.
+        """
+        try:
+            f = open(filename, 'rb')
+            try:
+                if f.read(len(snapshot_magic)) != snapshot_magic:
+                    raise ValueError
+                version, rootloc, records = marshal.load(f)
+            finally:
+                f.close()
+        except IOError, e:
+            raise RanvierError("Error: Reading snapshot '%s': %s" %
+                               (filename, e))
+        except (ValueError, EOFError, TypeError):
+            raise RanvierError("Error: Invalid snapshot file '%s'." % filename)
+        if version != snapshot_version:
+            raise RanvierError("Error: Snapshot '%s' has version %s, "
+                               "expected %s." %
+                               (filename, version, snapshot_version))
+
+        mapper = UrlMapper(rootloc=rootloc, **kwds)
+        mapper.root_resource = root_resource
+
+        byresid = {}
+        if resources is not None:
+            for resource in resources:
+                byresid[getresid(resource)] = resource
+
+        # Note: the mappings were validated when they were dumped, so we do not
+        # check them again here.
+        components = {}
+        for record in records:
+            mapping = Mapping.from_snapshot(record, components)
+            mapping.resource = byresid.get(mapping.alias_of or mapping.resid)
+            mapper.mappings[mapping.resid] = mapping
 
         return mapper
 
 
+    def compile_routes_trie(self):
+        """
+        Build the trie of the paths of the resource tree for route_request().
+        The value of each path is a pair of the list of the steps that can be
+        skipped at the top of the path, and the resource to delegate to after
+        them.  A step is None for a plain folder, which consumes a fixed
+        component, or the name of the context attribute that a plain variable
+        delegator sets to the component it consumes.  The resources are plain
+        if they only resolve their children, i.e. they do not override the
+        methods that handle the request nor define handlers.
+        """
+        routes = RouteTrie()
+        for mapping in self.itervalues():
+            if not is_tree_mapping(mapping):
+                continue
+            steps = []
+            resource = self.root_resource
+            for comp in mapping.components:
+                if isinstance(comp, FixedComponent):
+                    if not comp.name:
+                        continue
+                    if not is_plain_resource(resource, FolderBase):
+                        break
+                    child = resource.get(comp.name)
+                    if not isinstance(child, Resource):
+                        break
+                    steps.append(None)
+                    resource = child
+                else:
+                    if not (is_plain_resource(resource, VarDelegatorResource)
+                            and comp.varname == resource.compname):
+                        break
+                    steps.append(resource.compname)
+                    resource = resource.getnext()
+            routes.add(mapping.components, (steps, resource), mapping.catchall)
+        return routes
+
+    def route_request(self, ctxt):
+        """
+        Resolve the path of the given context through the compiled routes and
+        return the resource to delegate the request to.  The plain folders and
+        variable delegators at the top of the path are skipped: the components
+        that they would consume are consumed from the locator of the context,
+        and the attributes that they would set on it are set.  The root
+        resource is returned for the paths which are not served by the tree,
+        so that they are handled as usual.
+        """
+        routes = self.routes
+        if routes is None:
+            routes = self.routes = self.compile_routes_trie()
+
+        locator = ctxt.locator
+        pathstr = locator.pathstr
+        result = routes.resolve(pathstr.split('/') if pathstr else [])
+        if result is None:
+            return self.root_resource
+
+        (steps, resource), bindings = result
+        for compname in steps:
+            if compname is not None:
+                if hasattr(ctxt, compname):
+                    raise RanvierError("Error: Context already has attribute "
+                                       "'%s'." % compname)
+                setattr(ctxt, compname, locator.current())
+            locator.next()
+        return resource
+
     def getabsoluteids(self):
         """
         Return a list of the absolute-ids registered with the mapper, which
@@ -418,7 +756,22 @@ class UrlMapper(rodict.ReadOnlyDict):
 
         'extra': the extra keyword args are added as attribute to the context
         object that the handlers receive
+
+        Returns the context object.  If the contexts are pooled, it is reused
+        for the next request of the same thread, and must not be used after it.
+
+        If the handlers complete asynchronously, i.e. return a Twisted Deferred,
+        the 'deferred' attribute of the returned context is a Deferred that
+        fires when the request has been handled, including its internal
+        redirects.  Otherwise, it is None.  Note that the reporters keep the
+        state of a single request, so their results are mixed up if requests
+        are handled concurrently.
         """
+        return self._handle_request(method, uri, args, response_proxy,
+                                    ctxt_cls, extra, None)
+
+    def _handle_request(self, method, uri, args, response_proxy, ctxt_cls,
+                        extra, redirect_data):
 
         if self.root_resource is None:
             raise RanvierError("Error: You need to initialize the mapper with "
@@ -429,11 +782,13 @@ class UrlMapper(rodict.ReadOnlyDict):
         assert isinstance(response_proxy,
                           (types.NoneType, respproxy.ResponseProxy))
 
-        redirect_data = None
+        reporters = self.reporters
+        deferred = None
         while True:
             # Start reporter.
-            for rep in self.reporters:
-                rep.begin()
+            if reporters:
+                for rep in reporters:
+                    rep.begin()
 
             # Remove the root location if necessary.
             if self.rootloc is not None:
@@ -449,14 +804,18 @@ class UrlMapper(rodict.ReadOnlyDict):
             else:
                 assert issubclass(ctxt_cls, HandlerContext)
                 
-            ctxt = ctxt_cls(method, uri, args, self.rootloc)
+            if self.ctxtpool is not None:
+                ctxt = self.ctxtpool.acquire(ctxt_cls, method, uri, args,
+                                             self.rootloc)
+            else:
+                ctxt = ctxt_cls(method, uri, args, self.rootloc)
             ctxt.mapper = self
 
             # Add the redirect data
             ctxt.redirect_data = redirect_data
 
             # Setup the reporters.
-            ctxt.reporters = self.reporters
+            ctxt.reporters = reporters
 
             # Standard stuff that we graft onto the context object.
             ctxt.response = response_proxy
@@ -472,19 +831,66 @@ class UrlMapper(rodict.ReadOnlyDict):
                 setattr(ctxt, aname, avalue)
 
             # Handle the request.
+            returned = False
             try:
                 try:
-                    Resource.delegate(self.root_resource, ctxt)
+                    # Skip the top of the path if the routes are compiled,
+                    # unless the reporters need to see all the resources.
+                    if self.compile_routes and not reporters:
+                        resource = self.route_request(ctxt)
+                    else:
+                        resource = self.root_resource
+                    result = Resource.delegate(resource, ctxt)
+                    if is_deferred(result):
+                        deferred = result
+                    returned = True
                     break # Success, break out.
                 except InternalRedirect, e:
                     redirect_data = e
                     uri, args = e.uri, e.args
                     # Loop again for the internal redirect.
             finally:
-                # Complete reporters.
-                for rep in self.reporters:
-                    rep.end()
+                if deferred is None:
+                    self._end_request(ctxt, returned)
+
+        # Complete the request when the handlers complete, and handle the
+        # internal redirects that they raise.
+        if deferred is not None:
+            deferred.addBoth(self._end_request_async, ctxt, method,
+                             response_proxy, ctxt_cls, extra)
+        ctxt.deferred = deferred
         return ctxt
+
+    def _end_request(self, ctxt, returned):
+        """
+        Complete the reporters and release the context of a request.  If
+        'returned' is true, the context is handed back to the caller and is
+        only released on the next request of the thread.
+        """
+        if ctxt.reporters:
+            for rep in ctxt.reporters:
+                rep.end()
+
+        if self.ctxtpool is not None:
+            if returned:
+                self.ctxtpool.release_later(ctxt)
+            else:
+                self.ctxtpool.release(ctxt)
+
+    def _end_request_async(self, result, ctxt, method, response_proxy,
+                           ctxt_cls, extra):
+        """
+        Callback for the completion of an asynchronous request.  'result' is the
+        result of the handlers, or a Failure.
+        """
+        self._end_request(ctxt, True)
+
+        if hasattr(result, 'check') and result.check(InternalRedirect):
+            e = result.value
+            ctxt = self._handle_request(method, e.uri, e.args, response_proxy,
+                                        ctxt_cls, extra, e)
+            return ctxt.deferred
+        return result
     
     def add_reporter(self, reporter):
         """
@@ -499,7 +905,7 @@ class UrlMapper(rodict.ReadOnlyDict):
         """
         try:
             self.reporters.remove(reporter)
-        except IndexError:
+        except ValueError:
             raise RanvierError("Trying to remove an unregistered reporter.")
 
     def get_match_regexp(self, resid):
@@ -507,12 +913,10 @@ class UrlMapper(rodict.ReadOnlyDict):
         Return a regular expression to match the URL for the given resource-id.
         """
         mapping = self._get_mapping(resid)
-        restring = mapping.render_regexp_matcher(self.rootloc)
 
         # Note: we do not match the beginning and end because this might be used
         # to match links within a document (e.g. in some test).
-        mre = re.compile(restring)
-        return mre
+        return mapping.get_regexp(self.rootloc)
 
     def match(self, resid, url):
         """
@@ -524,10 +928,9 @@ class UrlMapper(rodict.ReadOnlyDict):
         Important note: this ignores the hostname in the given url and anything
         other than the path.
         """
-        # Get the mapping and build a regexp for matching.
+        # Get the mapping and its regexp for matching.
         mapping = self._get_mapping(resid)
-        restring = mapping.render_regexp_matcher(self.rootloc)
-        mre = re.compile('^%s$' % restring)
+        mre = mapping.get_regexp(self.rootloc, anchored=True)
 
         # Match against just the given path.
         scheme, netloc, path, query, frag = urlparse.urlsplit(url)
@@ -538,15 +941,81 @@ class UrlMapper(rodict.ReadOnlyDict):
             # Convert the match to the target type, guessed using the format.
             results = {}
             for comp, value in zip(mapping.positional, mo.groups()):
-                format = comp.format
-                if format and format.endswith('d'):
-                    value = int(value)
-                elif format and format.endswith('f'):
-                    value = float(value)
+                if comp.converter is not None:
+                    value = comp.converter(value)
                 results[comp.varname] = value
 
         return results
 
+    def match_any(self, url):
+        """
+        Find which resource-id the given URL belongs to.  On success, return a
+        pair of the resource-id and a dictionary of the matched values,
+        converted like for match().  On failure, return None.  If the URL
+        matches more than one mapping, the mappings of the resource tree have
+        precedence over the static mappings, and the original mappings over
+        their aliases.
+
+        The external mappings, i.e. those with a scheme or a network location,
+        only match the URLs with the same scheme and network location, and
+        have precedence over the mappings of this site for those URLs.  For the
+        other mappings, this ignores the hostname in the given url and anything
+        other than the path, like match().  This is meant for classifying large
+        numbers of URLs, e.g. from access logs, and all the mappings are
+        compiled once into tries of the path components on the first call.
+        """
+        matchers = self.matcher
+        if matchers is None:
+            matchers = self.matcher = self.compile_matcher()
+
+        scheme, netloc, path = urlparse.urlsplit(url)[:3]
+        components = [x for x in path.split('/') if x]
+        result = None
+        if scheme or netloc:
+            matcher = matchers.get((scheme.lower(), netloc.lower()))
+            if matcher is not None:
+                result = matcher.resolve(components)
+        if result is None:
+            result = matchers[('', '')].resolve(components)
+        if result is None:
+            return None
+
+        mapping, bindings = result
+        results = {}
+        for comp, value in bindings:
+            if isinstance(value, list):
+                value = '/'.join(value)
+            elif comp.converter is not None:
+                value = comp.converter(value)
+            results[comp.varname] = value
+
+        return mapping.resid, results
+
+    def compile_matcher(self):
+        """
+        Build the tries of the full paths of all the mappings, for match_any(),
+        in a dict keyed by the (scheme, netloc) of the mappings.  The mappings
+        of this site are under ('', '').
+        """
+        matchers = {('', ''): TypedRouteTrie()}
+        rootcomps = [FixedComponent(x)
+                     for x in (self.rootloc or '').split('/') if x]
+
+        sortkey = lambda x: (not is_tree_mapping(x), bool(x.absolute),
+                             x.alias_of is not None, x.resid)
+        for mapping in sorted(self.itervalues(), key=sortkey):
+            scheme, netloc = mapping.prefix
+            prefix = ((scheme or '').lower(), (netloc or '').lower())
+            try:
+                matcher = matchers[prefix]
+            except KeyError:
+                matcher = matchers[prefix] = TypedRouteTrie()
+            components = mapping.components
+            if not mapping.absolute:
+                components = rootcomps + components
+            matcher.add(components, mapping, mapping.catchall)
+        return matchers
+
 
 
 class Mapping(object):
@@ -579,6 +1048,13 @@ class Mapping(object):
         self.resid = resid
         self.resource = resobj
 
+        # The resource-id of the mapping this one is an alias to, if any.
+        self.alias_of = None
+
+        # True if the last component consumes all the remaining components of
+        # the path.
+        self.catchall = isinstance(resobj, VarVarResource)
+
         # True if this resource does not have any further branches
         self.isterminal = isterminal
 
@@ -590,8 +1066,8 @@ class Mapping(object):
         self.urltmpl, self.urltmpl_untyped = self.create_path_templates()
 
         # Set the positional args to the list of components with variables.
-        self.positional = filter(lambda x: isinstance(x, VarComponent),
-                                 components)
+        self.positional = [x for x in components
+                           if isinstance(x, VarComponent)]
         self.posmap = dict((x.varname, None) for x in self.positional)
         # Note: only exists for efficient copy in mapurl.
 
@@ -609,6 +1085,82 @@ class Mapping(object):
         # A dict of the optional parameters.
         self.optparams = dict((x.varname, x) for x in optparams or ())
 
+        # The specialised rendering function, compiled on demand for a
+        # particular root location.  See compile_renderer().
+        self.renderer = None
+        self.renderer_rootloc = None
+
+        # The unanchored and anchored compiled regexps for matching URLs,
+        # compiled on demand for a particular root location.  See
+        # get_regexp().
+        self.regexps = None
+        self.regexps_rootloc = None
+
+    def snapshot(self):
+        """
+        Return a representation of this mapping made of builtin types only, for
+        saving in a snapshot file.  See from_snapshot().
+        """
+        components = tuple(
+            isinstance(comp, VarComponent) and (comp.varname, comp.format)
+            or comp.name
+            for comp in self.components)
+        optparams = tuple((comp.varname, comp.format)
+                          for comp in self.optparams.itervalues())
+
+        return (self.resid, self.alias_of, self.prefix, self.suffix,
+                self.absolute, components, optparams, self.isterminal,
+                self.catchall, self.urltmpl, self.urltmpl_untyped)
+
+    @staticmethod
+    def from_snapshot(record, components):
+        """
+        Recreate a mapping from the representation returned by snapshot(),
+        without recomputing what was computed when it was created.  The
+        component objects are shared between the mappings via the
+        'components' dict.  Note: this must set all the attributes that
+        __init__ sets.
+        """
+        (resid, alias_of, prefix, suffix, absolute, comprecs, optrecs,
+         isterminal, catchall, urltmpl, urltmpl_untyped) = record
+
+        self = Mapping.__new__(Mapping)
+        self.prefix, self.suffix = prefix, suffix
+        self.absolute = absolute
+
+        self.components = []
+        for comprec in comprecs:
+            try:
+                comp = components[comprec]
+            except KeyError:
+                if isinstance(comprec, tuple):
+                    comp = VarComponent(*comprec)
+                else:
+                    comp = FixedComponent(comprec)
+                components[comprec] = comp
+            self.components.append(comp)
+
+        self.resid = resid
+        self.resource = None
+        self.alias_of = alias_of
+        self.catchall = catchall
+        self.isterminal = isterminal
+        self.urltmpl, self.urltmpl_untyped = urltmpl, urltmpl_untyped
+
+        self.positional = [x for x in self.components
+                           if isinstance(x, VarComponent)]
+        self.posmap = dict((x.varname, None) for x in self.positional)
+        self.optparams = dict((varname, OptParam(varname, format))
+                              for varname, format in optrecs)
+        self.varset = set(self.posmap)
+        self.varset.update(self.optparams)
+
+        self.renderer = None
+        self.renderer_rootloc = None
+        self.regexps = None
+        self.regexps_rootloc = None
+        return self
+
     def create_path_templates(self):
         """
         Render a string template that can be used with a mapping to perform the
@@ -634,7 +1186,72 @@ class Mapping(object):
         return '/'.join(rcomps), '/'.join(rcomps_untyped)
 
     def render(self, posargs, optargs, rootloc=None):
-        return self._render(self.urltmpl, posargs, optargs, rootloc)
+        if self.renderer is None or rootloc != self.renderer_rootloc:
+            self.compile_renderer(rootloc)
+        return self.renderer(posargs, optargs)
+
+    def compile_renderer(self, rootloc=None):
+        """
+        Compile a function specialised for rendering this mapping under the
+        given root location, and store it for render() to use.  The rendered
+        URLs are identical to those of _render(), but the fixed parts of the
+        URL are joined only once, and the URL is not reassembled with
+        urlunsplit() if it has no scheme, network location or fragment.
+        """
+        if self.absolute:
+            first_comp = ''
+        else:
+            first_comp = rootloc or ''
+        template = '%s/%s' % (first_comp.replace('%', '%%'), self.urltmpl)
+
+        # Find out if we need to check for the trailing slash when rendering,
+        # or if we can append it right now.
+        check_trailing = False
+        if self.isterminal:
+            if self.components and isinstance(self.components[-1],
+                                              VarComponent):
+                check_trailing = True
+            elif not template.endswith('/'):
+                template += '/'
+
+        # Parameterless mappings always render the same path.
+        if not self.positional:
+            path = template % {}
+        else:
+            path = None
+
+        render_query = self.render_query
+        prefix, suffix = self.prefix, self.suffix
+        if prefix != ('', '') or suffix != ('',):
+            def renderer(posargs, optargs):
+                rendered_path = path or template % posargs
+                if check_trailing and not rendered_path.endswith('/'):
+                    rendered_path += '/'
+                query = optargs and render_query(optargs) or ''
+                return urlparse.urlunsplit(
+                    prefix + (rendered_path, query) + suffix)
+
+        elif path is not None:
+            def renderer(posargs, optargs):
+                if optargs:
+                    query = render_query(optargs)
+                    if query:
+                        return '%s?%s' % (path, query)
+                return path
+
+        else:
+            def renderer(posargs, optargs):
+                rendered_path = template % posargs
+                if check_trailing and not rendered_path.endswith('/'):
+                    rendered_path += '/'
+                if optargs:
+                    query = render_query(optargs)
+                    if query:
+                        return '%s?%s' % (rendered_path, query)
+                return rendered_path
+
+        self.renderer = renderer
+        self.renderer_rootloc = rootloc
 
     def render_pattern(self, rootloc=None):
         """
@@ -671,6 +1288,20 @@ class Mapping(object):
             restring += '/?'
         return restring
 
+    def get_regexp(self, rootloc=None, anchored=False):
+        """
+        Return a compiled regular expression for matching against a known URL.
+        If 'anchored' is true, the regexp matches only entire paths.  The
+        regexps are compiled once and kept for as long as the root location
+        does not change.
+        """
+        if self.regexps is None or rootloc != self.regexps_rootloc:
+            restring = self.render_regexp_matcher(rootloc)
+            self.regexps = (re.compile(restring),
+                            re.compile('^%s$' % restring))
+            self.regexps_rootloc = rootloc
+        return self.regexps[bool(anchored)]
+
     def _render(self, template, posargs, optargs,
                 rootloc=None, render_trailing=True):
         """
@@ -691,17 +1322,7 @@ class Mapping(object):
 
         # Render the optional parameters.
         if optargs:
-            fmt_optargs = {}
-            for name, value in optargs.iteritems():
-                if value is None:
-                    continue # Skip None values.
-
-                comp = self.optparams[name]
-                if comp.format:
-                    value = ('%' + comp.format) % value
-                fmt_optargs[name] = value
-
-            query = urllib.urlencode(fmt_optargs)
+            query = self.render_query(optargs)
         else:
             query = ''
 
@@ -711,6 +1332,92 @@ class Mapping(object):
 
         return rendered
 
+    def render_query(self, optargs):
+        """
+        Render the query string for the given optional parameters.  Parameters
+        whose value is None are skipped.
+        """
+        fmt_optargs = {}
+        for name, value in optargs.iteritems():
+            if value is None:
+                continue # Skip None values.
+
+            comp = self.optparams[name]
+            if comp.format:
+                value = ('%' + comp.format) % value
+            fmt_optargs[name] = value
+
+        return urllib.urlencode(fmt_optargs)
+
+
+
+
+def is_plain_resource(resource, base):
+    """
+    Return true if the given resource is an instance of 'base' that handles
+    the requests like it, i.e. its class does not override the methods of
+    'base' that handle the requests, and it does not have handlers for the
+    request methods.  See UrlMapper.compile_routes_trie().
+    """
+    if not isinstance(resource, base) or resource.get_allowed():
+        return False
+    for name in plain_methods:
+        if name in resource.__dict__:
+            return False
+        if lookup_class(resource.__class__, name) is not \
+                lookup_class(base, name):
+            return False
+    return True
+
+# The methods that are involved in the handling of a request by the folders and
+# the variable delegators.
+plain_methods = ('handle', 'handle_base', 'notfound', 'forward_child',
+                 'consume_component', 'forward', 'post_handle', 'getnext',
+                 '__getitem__')
+
+def lookup_class(cls, name):
+    """
+    Return the attribute of the given class with the given name, as defined in
+    the dict of the class or of its first base that defines it, or None.
+    """
+    for base in cls.__mro__:
+        if name in base.__dict__:
+            return base.__dict__[name]
+    return None
+
+def is_tree_mapping(mapping):
+    """
+    Return true if the given mapping is an original mapping of the resource
+    tree, i.e. not a static mapping nor an alias.
+    """
+    return mapping.absolute is None and mapping.alias_of is None
+
+# The types of the arguments for which the rendered URLs may be cached.  Note
+# that we leave out the types whose values compare equal to values of these
+# types but render differently (e.g. 1.0, True, u'a').
+cacheable_types = frozenset((str, int, long, types.NoneType))
+
+def cache_key(resid, args, kwds):
+    """
+    Compute the key for caching the URL rendered by mapurl() with the given
+    arguments.  Returns None if the URL cannot be cached, i.e. if some of the
+    arguments are containers or instances, whose contents may change.
+    """
+    for value in args:
+        if type(value) not in cacheable_types:
+            return None
+    for value in kwds.itervalues():
+        if type(value) not in cacheable_types:
+            return None
+    if not isinstance(resid, str):
+        resid = getresid(resid)
+    return (resid, args, frozenset(kwds.iteritems()))
+
+
+
+# Header and format version of the snapshot files.
+snapshot_magic = 'RANVIER-SNAPSHOT\n'
+snapshot_version = 1
 
 
 
@@ -739,7 +1446,7 @@ def getresid(res):
 
 compre = re.compile('^\\(([a-z][a-z_]*)(?:%([a-z0-9\\-]+))?\\)$')
 
-def urlpattern_to_components(urlpattern):
+def urlpattern_to_components(urlpattern, compcache=None):
     """
     Convert a URL pattern string to a list of components.  Return a tuple of
 
@@ -772,8 +1479,15 @@ def urlpattern_to_components(urlpattern):
 
          /catalog/gizmos/(id%08d)
 
+    If 'compcache' is a dict, it is used to share the component objects between
+    the calls, by component string.
     """
-    scheme, netloc, path, query, fragment = urlparse.urlsplit(urlpattern)
+    # Only split the URL pattern if it has something else than a path.
+    if (':' in urlpattern or '?' in urlpattern or '#' in urlpattern or
+        urlpattern.startswith('//')):
+        scheme, netloc, path, query, fragment = urlparse.urlsplit(urlpattern)
+    else:
+        scheme, netloc, path, query, fragment = '', '', urlpattern, '', ''
 
     # Find out if the URL we're trying to map is absolute.
     absolute = scheme or netloc or path.startswith('/')
@@ -791,6 +1505,14 @@ def urlpattern_to_components(urlpattern):
     components = []  # name, var, format
 
     for comp in path.split('/'):
+        # Reuse the component objects that have already been parsed.
+        if compcache is not None:
+            try:
+                components.append(compcache[comp])
+                continue
+            except KeyError:
+                pass
+
         mo = compre.match(comp)
         if not mo:
             # Catch components with parentheses that are misformed.
@@ -800,11 +1522,14 @@ def urlpattern_to_components(urlpattern):
                     urlpattern)
 
             # Add a fixed component
-            components.append( FixedComponent(comp) )
-            continue
+            component = FixedComponent(comp)
         else:
             varname, varformat = mo.group(1, 2)
-            components.append( VarComponent(varname, varformat) )
+            component = VarComponent(varname, varformat)
+
+        components.append(component)
+        if compcache is not None:
+            compcache[comp] = component
 
     return (scheme, netloc, absolute, components, query, fragment), isterminal
 
@@ -813,15 +1538,61 @@ def urlpattern_to_components(urlpattern):
 class EnumResource(LeafResource):
     """
     Enumerate all the resources available from a resource tree.
+
+    The list is served with an ETag header that is a hash of its contents and a
+    Last-Modified header that is the time at which those contents were first
+    served, so that clients can revalidate a cached copy of it.  If the adapter
+    passes the request headers to the handlers in a 'headers' attribute of the
+    context (a dict with lowercase header names), conditional requests are
+    answered with a 304 response and the list is compressed for the clients
+    that accept gzip.
     """
     def __init__(self, mapper, **kwds):
         LeafResource.__init__(self, **kwds)
         self.mapper = mapper
 
+        self.etag = None
+        """The ETag of the contents last served."""
+
+        self.lastmod = None
+        """The time at which the contents last served have changed."""
+
     def handle(self, ctxt):
-        ctxt.response.setContentType('text/plain')
-        for line in self.mapper.render():
-            ctxt.response.write(line)
-            ctxt.response.write('\n')
+        contents = ''.join(line + '\n' for line in self.mapper.render())
+        etag = '"%s"' % md5(contents).hexdigest()
+        if etag != self.etag:
+            self.etag, self.lastmod = etag, int(time.time())
+
+        response = ctxt.response
+        headers = getattr(ctxt, 'headers', None) or {}
+
+        # Check the validators of the client's copy, if any.  The entity tag has
+        # precedence over the modification time (RFC 2616, 14.26).
+        inm = headers.get('if-none-match')
+        if inm is not None:
+            notmod = inm.strip() == '*' or etag in map(str.strip,
+                                                       inm.split(','))
+        else:
+            ims = headers.get('if-modified-since')
+            ims = ims and email.utils.parsedate_tz(ims)
+            notmod = bool(ims) and email.utils.mktime_tz(ims) >= self.lastmod
+
+        response.addHeader('ETag', etag)
+        response.addHeader('Last-Modified',
+                           email.utils.formatdate(self.lastmod, usegmt=True))
+        response.addHeader('Vary', 'Accept-Encoding')
+        if notmod:
+            return response.notModified()
+
+        if 'gzip' in headers.get('accept-encoding', ''):
+            buf = StringIO()
+            f = gzip.GzipFile(fileobj=buf, mode='wb')
+            f.write(contents)
+            f.close()
+            contents = buf.getvalue()
+            response.addHeader('Content-Encoding', 'gzip')
+
+        response.setContentType('text/plain')
+        response.write(contents)
 
 
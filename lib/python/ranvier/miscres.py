@@ -6,7 +6,7 @@ Miscallenious useful generic resource classes.
 """
 
 # ranvier imports
-from ranvier.resource import Resource
+from ranvier.resource import Resource, is_deferred, when_done
 from ranvier import _verbosity, RanvierError
 
 
@@ -56,7 +56,14 @@ class DelegatorResource(Resource):
     def handle_base(self, ctxt):
         # Call the handler.
         rcode = Resource.handle_base(self, ctxt)
+        if is_deferred(rcode):
+            return rcode.addCallback(self.forward, ctxt)
+        return self.forward(rcode, ctxt)
 
+    def forward(self, rcode, ctxt):
+        """
+        Forward to the delegate resource, given the return value of the handler.
+        """
         # Support errors that does not use exception handling.  Typically it
         # would be better to raise an exception to unwind the chain of
         # responsibility, but I'm not one to decide what you like to do.  This
@@ -66,18 +73,22 @@ class DelegatorResource(Resource):
 
         # Automatically forward to the delegate resource if there are no
         # errors.
+        def done(result):
+            self.post_handle(ctxt)
+            return result
         try:
             r = self.delegate(self._next, ctxt)
-        finally:
+        except:
             self.post_handle(ctxt)
-            
-        return r
+            raise
+        return when_done(r, done)
 
     def post_handle(self, ctxt):
         """
         Callback that can be overriden to perform stuff after the request has
         been delegated.  This is called even if when unwinding from an
-        exception.
+        exception.  If the delegate resource completes asynchronously, this is
+        called when it completes.
         """
         # Noop.
         
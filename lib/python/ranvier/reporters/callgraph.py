@@ -8,11 +8,17 @@ This is an object that can be used for the code that reports the call graph.  To
 be used only for debugging.
 """
 
+# stdlib imports
+import os, struct, time, atexit, math, StringIO
+
 # ranvier imports
+from ranvier import RanvierError
 from ranvier.reporters.reporter import SimpleReporter
 
 
-__all__ = ('CallGraphReporter', 'FileCallGraphReporter')
+__all__ = ('CallGraphReporter', 'FileCallGraphReporter',
+           'LogCallGraphReporter', 'read_callgraph_log',
+           'callgraph_render_dot')
 
 
 
@@ -48,3 +54,171 @@ class FileCallGraphReporter(CallGraphReporter):
     def publish_relation(self, caller, target):
         self.outf.write('%s %s\n' % (caller, target))
 
+
+
+# The header of each record of a binary call graph log: magic, version, length
+# of the newline-separated resource-ids, number of edges.
+callgraph_header_fmt = '<4sHII'
+callgraph_header_size = struct.calcsize(callgraph_header_fmt)
+callgraph_magic = 'RVCG'
+callgraph_version = 1
+
+# An edge of a record: indexes of the caller and target resource-ids, count.
+callgraph_edge_fmt = '<IIQ'
+callgraph_edge_size = struct.calcsize(callgraph_edge_fmt)
+
+class LogCallGraphReporter(CallGraphReporter):
+    """
+    Call graph reporter that counts the relations in memory and periodically
+    appends the counts accumulated since the last write to a binary log file.
+
+    Each write appends a self-contained record with the table of the
+    resource-ids it refers to and the counts of the edges, in a single
+    system call on a file opened for appending, so that the processes of a
+    server can share the same log.  The logs are read back and merged with
+    read_callgraph_log(), e.g. by the ranvier-callgraph tool.
+    """
+    def __init__(self, filename, flush_interval=60):
+        """
+        'flush_interval' is the minimum number of seconds between the writes to
+        the log.  If it is None, the counts of each request are written at its
+        end.  The pending counts are written at exit.
+        """
+        CallGraphReporter.__init__(self)
+
+        self.filename = filename
+        self.fd = os.open(filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                          0666)
+
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+
+        self.pending = {}
+        """The counts accumulated since the last write, as a dict of
+        (caller, target) pairs to counts."""
+
+        self.names = {}
+        """A table of the resource-ids to shared str objects, encoded in UTF-8
+        if they are unicode, used for the keys of the pending counts."""
+
+        atexit.register(self.close)
+
+    def getname(self, resid):
+        """
+        Return the shared str object for the given resource-id.
+        """
+        try:
+            return self.names[resid]
+        except KeyError:
+            name = self.names[resid] = (resid.encode('utf-8')
+                                        if isinstance(resid, unicode)
+                                        else resid)
+            return name
+
+    def publish_relation(self, caller, target):
+        key = (self.getname(caller), self.getname(target))
+        self.pending[key] = self.pending.get(key, 0) + self.weight
+
+    def end(self):
+        CallGraphReporter.end(self)
+        if (self.flush_interval is None or
+            time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Append the pending counts to the log.
+        """
+        edges, self.pending = self.pending, {}
+        self.last_flush = time.time()
+        if edges and self.fd is not None:
+            os.write(self.fd, callgraph_pack_record(edges))
+
+    def close(self):
+        """
+        Write the pending counts and close the log.
+        """
+        if self.fd is not None:
+            self.flush()
+            os.close(self.fd)
+            self.fd = None
+
+def callgraph_pack_record(edges):
+    """
+    Encode a dict of (caller, target) pairs to counts as a log record.
+    """
+    ordinals = {}
+    for pair in edges:
+        for resid in pair:
+            if resid not in ordinals:
+                ordinals[resid] = len(ordinals)
+    resids = sorted(ordinals, key=ordinals.get)
+    index = '\n'.join(resids)
+
+    data = [struct.pack(callgraph_header_fmt, callgraph_magic,
+                        callgraph_version, len(index), len(edges)),
+            index]
+    for (caller, target), count in edges.iteritems():
+        data.append(struct.pack(callgraph_edge_fmt,
+                                ordinals[caller], ordinals[target], count))
+    return ''.join(data)
+
+def read_callgraph_log(filename, edges=None):
+    """
+    Read a binary call graph log and add its counts to the given dict of
+    (caller, target) pairs to counts, which is returned.  An incomplete record
+    at the end of the log (e.g. from a process that was killed while writing)
+    is ignored.
+    """
+    if edges is None:
+        edges = {}
+    f = open(filename, 'rb')
+    try:
+        data = f.read()
+    finally:
+        f.close()
+
+    pos = 0
+    while pos + callgraph_header_size <= len(data):
+        magic, version, indexlen, nbedges = struct.unpack_from(
+            callgraph_header_fmt, data, pos)
+        if magic != callgraph_magic or version != callgraph_version:
+            raise RanvierError("Error: Invalid call graph log '%s' at offset "
+                               "%d." % (filename, pos))
+        pos += callgraph_header_size
+        end = pos + indexlen + nbedges * callgraph_edge_size
+        if end > len(data):
+            break
+
+        resids = data[pos:pos + indexlen].split('\n')
+        pos += indexlen
+        for i in xrange(nbedges):
+            caller, target, count = struct.unpack_from(callgraph_edge_fmt,
+                                                       data, pos)
+            pos += callgraph_edge_size
+            key = (resids[caller], resids[target])
+            edges[key] = edges.get(key, 0) + count
+    return edges
+
+def callgraph_render_dot(edges, min_count=1):
+    """
+    Render a graphviz dot graph of the given dict of (caller, target) pairs to
+    counts.  The edges are labeled with their counts and their width is scaled
+    logarithmically.  The edges with less than 'min_count' calls are ignored.
+    """
+    oss = StringIO.StringIO()
+    oss.write('digraph callgraph {\n')
+    for (caller, target), count in sorted(edges.iteritems()):
+        if count < min_count:
+            continue
+        oss.write('  "%s" -> "%s" [label="%d", penwidth=%.1f];\n' %
+                  (dot_escape(caller), dot_escape(target),
+                   count, 1 + math.log10(count)))
+    oss.write('}\n')
+    return oss.getvalue()
+
+def dot_escape(name):
+    """
+    Escape the given name for a double-quoted graphviz dot identifier.
+    """
+    return name.replace('\\', '\\\\').replace('"', '\\"')
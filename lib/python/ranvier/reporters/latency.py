@@ -0,0 +1,262 @@
+# This file is part of the Ranvier package.
+# See http://furius.ca/ranvier/ for license and details.
+
+"""
+Latency reporter.
+
+A reporter that measures the time spent handling each resource of the
+delegation chains, and accumulates it into histograms per resource-id, to find
+which resources are slow.
+"""
+
+# stdlib imports
+import time, bisect, StringIO
+
+# ranvier imports
+from ranvier.reporters.reporter import ResourceReporter
+from ranvier.miscres import LeafResource
+import ranvier.template
+
+
+__all__ = ('LatencyReporter', 'ReportLatency', 'DumpLatency')
+
+
+
+# The upper bounds of the buckets of the histograms, in seconds.  The last
+# bucket has no upper bound.
+latency_buckets = (0.0001, 0.0002, 0.0005,
+                   0.001, 0.002, 0.005,
+                   0.01, 0.02, 0.05,
+                   0.1, 0.2, 0.5,
+                   1.0, 2.0, 5.0,
+                   10.0)
+
+# The quantiles that are read out of the histograms.
+latency_quantiles = (0.50, 0.95, 0.99)
+
+class Histogram(object):
+    """
+    A histogram of durations with fixed buckets.
+    """
+    def __init__(self):
+        self.counts = [0] * (len(latency_buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(latency_buckets, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """
+        Return an upper bound for the given quantile of the values, i.e. the
+        upper bound of the bucket in which it falls, or the largest value if it
+        falls in the last bucket.
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        accu = 0
+        for bound, count in zip(latency_buckets, self.counts):
+            accu += count
+            if accu >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+
+class LatencyReporter(ResourceReporter):
+    """
+    A reporter that measures the wall-clock time and the processor time spent in
+    the handlers of each resource, both inclusive and exclusive of the
+    resources that it delegates to, and accumulates them in histograms per
+    resource-id.
+
+    The state of the resources being handled is kept per request, so that
+    the requests which complete asynchronously can be interleaved.  Note that
+    the processor time is that of the entire process, so it is only
+    meaningful if the process handles a single request at a time.
+    """
+    # The names of the measures, in the order in which they are stored.
+    measures = ('wall', 'wall_excl', 'cpu', 'cpu_excl')
+
+    def __init__(self, wallclock=time.time, cpuclock=time.clock):
+        self.wallclock = wallclock
+        self.cpuclock = cpuclock
+
+        self.histograms = {}
+        """A dict of resource-ids to a list of histograms, one per measure."""
+
+        self.stacks = {}
+        """A dict of the contexts of the requests being handled to the
+        resources being handled for them, as a list of [resid, wall start
+        time, cpu start time, wall time of the delegates, cpu time of the
+        delegates]."""
+
+    def register_handled(self, resid):
+        pass
+
+    def register_entered(self, resid, ctxt):
+        try:
+            stack = self.stacks[ctxt]
+        except KeyError:
+            stack = self.stacks[ctxt] = []
+        stack.append([resid, self.wallclock(), self.cpuclock(), 0.0, 0.0])
+
+    def register_returned(self, resid, ctxt):
+        wall, cpu = self.wallclock(), self.cpuclock()
+        stack = self.stacks.get(ctxt)
+        if not stack:
+            return
+        resid, wall0, cpu0, child_wall, child_cpu = stack.pop()
+        wall -= wall0
+        cpu -= cpu0
+
+        try:
+            histograms = self.histograms[resid]
+        except KeyError:
+            histograms = self.histograms[resid] = [Histogram()
+                                                   for x in self.measures]
+        for hist, value in zip(histograms, (wall, wall - child_wall,
+                                            cpu, cpu - child_cpu)):
+            hist.add(value)
+
+        if stack:
+            parent = stack[-1]
+            parent[3] += wall
+            parent[4] += cpu
+        else:
+            del self.stacks[ctxt]
+
+    def register_rendered(self, resid):
+        pass
+
+    def register_rendered_many(self, resid, count):
+        pass
+
+    def reset(self):
+        self.histograms = {}
+
+    def get_latencies(self):
+        """
+        Return a dict of resource-ids to a dict of the measure names to a tuple
+        of (count, mean, p50, p95, p99, max), in seconds.
+        """
+        latencies = {}
+        for resid, histograms in self.histograms.iteritems():
+            latencies[resid] = dict(
+                (measure, (hist.count, hist.total / hist.count) +
+                 tuple(hist.quantile(q) for q in latency_quantiles) +
+                 (hist.max,))
+                for measure, hist in zip(self.measures, histograms))
+        return latencies
+
+
+
+def latency_render_html_table(latencies):
+    """
+    Render an HTML table of the latencies returned by
+    LatencyReporter.get_latencies(), in milliseconds.
+    """
+    oss = StringIO.StringIO()
+    oss.write('<table id="latency-report">\n')
+    oss.write(' <thead><tr><td>Resource</td><td>Count</td>')
+    for title in ('Wall', 'Wall (excl.)', 'CPU', 'CPU (excl.)'):
+        oss.write('<td>%s p50</td><td>p95</td><td>p99</td>' % title)
+    oss.write('</tr></thead>\n')
+
+    for resid in sorted(latencies):
+        measures = latencies[resid]
+        oss.write('  <tr>\n    <td class="lat-resid">%s</td>' % resid)
+        oss.write('<td>%d</td>' % measures['wall'][0])
+        for measure in LatencyReporter.measures:
+            for value in measures[measure][2:5]:
+                oss.write('<td>%.2f</td>' % (value * 1000))
+        oss.write('\n  </tr>\n')
+
+    oss.write('</table>\n')
+    return oss.getvalue()
+
+# CSS to be included for rendering the HTML table nicely.
+latency_css = '''
+
+table#latency-report {
+  border-collapse: collapse;
+}
+
+table#latency-report td {
+  padding-left: 1em;
+  padding-right: 1em;
+  border: thin solid black;
+  text-align: right;
+}
+
+table#latency-report td.lat-resid {
+  font-family: monospace;
+  text-align: left;
+}
+
+table#latency-report thead {
+  background-color: #EEE;
+  border-bottom: medium solid black;
+}
+
+'''
+
+
+
+class ReportLatency(LeafResource):
+    """
+    Outputs an HTML table of the latencies measured by a LatencyReporter.
+    """
+    def __init__(self, reader_fun, **kwds):
+        """
+        'reader_fun' is a function that can be invoked to obtain the latencies,
+        in the format returned by LatencyReporter.get_latencies().
+        """
+        LeafResource.__init__(self, **kwds)
+        assert reader_fun is not None
+        self.reader_fun = reader_fun
+
+    def get_html_table(self):
+        """
+        Return an HTML table with the latencies.
+        """
+        return latency_render_html_table(self.reader_fun())
+
+    def handle(self, ctxt):
+        ctxt.response.setContentType('text/html')
+        ranvier.template.render_header(
+            ctxt.response, 'Resource Latencies (ms)', latency_css)
+        ctxt.response.write(self.get_html_table())
+        ranvier.template.render_footer(ctxt.response)
+
+
+class DumpLatency(LeafResource):
+    """
+    Outputs the latencies measured by a LatencyReporter in a machine-readable
+    form, one line per resource-id and measure, with the fields::
+
+      <resid> <measure> <count> <mean> <p50> <p95> <p99> <max>
+
+    The times are in seconds.  'reader_fun' is as for ReportLatency.
+    """
+    def __init__(self, reader_fun, **kwds):
+        LeafResource.__init__(self, **kwds)
+        assert reader_fun is not None
+        self.reader_fun = reader_fun
+
+    def handle(self, ctxt):
+        ctxt.response.setContentType('text/plain')
+        latencies = self.reader_fun()
+        for resid in sorted(latencies):
+            for measure in LatencyReporter.measures:
+                values = latencies[resid][measure]
+                ctxt.response.write('%s %s %d %s\n' % (
+                    resid, measure, values[0],
+                    ' '.join('%.6f' % x for x in values[1:])))
+
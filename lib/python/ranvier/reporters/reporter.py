@@ -9,14 +9,22 @@ a URL is being mapped back for a resource.  The callgraph generator and the
 coverage analysis tool both use it.
 """
 
+# stdlib imports
+import random, zlib
 
-__all__ = ('ResourceReporter', 'SimpleReporter')
+
+__all__ = ('ResourceReporter', 'SimpleReporter', 'SamplingReporter')
 
 
 class ResourceReporter(object):
     """
     Interface for all reporters.
     """
+    weight = 1
+    """The number of requests that each reported request stands for.  This is
+    set by SamplingReporter, reporters that count requests should scale their
+    counts by it."""
+
     def register_handled(self, resid):
         """
         Callback for caller resource-ids.
@@ -29,6 +37,30 @@ class ResourceReporter(object):
         """
         raise NotImplementedError
 
+    def register_entered(self, resid, ctxt):
+        """
+        Callback for caller resource-ids, with the context of the request, which
+        the reporters can use to keep per-request state.  By default, this
+        calls register_handled().
+        """
+        self.register_handled(resid)
+
+    def register_returned(self, resid, ctxt):
+        """
+        Callback for caller resource-ids whose handler has returned, including
+        when it raised an exception, with the context of the request.  If the
+        handler completes asynchronously, this is called when it completes.
+        """
+        # Noop.
+
+    def register_rendered_many(self, resid, count):
+        """
+        Callback for a resource-id that has been rendered 'count' times in a
+        batch.  By default, this just calls register_rendered() repeatedly.
+        """
+        for i in xrange(count):
+            self.register_rendered(resid)
+
     def begin(self):
         """
         Initialize the reporter for handling a request.
@@ -69,7 +101,93 @@ class SimpleReporter(ResourceReporter):
         """
         self.rendered_list.append(resid)
 
+    def register_rendered_many(self, resid, count):
+        self.rendered_list.extend([resid] * count)
+
     def begin(self):
         self.last_handled = None
         self.rendered_list = []
 
+
+
+class SamplingReporter(ResourceReporter):
+    """
+    A wrapper that forwards to another reporter only one request out of every
+    'rate' requests, and sets the weight of that reporter to 'rate'.  This
+    allows running costly reporters (e.g. coverage or tracing) continuously in
+    production.  The sampled requests are chosen by hashing their path, so that
+    a given path is sampled by all the processes or never, unless 'randomize'
+    is true, in which case they are chosen at random.
+
+    The decision is taken when the first resource of a request is entered, and
+    is kept per context, so that the interleaved requests of an asynchronous
+    server are sampled independently.  The wrapped reporter is begun and ended
+    around each of the sampled requests, and receives the rendered URLs while
+    any of them is being handled.  The other attributes of the wrapped
+    reporter (e.g. get_coverage()) are accessible from the wrapper.
+    """
+    def __init__(self, reporter, rate, randomize=False):
+        assert rate >= 1
+        self.reporter = reporter
+        """The wrapped reporter."""
+
+        self.rate = rate
+        self.randomize = randomize
+
+        reporter.weight = rate
+
+        self.requests = {}
+        """A dict of the contexts of the requests being handled to a pair of
+        whether they are sampled, and the number of their resources being
+        handled."""
+
+        self.active = 0
+        """The number of sampled requests being handled."""
+
+    def __getattr__(self, name):
+        return getattr(self.reporter, name)
+
+    def sample(self, ctxt):
+        """
+        Return true if the request of the given context is to be sampled.
+        """
+        if self.randomize:
+            return random.randrange(self.rate) == 0
+        return (zlib.crc32(ctxt.locator.pathstr) & 0xffffffff) % self.rate == 0
+
+    def register_handled(self, resid):
+        if self.active:
+            self.reporter.register_handled(resid)
+
+    def register_entered(self, resid, ctxt):
+        try:
+            request = self.requests[ctxt]
+        except KeyError:
+            request = self.requests[ctxt] = [self.sample(ctxt), 0]
+            if request[0]:
+                self.active += 1
+                self.reporter.begin()
+        request[1] += 1
+        if request[0]:
+            self.reporter.register_entered(resid, ctxt)
+
+    def register_returned(self, resid, ctxt):
+        request = self.requests.get(ctxt)
+        if request is None:
+            return
+        if request[0]:
+            self.reporter.register_returned(resid, ctxt)
+        request[1] -= 1
+        if request[1] == 0:
+            del self.requests[ctxt]
+            if request[0]:
+                self.active -= 1
+                self.reporter.end()
+
+    def register_rendered(self, resid):
+        if self.active:
+            self.reporter.register_rendered(resid)
+
+    def register_rendered_many(self, resid, count):
+        if self.active:
+            self.reporter.register_rendered_many(resid, count)
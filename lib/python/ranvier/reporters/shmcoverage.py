@@ -0,0 +1,252 @@
+# This file is part of the Ranvier package.
+# See http://furius.ca/ranvier/ for license and details.
+
+"""
+Shared-memory coverage reporter.
+
+This reporter keeps the coverage counters in a memory-mapped file that is
+shared by all the processes of a server (e.g. the children of a pre-forking
+server), so that their coverage is aggregated without a database.
+"""
+
+# stdlib imports
+import os, mmap, struct, fcntl, threading
+
+# ranvier imports
+from ranvier import RanvierError
+from ranvier.reporters.reporter import SimpleReporter
+from ranvier.reporters.coverage import coverage_deltas
+
+
+__all__ = ('MmapCoverageReporter',)
+
+
+
+class MmapCoverageReporter(SimpleReporter):
+    """
+    Coverage reporter that stores the counts in a memory-mapped file.
+
+    The file contains the sorted list of the resource-ids of the mapper and a
+    pair of (handled-count, rendered-count) counters for each of them, indexed
+    by the position of the resource-id in the list.  The processes of a server
+    all create the same mapper and thus share the same file layout.  The
+    counters are locked with fcntl.lockf() once per request while the counts of
+    the request are added, so that the processes can update the file
+    concurrently.  The record locks do not exclude the threads of a process
+    from each other, so the updates of a reporter are also serialized with a
+    lock.
+
+    If 'mapper' is specified, the file is created if it does not exist, and
+    must otherwise have been created for the same resource-ids.  The
+    resource-ids are only read from the mapper when the first request ends, so
+    the reporter can be created before the mapper is initialized, and the
+    'mapper' attribute may also be set after the reporter is created, e.g. for
+    a reporter created from a connection string.  If there is no mapper, the
+    file must exist.  Reading the coverage only requires read access to the
+    file, e.g. for reading it from a separate program.
+    """
+    magic = 'RANVIER-COVERAGE'
+    version = 1
+
+    # The header: magic, version, number of counters, length of the index.
+    header_fmt = '<16sIII'
+
+    # The counters of a resource-id.
+    counter_fmt = '<QQ'
+    counter_size = struct.calcsize(counter_fmt)
+
+    def __init__(self, filename, mapper=None):
+        SimpleReporter.__init__(self)
+
+        self.filename = filename
+        self.mapper = mapper
+
+        self.fd = None
+        self.map = None
+
+        self.writable = False
+        """True if the file is open for writing."""
+
+        self.ordinals = None
+        """A dict of the resource-ids to the offset of their counters, or None
+        if the file has not been opened yet."""
+
+        self.counters = None
+        """A pair of the offset and the length of the counters in the file."""
+
+        self.lock = threading.Lock()
+        """A lock for the updates of the counters by the threads of this
+        process."""
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        """
+        Unmap and close the file.
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        self.ordinals = self.counters = None
+
+    def open(self, writable=True):
+        """
+        Open and map the file, for writing or only for reading.  The file is
+        created if it does not exist and it is opened for writing with a
+        mapper.
+        """
+        if not writable:
+            resids = None
+            flags = os.O_RDONLY
+        elif self.mapper is not None:
+            resids = sorted(self.mapper.keys())
+            flags = os.O_RDWR | os.O_CREAT
+        else:
+            resids = None
+            flags = os.O_RDWR
+        try:
+            fd = os.open(self.filename, flags, 0666)
+        except OSError, e:
+            if resids is None and not os.path.exists(self.filename):
+                raise RanvierError(
+                    "Error: Coverage file '%s' does not exist, it is created "
+                    "by a reporter with a mapper." % self.filename)
+            raise RanvierError("Error: Opening coverage file '%s': %s" %
+                               (self.filename, e))
+        try:
+            # Lock the entire file while checking the header, so that processes
+            # do not create it at the same time.
+            fcntl.lockf(fd, fcntl.LOCK_EX if writable else fcntl.LOCK_SH)
+            try:
+                if os.fstat(fd).st_size == 0 and resids is not None:
+                    self.create(fd, resids)
+                index, offset = self.read_index(fd)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN)
+
+            if resids is not None and index != resids:
+                raise RanvierError(
+                    "Error: Coverage file '%s' was created for other resource "
+                    "ids, remove it to start a new one." % self.filename)
+
+            length = len(index) * self.counter_size
+            if writable:
+                self.map = mmap.mmap(fd, offset + length)
+            else:
+                self.map = mmap.mmap(fd, offset + length, mmap.MAP_SHARED,
+                                     mmap.PROT_READ)
+        except:
+            os.close(fd)
+            raise
+
+        self.fd = fd
+        self.writable = writable
+        self.ordinals = dict((resid, offset + i * self.counter_size)
+                             for i, resid in enumerate(index))
+        self.counters = (offset, length)
+
+    def open_writable(self):
+        """
+        Open the file for writing, if it is not already.
+        """
+        if not self.writable:
+            self.close()
+            self.open()
+
+    def create(self, fd, resids):
+        """
+        Write the header, index and zero counters of a new file.
+        """
+        index = '\n'.join(resids)
+        header = struct.pack(self.header_fmt, self.magic, self.version,
+                             len(resids), len(index))
+        data = header + index
+        data += '\0' * (-len(data) % 8 + len(resids) * self.counter_size)
+        os.write(fd, data)
+
+    def read_index(self, fd):
+        """
+        Read the header and the index of the file.  Returns the list of
+        resource-ids and the offset of the counters.
+        """
+        hsize = struct.calcsize(self.header_fmt)
+        os.lseek(fd, 0, os.SEEK_SET)
+        header = os.read(fd, hsize)
+        try:
+            magic, version, nbcounters, indexlen = struct.unpack(
+                self.header_fmt, header)
+        except struct.error:
+            magic = None
+        if magic != self.magic or version != self.version:
+            raise RanvierError("Error: Invalid coverage file '%s'." %
+                               self.filename)
+
+        index = os.read(fd, indexlen)
+        index = index.split('\n') if index else []
+        assert len(index) == nbcounters
+        offset = hsize + indexlen
+        return index, offset + (-offset % 8)
+
+    def add_counts(self, deltas):
+        """
+        Add the given dict of resource-ids to pairs of (handled-count,
+        rendered-count) increments to the counters.  The counts of the
+        resource-ids that are not in the file are ignored.
+        """
+        self.lock.acquire()
+        try:
+            self.open_writable()
+            fd, shm, fmt = self.fd, self.map, self.counter_fmt
+            ordinals = self.ordinals
+            start, length = self.counters
+            fcntl.lockf(fd, fcntl.LOCK_EX, length, start)
+            try:
+                for resid, (hdelta, rdelta) in deltas.iteritems():
+                    offset = ordinals.get(resid)
+                    if offset is None:
+                        continue
+                    hcount, rcount = struct.unpack_from(fmt, shm, offset)
+                    struct.pack_into(fmt, shm, offset,
+                                     hcount + hdelta, rcount + rdelta)
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, length, start)
+        finally:
+            self.lock.release()
+
+    def end(self):
+        self.add_counts(coverage_deltas(self.last_handled, self.rendered_list,
+                                        weight=self.weight))
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.open_writable()
+            offset, length = self.counters
+            if not length:
+                return
+            fcntl.lockf(self.fd, fcntl.LOCK_EX, length, offset)
+            try:
+                self.map[offset:offset + length] = '\0' * length
+            finally:
+                fcntl.lockf(self.fd, fcntl.LOCK_UN, length, offset)
+        finally:
+            self.lock.release()
+
+    def get_coverage(self):
+        """
+        Read the counts of the resource-ids that have been handled or
+        rendered.  Without a mapper, the file is only opened for reading.
+        """
+        if self.ordinals is None:
+            self.open(writable=self.mapper is not None)
+        allresults = {}
+        for resid, offset in self.ordinals.iteritems():
+            counts = struct.unpack_from(self.counter_fmt, self.map, offset)
+            if counts != (0, 0):
+                allresults[resid] = counts
+        return allresults
+
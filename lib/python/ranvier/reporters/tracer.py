@@ -37,6 +37,9 @@ class TracerReporter(ResourceReporter):
     def register_rendered(self, resid):
         pass
 
+    def register_rendered_many(self, resid, count):
+        pass
+
     def end(self):
         self.outfunc(' -> '.join(self.accu))
 
@@ -5,11 +5,59 @@
 Resource file.
 """
 
+# stdlib imports
+import types
+
 # ranvier imports
 import ranvier
 
 
-__all__ = ('Resource',)
+__all__ = ('Resource', 'is_deferred', 'when_done')
+
+
+
+class ResourceType(type):
+    """
+    Metaclass of the resources, which computes the dispatch table of each
+    resource class when it is created.  See Resource.handle().
+    """
+    def __init__(cls, name, bases, dct):
+        type.__init__(cls, name, bases, dct)
+        cls._dispatch_table = dispatch_table(cls)
+        cls._allowed_methods = tuple(sorted(cls._dispatch_table))
+
+def dispatch_table(cls):
+    """
+    Return a dict of the request methods supported by the given class to the
+    functions that handle them, which are called with the resource and the
+    context, e.g. 'GET' to the 'handle_GET' function.  Every callable
+    'handle_<method>' attribute of the class is a handler, except for the
+    template methods of the resources (see _hook_names).  The handlers which
+    are not plain functions, e.g. class or static methods, are called through
+    a wrapper that binds them.
+    """
+    table = {}
+    for name in dir(cls):
+        if not name.startswith('handle_') or name in _hook_names:
+            continue
+        for base in cls.__mro__:
+            if name in base.__dict__:
+                func = base.__dict__[name]
+                break
+        if not isinstance(func, types.FunctionType):
+            if not callable(getattr(cls, name)):
+                continue
+            if hasattr(func, '__get__'):
+                func = (lambda self, ctxt, desc=func:
+                        desc.__get__(self, self.__class__)(ctxt))
+            else:
+                func = lambda self, ctxt, obj=func: obj(ctxt)
+        table[name[len('handle_'):]] = func
+    return table
+
+# The names of the template methods of the resources, which are not handlers
+# for the request methods.
+_hook_names = frozenset(('handle_base', 'handle_nofail', 'handle_default'))
 
 
 
@@ -17,6 +65,8 @@ class Resource(object):
     """
     Base class for all resources.
     """
+    __metaclass__ = ResourceType
+
     __resid = None
     """Default resource-id used for URL mapping.  You usually do not need to set
     this, you can rely on the automatic class name transformation."""
@@ -78,11 +128,24 @@ class Resource(object):
         ctxt.resource = nextres
 
         # Register this node to the callgraph reporter, if active.
-        for rep in ctxt.reporters:
-            rep.register_handled(resid)
-
-        # Handle the next resource (this is where the propagation occurs).
-        nextres.handle_base(ctxt)
+        reporters = ctxt.reporters
+        if not reporters:
+            # Handle the next resource (this is where the propagation occurs).
+            return nextres.handle_base(ctxt)
+
+        for rep in reporters:
+            rep.register_entered(resid, ctxt)
+
+        def returned(result):
+            for rep in reporters:
+                rep.register_returned(resid, ctxt)
+            return result
+        try:
+            result = nextres.handle_base(ctxt)
+        except:
+            returned(None)
+            raise
+        return when_done(result, returned)
 
     def handle_base(self, ctxt):
         """
@@ -102,31 +165,87 @@ class Resource(object):
         Important note: NEVER call this directly.  You should ALWAYS call the
         self.delegate() method to delegate control to another resource.
         """
-        
-        # Get the appropriate method.
-        meth_name = 'handle_%s' % ctxt.request_method
-        try:
-            meth = getattr(self, meth_name)
-        except AttributeError:
-            return ctxt.response.errorNotFound()
+        # Get the appropriate method from the table of the class.
+        func = self._dispatch_table.get(ctxt.request_method)
+        if func is not None:
+            return func(self, ctxt)
+
+        # Look for a handler set on the instance.
+        handler = self.get_handler(ctxt.request_method)
+        if handler is None:
+            return ctxt.response.errorMethodNotAllowed(self.get_allowed())
+        return handler(ctxt)
 
-        # Call the method handler.
-        return meth(ctxt)
-        
     def handle_nofail(self, ctxt):
         """
         Implementation of handle() that never fails.  If an appropriate method
         is not found, we simply do nothing.  This is used by the delegater
         classes.
         """
-        
-        # Get the appropriate method.
-        meth_name = 'handle_%s' % ctxt.request_method
-        try:
-            meth = getattr(self, meth_name)
-        except AttributeError:
+        # Get the appropriate method from the table of the class.
+        func = self._dispatch_table.get(ctxt.request_method)
+        if func is not None:
+            return func(self, ctxt)
+
+        # Look for a handler set on the instance.
+        handler = self.get_handler(ctxt.request_method)
+        if handler is None:
+            return None
+        return handler(ctxt)
+
+    def get_handler(self, method):
+        """
+        Return the bound handler method for the given request method, e.g. the
+        'handle_GET' method for 'GET', or None if this resource does not
+        support it.
+
+        The handlers of the class are found in its dispatch table, which is
+        computed when the class is created, so that dispatching a request to
+        them is a single lookup.  The handlers must therefore not be added to
+        the class after it is created.  The handlers set on the instance are
+        only looked up for the methods that the class does not handle, and do
+        not override the handlers of the class.
+        """
+        func = self._dispatch_table.get(method)
+        if func is not None:
+            return types.MethodType(func, self)
+        name = 'handle_' + method
+        if name in _hook_names:
             return None
+        handler = self.__dict__.get(name)
+        if not callable(handler):
+            return None
+        return handler
+
+    def get_allowed(self):
+        """
+        Return the sorted list of the request methods supported by this
+        resource.  See get_handler().
+        """
+        extra = [name[len('handle_'):] for name, value in self.__dict__.items()
+                 if (name.startswith('handle_') and name not in _hook_names and
+                     callable(value))]
+        if not extra:
+            return list(self._allowed_methods)
+        return sorted(set(self._allowed_methods).union(extra))
+
+
 
-        # Call the method handler.
-        return meth(ctxt)
+def is_deferred(result):
+    """
+    Return true if the given handler result is a Twisted Deferred, i.e. the
+    handler completes asynchronously.  Twisted is not required, any object with
+    the interface of a Deferred is accepted.
+    """
+    return hasattr(result, 'addCallbacks')
 
+def when_done(result, fun):
+    """
+    Call 'fun' with the given handler result when it is available and return
+    what it returns.  If the result is a Deferred, 'fun' is added to its
+    callbacks and errbacks, and receives the Failure if the handler failed, so
+    it should return its argument to let the failure propagate.
+    """
+    if is_deferred(result):
+        return result.addBoth(fun)
+    return fun(result)
@@ -10,7 +10,7 @@ integrate those default resources into any framework.
 """
 
 # stdlib imports
-import sys, cgi
+import sys, os, cgi
 
 
 __all__ = ('ResponseProxy', 'CGIResponse')
@@ -33,6 +33,12 @@ class ResponseProxy(object):
         """
         raise NotImplementedError
 
+    def addHeader(self, header, content):
+        """
+        Add a header to the response.
+        """
+        raise NotImplementedError
+
     def errorNotFound(self, msg=None):
         """
         Signal an error to the client indicating that the resource was not
@@ -40,6 +46,15 @@ class ResponseProxy(object):
         """
         raise NotImplementedError
 
+    def errorMethodNotAllowed(self, allowed):
+        """
+        Signal an error to the client indicating that the resource does not
+        support the request method (405).  'allowed' is the list of the methods
+        that it supports.  By default, this signals that the resource was not
+        found.
+        """
+        return self.errorNotFound()
+
     def errorForbidden(self, msg=None):
         """
         Signal an error to the client indicating that accessing the resource was
@@ -47,12 +62,58 @@ class ResponseProxy(object):
         """
         raise NotImplementedError
 
+    def notModified(self):
+        """
+        Signal to the client that the resource has not changed since the copy
+        it has cached (304).
+        """
+        raise NotImplementedError
+
     def redirect(self, target):
         """
         Redirect the client's browser to another URL.
         """
         raise NotImplementedError
 
+    def partialContent(self, first, last, size):
+        """
+        Signal to the client that the response contains the bytes 'first' to
+        'last' (inclusive) of a content of 'size' bytes (206).  Returns true if
+        the adapter supports partial responses, otherwise the entire content
+        should be sent.  By default, they are not supported.
+        """
+        return False
+
+    def errorRangeNotSatisfiable(self, size):
+        """
+        Signal an error to the client indicating that the range it requested
+        is outside of the content of 'size' bytes (416).  Returns true if the
+        adapter supports partial responses, otherwise the entire content should
+        be sent.  By default, they are not supported.
+        """
+        return False
+
+    def sendFile(self, fileobj, blksize=65536, length=None):
+        """
+        Write the contents of the given open file, from its current position, as
+        the body of the response.  If 'length' is specified, only that many
+        bytes are sent.  The response takes ownership of the file, which is
+        closed once it has been sent.  By default, this copies the file in
+        blocks of 'blksize' bytes with write(); adapters which can send files
+        more efficiently should override it.
+        """
+        try:
+            while length is None or length > 0:
+                data = fileobj.read(blksize if length is None
+                                    else min(blksize, length))
+                if not data:
+                    break
+                self.write(data)
+                if length is not None:
+                    length -= len(data)
+        finally:
+            fileobj.close()
+
     def log(self, message):
         """
         Send something to the log file.
@@ -97,7 +158,7 @@ class CGIResponse(ResponseProxy):
             # Output the headers
             for header, content in self.headers.iteritems():
                 self.outfile.write('%s: %s\n' % (header, content))
-            self.outfile.write('\n\n')
+            self.outfile.write('\n')
             self.wrote = True
 
         self.outfile.write(text)
@@ -112,6 +173,14 @@ class CGIResponse(ResponseProxy):
         self.write('<html><body><p>%s</p></body></html>\n' % msg)
         return True
 
+    def errorMethodNotAllowed(self, allowed):
+        msg = 'Method Not Allowed'
+        self.addHeader('Allow', ', '.join(allowed))
+        self.addHeader('Status', '405 %s' % msg)
+        self.setContentType('text/html')
+        self.write('<html><body><p>%s</p></body></html>\n' % msg)
+        return True
+
     def errorForbidden(self, msg=None):
         if msg is None:
             msg = 'Access Denied'
@@ -120,6 +189,22 @@ class CGIResponse(ResponseProxy):
         self.write('<html><body><p>%s</p></body></html>\n' % msg)
         return True
 
+    def notModified(self):
+        self.addHeader('Status', '304 Not Modified')
+        self.write('')
+        return True
+
+    def partialContent(self, first, last, size):
+        self.addHeader('Status', '206 Partial Content')
+        self.addHeader('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+        return True
+
+    def errorRangeNotSatisfiable(self, size):
+        self.addHeader('Status', '416 Requested Range Not Satisfiable')
+        self.addHeader('Content-Range', 'bytes */%d' % size)
+        self.write('')
+        return True
+
     def redirect(self, target):
         self.addHeader('Location', target)
         self.addHeader('Status', '302 Redirecting')
@@ -132,14 +217,19 @@ class CGIResponse(ResponseProxy):
         outf.flush()
         
 
-def cgi_getargs():
+def cgi_getargs(form=None):
     """
     Get the CGI arguments and convert them into a nice dictionary.
-    This is a convenience method.
+    This is a convenience method.  'form' is the cgi.FieldStorage to convert,
+    by default it is read from the CGI environment.
     """
-    form = cgi.FieldStorage()
+    if form is None:
+        form = cgi.FieldStorage()
 
     args = {}
+    if form.list is None:
+        # The body is not a form.
+        return args
     for varname in form.keys():
         value = form[varname]
 
@@ -158,3 +248,18 @@ def cgi_getargs():
 
     return args
 
+def cgi_getheaders(environ=None):
+    """
+    Get the HTTP request headers from the CGI environment, as a dictionary with
+    lowercase header names.  This is meant to be passed to the handlers in the
+    'headers' attribute of the context.  'environ' is the environment to read
+    the headers from, by default os.environ.
+    """
+    if environ is None:
+        environ = os.environ
+    headers = {}
+    for name, value in environ.iteritems():
+        if name.startswith('HTTP_'):
+            headers[name[5:].lower().replace('_', '-')] = value
+    return headers
+
@@ -0,0 +1,171 @@
+# This file is part of the Ranvier package.
+# See http://furius.ca/ranvier/ for license and details.
+
+"""
+Precompiled route tries.
+
+A route trie is built from the lists of components of the mappings and can be
+used to resolve a URI path to its mapping and the values of its variables in a
+single pass over the path components, without visiting the resource objects.
+"""
+
+# stdlib imports
+import re
+
+# ranvier imports
+from ranvier.enumerator import FixedComponent, VarComponent
+
+
+__all__ = ()
+
+
+
+class RouteNode(object):
+    """
+    A node of the route trie.
+    """
+    def __init__(self):
+        self.fixed = {}
+        """Children for fixed components, by component name."""
+
+        self.variables = []
+        """A list of (variable component, child node) pairs, in insertion
+        order."""
+
+        self.catchall = None
+        """A pair of (variable component, value) for a variable that consumes
+        all the remaining components, or None."""
+
+        self.value = None
+        """The value stored at this node if a route ends here, or None."""
+
+    def get_variable(self, comp):
+        """
+        Return the child node for the given variable component, creating it if
+        necessary.  Variables with the same name and format share a node.
+        """
+        for vcomp, child in self.variables:
+            if vcomp.varname == comp.varname and vcomp.format == comp.format:
+                return child
+        child = RouteNode()
+        self.variables.append( (comp, child) )
+        return child
+
+
+
+class RouteTrie(object):
+    """
+    A trie of path components.  Fixed components are looked up in a dict,
+    variable components match any single component, and catch-all variables
+    match zero or more of the remaining components.  When a path could be
+    matched in more than one way, fixed components have precedence over
+    variables, which have precedence over catch-alls.
+    """
+    def __init__(self):
+        self.root = RouteNode()
+
+    def add(self, components, value, catchall=False):
+        """
+        Add a route for the given list of components.  If 'catchall' is true,
+        the last component must be a variable and it is made to consume all the
+        remaining components of the path.  If a route already exists for the
+        same components, the first one added is kept.  Returns true if the
+        route was added.
+        """
+        components = [comp for comp in components
+                      if not (isinstance(comp, FixedComponent) and
+                              not comp.name)]
+        if catchall:
+            assert components and isinstance(components[-1], VarComponent)
+            components, last = components[:-1], components[-1]
+
+        node = self.root
+        for comp in components:
+            if isinstance(comp, VarComponent):
+                node = node.get_variable(comp)
+            else:
+                child = node.fixed.get(comp.name)
+                if child is None:
+                    child = node.fixed[comp.name] = RouteNode()
+                node = child
+
+        if catchall:
+            if node.catchall is not None:
+                return False
+            node.catchall = (last, value)
+        else:
+            if node.value is not None:
+                return False
+            node.value = value
+        return True
+
+    def resolve(self, path):
+        """
+        Resolve the given list of path components.  Returns a pair of the value
+        of the route and a list of (variable component, matched value) pairs,
+        or None if there is no route for the path.  The matched value of a
+        catch-all variable is the list of the components it consumed.
+        """
+        bindings = []
+        value = self._resolve(self.root, path, 0, bindings)
+        if value is None:
+            return None
+        return value, bindings
+
+    def _resolve(self, node, path, index, bindings):
+        if index == len(path):
+            if node.value is not None:
+                return node.value
+        else:
+            comp = path[index]
+            child = node.fixed.get(comp)
+            if child is not None:
+                value = self._resolve(child, path, index+1, bindings)
+                if value is not None:
+                    return value
+
+            for vcomp, child in node.variables:
+                if not self.accept(vcomp, comp):
+                    continue
+                bindings.append( (vcomp, comp) )
+                value = self._resolve(child, path, index+1, bindings)
+                if value is not None:
+                    return value
+                bindings.pop()
+
+        if node.catchall is not None:
+            vcomp, value = node.catchall
+            bindings.append( (vcomp, path[index:]) )
+            return value
+
+        return None
+
+    def accept(self, comp, value):
+        """
+        Return true if the given variable component may bind the given path
+        component.  By default, variables accept any component.
+        """
+        return True
+
+
+
+class TypedRouteTrie(RouteTrie):
+    """
+    A route trie whose variables only accept the components that could have
+    been rendered with their format, i.e. integer formats only accept digits.
+    This matches the same components as the regular expressions produced by
+    Mapping.render_regexp_matcher().
+    """
+    int_re = re.compile('[0-9]+$')
+    float_re = re.compile('[0-9\\.\\+\\-]+$')
+
+    def accept(self, comp, value):
+        format = comp.format
+        if format is None or format.endswith('s'):
+            return True
+        elif format.endswith('d'):
+            return self.int_re.match(value) is not None
+        elif format.endswith('f'):
+            return self.float_re.match(value) is not None
+        return True
+
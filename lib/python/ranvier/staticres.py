@@ -0,0 +1,201 @@
+# This file is part of the Ranvier package.
+# See http://furius.ca/ranvier/ for license and details.
+
+"""
+Static files resource.
+
+A resource that serves the files of a directory, which can be mounted anywhere
+in a resource tree and works with all the adapters.
+"""
+
+# stdlib imports
+import os, re, time, stat, mimetypes, threading, email.utils
+from os.path import join
+
+# ranvier imports
+from ranvier.resource import Resource
+from ranvier.miscres import VarVarResource
+from ranvier.cache import LRUCache
+
+
+__all__ = ('StaticFiles',)
+
+
+
+class StaticFiles(VarVarResource):
+    """
+    Serve the files under a directory, using the remaining components of the
+    path as the relative filename.
+
+    The results of stat() are cached for 'check_interval' seconds (at most
+    'cache_size' of them), so that the popular files are not looked up on
+    every request.  The files are served with ETag and Last-Modified headers,
+    conditional requests are answered with a 304 response, and single byte
+    ranges are supported if the adapter supports partial responses.  The files
+    are written with ResponseProxy.sendFile(), which lets the adapters send
+    them without copying them when possible.
+
+    Conditional and range requests need the adapter to pass the request headers
+    in a 'headers' attribute of the context (a dict with lowercase header
+    names).  The hidden files, whose names start with a dot, are not served.
+    """
+    range_re = re.compile('bytes=([0-9]*)-([0-9]*)$')
+
+    def __init__(self, rootdir, check_interval=2.0, cache_size=1000,
+                 max_age=None, **kwds):
+        """
+        'max_age' is the number of seconds that the clients may cache the files
+        without revalidating them, or None to let the clients decide.
+        """
+        VarVarResource.__init__(self, 'filepath', **kwds)
+        self.rootdir = rootdir
+        self.check_interval = check_interval
+        self.max_age = max_age
+
+        self.cache = LRUCache(cache_size)
+        """A cache of the relative filenames to their stat entries.  See
+        getentry()."""
+
+        self.lock = threading.Lock()
+
+    handle = Resource.handle
+
+    def getentry(self, filepath):
+        """
+        Return a list of (check time, filename, stat result, etag, last-modified
+        string) for the given list of path components, or None if there is no
+        such file.  The entries are revalidated after 'check_interval' seconds.
+        """
+        key = '/'.join(filepath)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            entry = self.cache.get(key)
+            if entry is not None and now - entry[0] < self.check_interval:
+                return entry[2] and entry
+        finally:
+            self.lock.release()
+
+        # Refuse the paths that would escape the directory.
+        for comp in filepath:
+            if comp.startswith('.') or '\0' in comp:
+                return None
+
+        fn = join(self.rootdir, *filepath)
+        try:
+            st = os.stat(fn)
+        except OSError:
+            st = None
+        if st is not None and not stat.S_ISREG(st.st_mode):
+            st = None
+
+        if st is None:
+            newentry = [now, fn, None, None, None]
+        else:
+            newentry = [now, fn, st,
+                        '"%x-%x-%x"' % (st.st_ino, st.st_size,
+                                        int(st.st_mtime)),
+                        email.utils.formatdate(st.st_mtime, usegmt=True)]
+        self.lock.acquire()
+        try:
+            if entry is not None:
+                entry[:] = newentry
+            elif self.cache.get(key) is None:
+                self.cache.put(key, newentry)
+        finally:
+            self.lock.release()
+        return st and newentry
+
+    def handle_GET(self, ctxt):
+        return self.serve(ctxt, True)
+
+    def handle_HEAD(self, ctxt):
+        return self.serve(ctxt, False)
+
+    def serve(self, ctxt, body):
+        response = ctxt.response
+        entry = self.getentry(ctxt.filepath)
+        if entry is None:
+            return response.errorNotFound()
+        fn, st, etag, lastmod = entry[1:]
+
+        # Open the file before setting any header, so that an error can still
+        # be returned if it cannot be read.
+        try:
+            f = open(fn, 'rb')
+        except IOError:
+            return response.errorNotFound()
+        try:
+            start, length = self.serve_headers(ctxt, fn, st, etag, lastmod)
+        except:
+            f.close()
+            raise
+        if length is None or not body:
+            # Output the headers, the adapters send them on the first write.
+            f.close()
+            response.write('')
+            return True
+
+        # The response closes the file once it has been sent.
+        if start:
+            f.seek(start)
+        response.sendFile(f, length=length)
+
+    def serve_headers(self, ctxt, fn, st, etag, lastmod):
+        """
+        Set the headers of the response for the given file, and return the
+        (start, length) of the bytes to send, or a length of None if no content
+        should be sent.
+        """
+        response = ctxt.response
+        headers = getattr(ctxt, 'headers', None) or {}
+
+        # Check the validators of the client's copy, if any.  The entity tag has
+        # precedence over the modification time (RFC 2616, 14.26).
+        inm = headers.get('if-none-match')
+        if inm is not None:
+            notmod = inm.strip() == '*' or etag in map(str.strip,
+                                                       inm.split(','))
+        else:
+            ims = headers.get('if-modified-since')
+            ims = ims and email.utils.parsedate_tz(ims)
+            notmod = (bool(ims) and
+                      email.utils.mktime_tz(ims) >= int(st.st_mtime))
+
+        response.addHeader('ETag', etag)
+        response.addHeader('Last-Modified', lastmod)
+        if self.max_age is not None:
+            response.addHeader('Cache-Control', 'max-age=%d' % self.max_age)
+        if notmod:
+            response.notModified()
+            return 0, None
+
+        contype = mimetypes.guess_type(fn)[0]
+        response.setContentType(contype or 'application/octet-stream')
+
+        # Find the byte range to send.  Only single ranges are supported, the
+        # entire file is sent for the others.
+        size = st.st_size
+        start, length = 0, size
+        rng = headers.get('range')
+        mo = rng and self.range_re.match(rng.strip())
+        if mo and headers.get('if-range', etag) in (etag, lastmod):
+            first, last = mo.groups()
+            if first:
+                first = int(first)
+                last = min(int(last or size - 1), size - 1)
+                valid = first <= int(mo.group(2) or first)
+            elif last:
+                first, last = max(size - int(last), 0), size - 1
+                valid = True
+            else:
+                valid = False
+
+            if valid and first > last:
+                if response.errorRangeNotSatisfiable(size):
+                    return 0, None
+            elif valid and response.partialContent(first, last, size):
+                start, length = first, last - first + 1
+
+        response.addHeader('Content-Length', str(length))
+        return start, length
@@ -14,12 +14,12 @@ from StringIO import StringIO
 from base64 import b64decode
 
 # twisted imports
-from twisted.web import resource, http, static
+from twisted.web import resource, http, static, server
 from zope.interface import implements
 
 # ranvier imports
 from ranvier.respproxy import ResponseProxy
-from ranvier import RanvierBadRoot
+from ranvier import RanvierError, RanvierBadRoot
 from ranvier.context import HandlerContext
 
 
@@ -30,8 +30,19 @@ __all__ = ('DispatchResource',)
 class TwistedWebResponseProxy(ResponseProxy):
     """
     Proxy for responding to Twisted.Web.
+
+    If 'streaming' is true, the text is written to the request as it is
+    produced, like CGIResponse does.  The text is held in a buffer until
+    'stream_threshold' bytes have been written, and the headers are sent with
+    it, so that handlers can still set headers after writing a little text,
+    e.g. the small responses are entirely buffered.  Otherwise, the text is
+    accumulated in a buffer which is returned by value().  A handler that needs
+    to set headers after it has written more than the threshold should call
+    bufferOutput() first.
     """
-    def __init__(self, twistreq):
+    stream_threshold = 8192
+
+    def __init__(self, twistreq, streaming=False):
         ResponseProxy.__init__(self)
 
         # A Twisted.Web Request object.
@@ -39,29 +50,112 @@ class TwistedWebResponseProxy(ResponseProxy):
 
         # A buffer to contain the response text.
         self.buffer = StringIO()
-        
-    def setContentType(self, contype):
-        self.twistreq.setHeader("Content-type", contype)
 
-    def addHeader(self, header, content):
-        assert header.lower() not in self.twistreq.headers
+        self.streaming = streaming
+        """True if the text is written directly to the request."""
+
+        self.wrote = False
+        """True if some text was written to the request, i.e. the headers have
+        been sent."""
+
+        self.producer = None
+        """A producer that sends a file to the request once the handlers have
+        completed, or None.  See sendFile()."""
+
+    def bufferOutput(self):
+        """
+        Buffer the text of the response instead of streaming it, so that
+        headers can still be set after writing.  This must be called before
+        the text is sent, i.e. before the buffer reaches the threshold.
+        """
+        if self.wrote:
+            raise RanvierError("Error: The response has already started, "
+                               "it cannot be buffered anymore.")
+        self.streaming = False
+
+    def flush(self):
+        """
+        Send the buffered text to the request, and with it the headers.  The
+        text written afterwards is sent directly.
+        """
+        self.wrote = True
+        text = self.buffer.getvalue()
+        self.buffer = StringIO()
+        if text:
+            self.twistreq.write(text)
+
+    def setContentType(self, contype):
+        self.addHeader("Content-type", contype, replace=True)
+
+    def addHeader(self, header, content, replace=False):
+        if self.wrote:
+            raise RanvierError("Error: Cannot set header '%s' after the "
+                               "response has started, call bufferOutput() "
+                               "before writing the text." % header)
+        assert replace or header.lower() not in self.twistreq.headers
         self.twistreq.setHeader(header, content)
 
     def value(self):
         return self.buffer.getvalue()
 
     def write(self, text):
-        self.buffer.write(text)
+        if self.wrote:
+            if text:
+                self.twistreq.write(text)
+        else:
+            self.buffer.write(text)
+            if (self.streaming and
+                self.buffer.tell() >= self.stream_threshold):
+                self.flush()
 
     def errorNotFound(self, msg=None):
         self.addHeader('Status', '404 %s' % (msg or ''))
-        self.twistreq.setHeader("Content-type", 'text/plain')
+        self.setContentType('text/plain')
         self.twistreq.setResponseCode(http.NOT_FOUND)
 
+    def errorMethodNotAllowed(self, allowed):
+        self.addHeader('Allow', ', '.join(allowed))
+        self.twistreq.setResponseCode(http.NOT_ALLOWED)
+
     def errorForbidden(self, msg=None):
         self.addHeader('Status', '403 %s' % msg or '')
         self.twistreq.setResponseCode(http.FORBIDDEN)
 
+    def notModified(self):
+        self.twistreq.setResponseCode(http.NOT_MODIFIED)
+
+    def partialContent(self, first, last, size):
+        self.twistreq.setResponseCode(http.PARTIAL_CONTENT)
+        self.addHeader('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+        return True
+
+    def errorRangeNotSatisfiable(self, size):
+        self.twistreq.setResponseCode(http.REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.addHeader('Content-Range', 'bytes */%d' % size)
+        return True
+
+    def sendFile(self, fileobj, blksize=65536, length=None):
+        # Send the file with a producer, which reads it as the transport can
+        # accept more data and closes it when it is done, unless some text has
+        # been written already.
+        if self.wrote or self.buffer.tell() or self.producer is not None:
+            return ResponseProxy.sendFile(self, fileobj, blksize, length)
+        if length is None:
+            self.producer = static.NoRangeStaticProducer(self.twistreq,
+                                                         fileobj)
+        else:
+            self.producer = static.SingleRangeStaticProducer(
+                self.twistreq, fileobj, fileobj.tell(), length)
+
+    def close(self):
+        """
+        Close the file that was to be sent, if any, for a request that is not
+        completed normally.
+        """
+        if self.producer is not None:
+            self.producer.stopProducing()
+            self.producer = None
+
     def redirect(self, target):
         self.twistreq.redirect(target)
         raise TwistedWebRedirect()
@@ -82,11 +176,22 @@ class DispatchResource(object):
 
     isLeaf = False
 
-    def __init__(self, cfg, mapper, rootdir, ctxt_cls=HandlerContext):
+    def __init__(self, cfg, mapper, rootdir, ctxt_cls=HandlerContext,
+                 streaming=False):
+        """
+        If 'streaming' is true, the responses are written to the clients as
+        they are produced rather than buffered until the handlers complete,
+        except for their beginning.  See TwistedWebResponseProxy.
+
+        The files under 'rootdir' are served for the requests that are not
+        found in the resource tree.  If it is None, they are not.  Mounting a
+        StaticFiles resource in the tree is more efficient.
+        """
         self.cfg = cfg
         self.mapper = mapper
         self.rootdir = rootdir
         self.ctxt_cls = ctxt_cls
+        self.streaming = streaming
 
     def getChildWithDefault(self, name, request):
         return self
@@ -110,7 +215,7 @@ class DispatchResource(object):
         ##trace('path', path)
 
         # Handle the request with our response object.
-        response = TwistedWebResponseProxy(request)
+        response = TwistedWebResponseProxy(request, self.streaming)
 
         badroot_redirect = 0
         try:
@@ -119,15 +224,45 @@ class DispatchResource(object):
                 ctxt_cls=self.ctxt_cls,
                 cfg=self.cfg,
                 referer=request.getHeader("referer") or None,
+                headers=request.received_headers,
                 auth_user=username)
+
+            # The handlers complete asynchronously, render the response when
+            # they are done.
+            if ctxt.deferred is not None:
+                ctxt.deferred.addCallbacks(
+                    self.render_async, self.render_failed,
+                    callbackArgs=(request, response),
+                    errbackArgs=(request, response))
+                return server.NOT_DONE_YET
         except TwistedWebRedirect:
             pass
         except RanvierBadRoot:
             badroot_redirect = 1
-        
+        except:
+            response.close()
+            raise
+
+        return self.render_response(request, response, badroot_redirect)
+
+    def render_response(self, request, response, badroot_redirect=0):
+        """
+        Render the response of a handled request.
+        """
+        # The response has been streamed, complete it.
+        if response.wrote:
+            request.finish()
+            return server.NOT_DONE_YET
+
+        # Send the file, the producer completes the request.
+        if response.producer is not None:
+            response.producer.start()
+            return server.NOT_DONE_YET
+
         # Serve files from a specific root directory.
         r = response.value()
-        if badroot_redirect or request.code == http.NOT_FOUND:
+        if (self.rootdir is not None and
+            (badroot_redirect or request.code == http.NOT_FOUND)):
             fn = join(self.rootdir, request.path[1:])
             if exists(fn) and isfile(fn):
                 
@@ -144,4 +279,20 @@ class DispatchResource(object):
             
         return r
 
-
+    def render_async(self, result, request, response):
+        """
+        Complete a request whose handlers completed asynchronously.
+        """
+        r = self.render_response(request, response)
+        if r != server.NOT_DONE_YET:
+            request.write(r)
+            request.finish()
+
+    def render_failed(self, failure, request, response):
+        """
+        Complete a request whose handlers failed asynchronously.
+        """
+        if failure.check(TwistedWebRedirect):
+            return self.render_async(None, request, response)
+        response.close()
+        request.processingFailed(failure)
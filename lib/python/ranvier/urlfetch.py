@@ -0,0 +1,112 @@
+# This file is part of the Ranvier package.
+# See http://furius.ca/ranvier/ for license and details.
+
+"""
+Conditional and compressed fetching of resource lists.
+
+The support tools fetch the list of resources rendered by an EnumResource every
+time they start.  The functions in this module request it compressed and keep a
+copy of it in a cache directory, which is revalidated with the ETag and
+Last-Modified headers sent by the server, so that an unchanged list is not
+transferred again.
+"""
+
+# stdlib imports
+import os, urllib, urllib2, urlparse, httplib, gzip, marshal, tempfile
+from os.path import join, isdir
+from StringIO import StringIO
+from hashlib import md5
+
+
+__all__ = ()
+
+
+
+def fetch(url, cachedir=None):
+    """
+    Fetch the contents of the given URL and return them as a string.  HTTP URLs
+    are requested with gzip compression and, if 'cachedir' is specified,
+    revalidated against the copy cached in that directory.  Other URLs (e.g.
+    local files) are read directly.  Raises an IOError on failure.
+    """
+    if urlparse.urlsplit(url)[0] not in ('http', 'https'):
+        return urllib.urlopen(url).read()
+
+    request = urllib2.Request(url)
+    request.add_header('Accept-Encoding', 'gzip')
+
+    # Add the validators of the cached copy, if there is one.
+    cached = None
+    if cachedir is not None:
+        cachefn = join(cachedir, md5(url).hexdigest())
+        cached = read_cache(cachefn)
+        if cached is not None:
+            etag, lastmod, contents = cached
+            if etag:
+                request.add_header('If-None-Match', etag)
+            if lastmod:
+                request.add_header('If-Modified-Since', lastmod)
+
+    try:
+        response = urllib2.urlopen(request)
+        try:
+            contents = response.read()
+            info = response.info()
+        finally:
+            response.close()
+    except urllib2.HTTPError, e:
+        if e.code == httplib.NOT_MODIFIED and cached is not None:
+            return cached[2]
+        raise
+    except httplib.HTTPException, e:
+        raise IOError(str(e))
+
+    if info.get('Content-Encoding', '').lower() == 'gzip':
+        contents = gzip.GzipFile(fileobj=StringIO(contents)).read()
+
+    if cachedir is not None:
+        write_cache(cachefn, (info.get('ETag'), info.get('Last-Modified'),
+                              contents))
+    return contents
+
+def read_cache(filename):
+    """
+    Read a cache entry.  Returns a tuple of (etag, last-modified, contents) or
+    None if there is no valid entry.
+    """
+    try:
+        f = open(filename, 'rb')
+        try:
+            entry = marshal.load(f)
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if not (isinstance(entry, tuple) and len(entry) == 3):
+        return None
+    return entry
+
+def write_cache(filename, entry):
+    """
+    Write a cache entry.  The file is replaced atomically, so that concurrent
+    fetches never read a partial entry.  Failures are ignored, the cache is
+    only an optimization.
+    """
+    dirname = os.path.dirname(filename)
+    try:
+        if not isdir(dirname):
+            os.makedirs(dirname)
+        fd, tmpfn = tempfile.mkstemp(dir=dirname)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                marshal.dump(entry, f, 2)
+            finally:
+                f.close()
+            os.rename(tmpfn, filename)
+        except:
+            os.remove(tmpfn)
+            raise
+    except (IOError, OSError):
+        pass
+
@@ -0,0 +1,336 @@
+# This file is part of the Ranvier package.
+# See http://furius.ca/ranvier/ for license and details.
+
+"""
+Response proxy to work with WSGI.
+
+This is used to serve a resource tree from any WSGI server, e.g. the
+multi-threaded and pre-forking servers, without the cost of a process per
+request of CGI.
+"""
+
+# stdlib imports
+import os, cgi, StringIO
+
+# ranvier imports
+from ranvier import RanvierError, RanvierBadRoot
+from ranvier.respproxy import ResponseProxy, cgi_getargs, cgi_getheaders
+from ranvier.context import HandlerContext
+
+
+__all__ = ('WSGIApplication',)
+
+
+
+class WSGIResponse(ResponseProxy):
+    """
+    Proxy for responding to a WSGI server.
+
+    The status and headers are collected while the request is handled, and the
+    text written by the handlers is kept as a list of chunks.  The body is
+    returned to the server as an iterable of those chunks, which reads the
+    files sent with sendFile() in blocks as it is iterated, or as the file
+    wrapper of the server.  The unicode text is encoded in UTF-8.
+
+    If 'streaming' is true, the text is sent to the server with the write
+    callable of start_response() as it is produced.  The text is held until
+    'stream_threshold' bytes have been written, and the response is started
+    with it, so that handlers can still set headers and the status after
+    writing a little text, e.g. the small responses are entirely buffered and
+    have a Content-Length.  A handler that needs to set headers after it has
+    written more than the threshold should call bufferOutput() first.  The
+    files sent with sendFile() are always returned in the body iterable.
+    """
+    stream_threshold = 8192
+
+    def __init__(self, environ, start_response=None, streaming=False):
+        ResponseProxy.__init__(self)
+
+        self.environ = environ
+        """The WSGI environment of the request."""
+
+        self.start_response = start_response
+        """The start_response() callable of the server, or None if the text
+        cannot be streamed."""
+
+        self.streaming = streaming and start_response is not None
+        """True if the text is written to the server once the buffered text
+        reaches the threshold."""
+
+        self.writer = None
+        """The write callable returned by start_response(), or None if the
+        response has not started yet."""
+
+        self.file_wrapper = environ.get('wsgi.file_wrapper')
+        """The file wrapper of the server, or None."""
+
+        self.status = '200 OK'
+        """The status line."""
+
+        self.contype = 'text/plain'
+        """Content type."""
+
+        self.headers = []
+        """Additional response headers, as a list of (name, value) pairs."""
+
+        self.body = []
+        """The parts of the body, as a list of written chunks and of tuples of
+        (file, block size, length) for the files to send, or a wrapped file."""
+
+        self.length = 0
+        """The length of the body."""
+
+    def getheaders(self, length=True):
+        """
+        Return the list of headers for start_response().  If 'length' is
+        false, the Content-Length is not added, e.g. for the streamed text.
+        """
+        # The responses without content must not have a content type.
+        if self.status[:3] in ('204', '304'):
+            return self.headers
+        headers = [('Content-type', self.contype)] + self.headers
+        if length and \
+                'content-length' not in (x.lower() for x, y in self.headers):
+            headers.append(('Content-Length', str(self.length)))
+        return headers
+
+    def bufferOutput(self):
+        """
+        Buffer the text of the response instead of streaming it, so that
+        headers can still be set after writing.  This must be called before
+        the text is sent, i.e. before the buffer reaches the threshold.
+        """
+        if self.writer is not None:
+            raise RanvierError("Error: The response has already started, "
+                               "it cannot be buffered anymore.")
+        self.streaming = False
+
+    def flush(self):
+        """
+        Start the response with the status and headers, and send the buffered
+        text with the write callable of the server.  The text written
+        afterwards is sent directly, until a file is sent.
+        """
+        self.writer = self.start_response(self.status, self.getheaders(False))
+        while self.body and isinstance(self.body[0], str):
+            self.writer(self.body.pop(0))
+
+    def setStatus(self, status):
+        """
+        Set the status line, before the response has started.
+        """
+        if self.writer is not None:
+            raise RanvierError("Error: Cannot set the status '%s' after the "
+                               "response has started, call bufferOutput() "
+                               "before writing the text." % status)
+        self.status = status
+
+    def getbody(self):
+        """
+        Return the body iterable for the server.
+        """
+        if not isinstance(self.body, list):
+            return self.body
+        return WSGIBody(self.body)
+
+    def close(self):
+        """
+        Close the files sent with sendFile(), if the body is not returned to
+        the server.
+        """
+        if isinstance(self.body, list):
+            WSGIBody(self.body).close()
+        elif hasattr(self.body, 'close'):
+            self.body.close()
+
+    def setContentType(self, contype):
+        if self.writer is not None:
+            raise RanvierError("Error: Cannot set the content type after the "
+                               "response has started, call bufferOutput() "
+                               "before writing the text.")
+        self.contype = contype
+
+    def addHeader(self, header, content):
+        # Support the CGI convention of setting the status with a header.
+        if header.lower() == 'status':
+            return self.setStatus(content)
+        if self.writer is not None:
+            raise RanvierError("Error: Cannot set header '%s' after the "
+                               "response has started, call bufferOutput() "
+                               "before writing the text." % header)
+        assert header.lower() not in (x.lower() for x, y in self.headers)
+        self.headers.append((header, content))
+
+    def write(self, text):
+        if not isinstance(self.body, list):
+            raise RanvierError("Error: Cannot write to the response after a "
+                               "file has been sent.")
+        if text:
+            if isinstance(text, unicode):
+                text = text.encode('utf-8')
+            if self.writer is not None and not self.body:
+                self.writer(text)
+                return
+            self.body.append(text)
+            self.length += len(text)
+            if (self.streaming and self.writer is None and
+                self.length >= self.stream_threshold):
+                self.flush()
+
+    def sendFile(self, fileobj, blksize=65536, length=None):
+        if not isinstance(self.body, list):
+            raise RanvierError("Error: Cannot write to the response after a "
+                               "file has been sent.")
+
+        # The files which are not on disk are copied.
+        try:
+            remaining = os.fstat(fileobj.fileno()).st_size - fileobj.tell()
+        except (AttributeError, ValueError, EnvironmentError):
+            return ResponseProxy.sendFile(self, fileobj, blksize, length)
+        if length is None or length > remaining:
+            length = remaining
+
+        # Let the server send the file, e.g. with sendfile(), unless some text
+        # is held already.  The streamed text is sent before the body.  The wrapper sends the rest of the file, so
+        # it cannot be used for a part of it.
+        if (self.file_wrapper is not None and not self.body and
+            length == remaining):
+            self.body = self.file_wrapper(fileobj, blksize)
+        else:
+            self.body.append((fileobj, blksize, length))
+        self.length += length
+
+    def error(self, status):
+        self.setStatus(status)
+        self.setContentType('text/html')
+        self.write('<html><body><p>%s</p></body></html>\n' %
+                   status.split(' ', 1)[1])
+        return True
+
+    def errorNotFound(self, msg=None):
+        return self.error('404 %s' % (msg or 'Not Found'))
+
+    def errorMethodNotAllowed(self, allowed):
+        self.addHeader('Allow', ', '.join(allowed))
+        return self.error('405 Method Not Allowed')
+
+    def errorForbidden(self, msg=None):
+        return self.error('403 %s' % (msg or 'Forbidden'))
+
+    def notModified(self):
+        self.setStatus('304 Not Modified')
+        return True
+
+    def partialContent(self, first, last, size):
+        self.setStatus('206 Partial Content')
+        self.addHeader('Content-Range', 'bytes %d-%d/%d' % (first, last, size))
+        return True
+
+    def errorRangeNotSatisfiable(self, size):
+        self.setStatus('416 Requested Range Not Satisfiable')
+        self.addHeader('Content-Range', 'bytes */%d' % size)
+        return True
+
+    def redirect(self, target):
+        self.addHeader('Location', target)
+        self.setStatus('302 Found')
+        return True
+
+    def log(self, message):
+        if not message.endswith('\n'):
+            message += '\n'
+        self.environ['wsgi.errors'].write(message)
+
+
+
+class WSGIBody(object):
+    """
+    The iterable returned to the server for a list of body parts.  The parts
+    are the written chunks and the tuples of (file, block size, length) for the
+    files to send, which are read in blocks as the body is iterated.  The files
+    are closed when the server calls close(), whether the body has been
+    iterated or not.
+    """
+    def __init__(self, body):
+        self.body = body
+
+    def __iter__(self):
+        for part in self.body:
+            if isinstance(part, str):
+                yield part
+                continue
+            fileobj, blksize, length = part
+            while length > 0:
+                data = fileobj.read(min(blksize, length))
+                if not data:
+                    break
+                length -= len(data)
+                yield data
+
+    def close(self):
+        for part in self.body:
+            if not isinstance(part, str):
+                part[0].close()
+
+
+
+class WSGIApplication(object):
+    """
+    A WSGI application that handles the requests with a URL mapper.
+
+    The URI that is mapped is the concatenation of SCRIPT_NAME and PATH_INFO,
+    so the 'rootloc' of the mapper should include the location at which the
+    application is mounted.  The handlers receive the lowercase request
+    headers in the 'headers' attribute of the context and the WSGI environment
+    in the 'environ' attribute.  The handlers must complete synchronously.
+    """
+    def __init__(self, mapper, ctxt_cls=HandlerContext, streaming=False,
+                 **extra):
+        """
+        'streaming': if true, the large texts are sent to the server as they
+                     are written.  See WSGIResponse.
+        'extra' are additional attributes to set on the contexts.
+        """
+        self.mapper = mapper
+        self.ctxt_cls = ctxt_cls
+        self.streaming = streaming
+        self.extra = extra
+
+    def __call__(self, environ, start_response):
+        response = WSGIResponse(environ, start_response, self.streaming)
+
+        uri = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+
+        # Do not read a body of unknown length, the input could block.
+        if environ.get('CONTENT_LENGTH'):
+            fp = environ['wsgi.input']
+        else:
+            fp = StringIO.StringIO()
+
+        # The cgi module parses the command-line arguments when there is no
+        # query string in the environment.
+        formenv = environ
+        if 'QUERY_STRING' not in environ:
+            formenv = dict(environ, QUERY_STRING='')
+        form = cgi.FieldStorage(fp=fp, environ=formenv, keep_blank_values=True)
+        try:
+            ctxt = self.mapper.handle_request(
+                environ['REQUEST_METHOD'], uri, cgi_getargs(form), response,
+                ctxt_cls=self.ctxt_cls,
+                headers=cgi_getheaders(environ),
+                environ=environ,
+                **self.extra)
+            if ctxt.deferred is not None:
+                raise RanvierError("Error: The handlers for '%s' completed "
+                                   "asynchronously, this is not supported "
+                                   "with WSGI." % uri)
+        except RanvierBadRoot:
+            response.errorNotFound()
+        except:
+            response.close()
+            raise
+
+        if response.writer is None:
+            start_response(response.status, response.getheaders())
+        return response.getbody()
+
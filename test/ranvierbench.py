@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+# This file is part of the Ranvier package.
+# See http://furius.ca/ranvier/ for license and details.
+
+"""ranvierbench.py [<options>] [<benchmark> ...]
+
+Micro-benchmarks for the hot paths of the library, based on the demoapp resource
+tree for the most part.  Run without arguments to run all the benchmarks.
+"""
+
+# stdlib imports
+import sys, os, re, timeit, tempfile
+from os.path import *
+# Allow import demoapp.
+sys.path.append(join(dirname(dirname(abspath(__file__))), 'demo'))
+
+# ranvier imports
+from ranvier import *
+from ranvier.mapper import Mapping, urlpattern_to_components
+from ranvier.context import PathLocator
+from ranvier.reporters.shmcoverage import MmapCoverageReporter
+
+# ranvier demo imports
+import demoapp
+
+
+
+units = {'s': 1, 'ms': 1e3, 'us': 1e6}
+
+def report(title, number, seconds, unit='us'):
+    """
+    Print the time per iteration for a benchmark.
+    """
+    print '  %-40s %10.3f %s' % (title, seconds / number * units[unit], unit)
+
+def timeit_best(fun, number, repeat=3, gcenabled=False):
+    """
+    Return the best total time of 'repeat' runs of 'number' calls of 'fun'.
+    The garbage collector is disabled while timing, unless 'gcenabled' is true.
+    """
+    setup = 'import gc; gc.enable()' if gcenabled else 'pass'
+    return min(timeit.repeat(fun, setup, number=number, repeat=repeat))
+
+
+
+def create_large_tree(nbsections):
+    """
+    Create a synthetic resource tree with many resources.
+    """
+    sections = {}
+    for i in xrange(nbsections):
+        sections['section%d' % i] = Folder(
+            index=LeafResource(resid='@@Index%d' % i),
+            items=VarDelegatorResource(
+                'item', Folder(view=LeafResource(resid='@@View%d' % i),
+                               edit=LeafResource(resid='@@Edit%d' % i))),
+            resid='@@Section%d' % i)
+    return Folder(resid='@@Root', **sections)
+
+def bench_snapshot(number):
+    """
+    Compare creating a mapper by enumerating a large resource tree against
+    loading it from a snapshot.
+    """
+    root = create_large_tree(5000)
+    mapper = UrlMapper(root)
+    fd, filename = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        mapper.dump_snapshot(filename)
+        initialize = timeit_best(lambda: UrlMapper(root), 1)
+        snapshot = timeit_best(
+            lambda: UrlMapper.load_snapshot(filename, root), 1)
+    finally:
+        os.remove(filename)
+
+    print '%d mappings' % len(mapper.keys())
+    report('UrlMapper.initialize()', 1, initialize, 'ms')
+    report('UrlMapper.load_snapshot()', 1, snapshot, 'ms')
+
+
+
+def bench_render(number):
+    """
+    Compare the compiled renderers of the mappings against the generic
+    rendering method.
+    """
+    mapper = UrlMapper(rootloc='/demo')
+    demoapp.create_application(mapper)
+
+    tests = (('@@Home', {}, None),
+             ('@@UserData', {'username': 'martin', 'userdata': 'school'},
+              None),
+             ('@@IntegerComponent', {'uid': 1042}, None),
+             ('@@OptionalParams', {}, {'cat': 'Miaouw'}),
+             ('@@ExternalExample', {}, None))
+
+    for resid, posargs, optargs in tests:
+        mapping = mapper[resid]
+        rootloc = mapper.rootloc
+        generic = timeit_best(
+            lambda: mapping._render(mapping.urltmpl, posargs, optargs,
+                                    rootloc), number)
+        compiled = timeit_best(
+            lambda: mapping.render(posargs, optargs, rootloc), number)
+        full = timeit_best(
+            lambda: mapper.mapurl(resid, **dict(posargs, **optargs or {})),
+            number)
+
+        print resid
+        report('Mapping._render() (generic)', number, generic)
+        report('Mapping.render() (compiled)', number, compiled)
+        report('UrlMapper.mapurl()', number, full)
+
+
+
+def load_reference(lines):
+    """
+    The original implementation of UrlMapper.load(), for comparison.
+    """
+    mapper = UrlMapper()
+    inpat_re = re.compile('([^:\s]+)\s*:\s*(.*)\s*$')
+
+    for line in lines:
+        if not line:
+            continue
+        mo = inpat_re.match(line.strip())
+        if not mo:
+            raise RanvierError("Warning: Error parsing line '%s' on load." %
+                               line)
+        resid, urlpattern = mo.groups()
+        unparsed, isterminal = urlpattern_to_components(urlpattern)
+        mapping = Mapping(resid, unparsed, isterminal)
+
+        # The original UrlMapper._add_mapping(), which did not compile the
+        # renderers of the mappings.
+        if resid in mapper.mappings:
+            lines = ("Error: Duplicate resource id '%s':" % resid,
+                     "  Existing mapping: %s" %
+                     mapper.mappings[resid].render_pattern(mapper.rootloc),
+                     "  New mapping     : %s" %
+                     mapping.render_pattern(mapper.rootloc))
+            raise RanvierError(os.linesep.join(lines))
+        mapper.mappings[resid] = mapping
+
+    return mapper
+
+def bench_load(number):
+    """
+    Compare the original and current text loaders on a synthetic list of 50000
+    resources, a tenth of which are aliases.
+    """
+    lines = []
+    for i in xrange(45000):
+        lines.append('@@Resource%d : /section%d/(username)/item%d/(id%%08d)' %
+                     (i, i % 100, i))
+    for i in xrange(5000):
+        lines.append('@@Alias%d : /section%d/(username)/item%d/(id%%08d)' %
+                     (i, i % 100, i))
+
+    # Time with the garbage collector enabled, as it is when a real mapper is
+    # loaded.
+    reference = timeit_best(lambda: load_reference(lines), 1, gcenabled=True)
+    current = timeit_best(lambda: UrlMapper.load(lines), 1, gcenabled=True)
+
+    assert UrlMapper.load(lines).render() == load_reference(lines).render()
+    report('original loader', 1, reference, 'ms')
+    report('UrlMapper.load()', 1, current, 'ms')
+
+
+
+def bench_mapurl_many(number):
+    """
+    Compare rendering a listing of links with mapurl() in a loop against the
+    batched mapurl_many().
+    """
+    mapper = UrlMapper(rootloc='/demo')
+    demoapp.create_application(mapper)
+    mapper.add_reporter(SimpleReporter())
+
+    usernames = ['user%d' % i for i in xrange(1000)]
+    nbatches = max(number // len(usernames), 1)
+
+    mapurl = mapper.mapurl
+    loop = timeit_best(
+        lambda: [mapurl('@@PrintUsername', x) for x in usernames], nbatches)
+    batched = timeit_best(
+        lambda: list(mapper.mapurl_many('@@PrintUsername', usernames)),
+        nbatches)
+
+    report('UrlMapper.mapurl() (per link)', nbatches * len(usernames), loop)
+    report('UrlMapper.mapurl_many() (per link)',
+           nbatches * len(usernames), batched)
+
+
+
+def bench_cache(number):
+    """
+    Compare mapurl() with and without the URL cache, for a parameterless
+    mapping and for a mapping with a positional argument.
+    """
+    for cache_size in (0, 1000):
+        mapper = UrlMapper(rootloc='/demo', cache_size=cache_size)
+        demoapp.create_application(mapper)
+        mapurl = mapper.mapurl
+
+        print 'cache_size=%d' % cache_size
+        report("mapurl('@@Home')", number,
+               timeit_best(lambda: mapurl('@@Home'), number))
+        report("mapurl('@@PrintName', 'martin')", number,
+               timeit_best(lambda: mapurl('@@PrintName', 'martin'), number))
+
+
+
+class ReferenceContext(object):
+    """
+    The original implementation of HandlerContext, for comparison.
+    """
+    def __init__(self, method, uri, args, rootloc=None):
+        self.request_method = method
+        self.locator = ReferenceLocator.from_uri(uri, rootloc)
+        self.args = args
+
+class ReferenceLocator(object):
+    """
+    The original implementation of PathLocator, for comparison.
+    """
+    @staticmethod
+    def from_uri(uri, rootloc=None):
+        trailing = False
+        if uri.endswith('/'):
+            trailing = True
+        path = [x for x in uri.split('/') if x]
+        return ReferenceLocator(path, trailing, rootloc)
+
+    def __init__(self, path, trailing=False, rootloc=None):
+        self.rootloc = rootloc
+        self.path = path
+        self.index = 0
+        self.trailing = trailing
+
+def create_context(ctxt_cls, uri, mapper):
+    """
+    Create a context and set the same attributes on it as
+    UrlMapper.handle_request().
+    """
+    ctxt = ctxt_cls('GET', uri, {}, None)
+    ctxt.mapper = mapper
+    ctxt.redirect_data = None
+    ctxt.reporters = mapper.reporters
+    ctxt.response = None
+    ctxt.mapurl = mapper.mapurl
+    ctxt.page = None
+    return ctxt
+
+def context_size(ctxt):
+    """
+    Return the number of bytes allocated for a context, its locator and their
+    containers.  The values shared with the mapper are not counted.
+    """
+    loc = ctxt.locator
+    size = sys.getsizeof(ctxt) + sys.getsizeof(loc) + sys.getsizeof(ctxt.mapurl)
+    for obj in (ctxt, loc):
+        if hasattr(obj, '__dict__'):
+            size += sys.getsizeof(obj.__dict__)
+    if isinstance(loc, PathLocator):
+        size += sys.getsizeof(loc.pathstr)
+    else:
+        size += sys.getsizeof(loc.path) + sum(map(sys.getsizeof, loc.path))
+    return size
+
+def bench_context(number):
+    """
+    Compare the memory allocated for the contexts of a mix of requests and the
+    time it takes to create them, for the original and the slotted contexts.
+    Uses tracemalloc if it is available, otherwise adds up the sizes of the
+    objects.
+    """
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+
+    mapper = UrlMapper()
+    demoapp.create_application(mapper)
+    uris = ['/', '/home', '/users/martin/username', '/users/martin/data/school',
+            '/wopts', '/lcomp/president', '/fold/', '/rest/a/b/c/d']
+
+    for title, ctxt_cls in (('original', ReferenceContext),
+                            ('HandlerContext', HandlerContext)):
+        if tracemalloc is not None:
+            tracemalloc.start()
+            contexts = [create_context(ctxt_cls, uri, mapper) for uri in uris]
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del contexts
+        else:
+            size = sum(context_size(create_context(ctxt_cls, uri, mapper))
+                       for uri in uris)
+
+        print title
+        print '  %-40s %10d bytes' % ('allocated per request',
+                                      size // len(uris))
+        report('creation (per request)', number, timeit_best(
+            lambda: [create_context(ctxt_cls, uri, mapper) for uri in uris],
+            number // len(uris)))
+
+
+
+def bench_pool(number):
+    """
+    Compare handling a mix of requests with new contexts for every request
+    against contexts reused from the pool.
+    """
+    uris = ['/users/martin/username', '/users/martin/data/school', '/wopts',
+            '/lcomp/president', '/rest/a/b/c/d']
+    response = NullResponse()
+
+    for pool_contexts in (False, True):
+        mapper = UrlMapper(pool_contexts=pool_contexts)
+        demoapp.create_application(mapper)
+        page = demoapp.PageLayout(mapper)
+
+        def handle():
+            for uri in uris:
+                mapper.handle_request('GET', uri, {}, response, page=page)
+
+        nbatches = max(number // 10 // len(uris), 1)
+        report('pool_contexts=%s (per request)' % pool_contexts,
+               nbatches * len(uris), timeit_best(handle, nbatches))
+
+
+
+def bench_routes(number):
+    """
+    Compare handling requests by walking down a large tree against skipping its
+    plain folders and variable delegators with the compiled routes.
+    """
+    root = create_large_tree(100)
+    uris = ['/section7/index', '/section42/items/1234/view',
+            '/section99/items/5678/edit']
+    response = NullResponse()
+
+    for compile_routes in (False, True):
+        mapper = UrlMapper(root, compile_routes=compile_routes)
+
+        def handle():
+            for uri in uris:
+                mapper.handle_request('GET', uri, {}, response)
+
+        nbatches = max(number // 10 // len(uris), 1)
+        report('compile_routes=%s (per request)' % compile_routes,
+               nbatches * len(uris), timeit_best(handle, nbatches))
+
+
+
+class NullResponse(ResponseProxy):
+    """
+    A response proxy that discards everything.
+    """
+    def setContentType(self, contype):
+        pass
+
+    def write(self, text):
+        pass
+
+    def errorNotFound(self, msg=None):
+        pass
+
+def handle_reference(self, ctxt):
+    """
+    The original implementation of Resource.handle(), for comparison.
+    """
+    meth_name = 'handle_%s' % ctxt.request_method
+    try:
+        meth = getattr(self, meth_name)
+    except AttributeError:
+        return ctxt.response.errorNotFound()
+    return meth(ctxt)
+
+def bench_dispatch(number):
+    """
+    Compare dispatching to the handler method of a resource with getattr()
+    against the dispatch tables, for a supported and an unsupported method.
+    """
+    class Getter(LeafResource):
+        def handle_GET(self, ctxt):
+            pass
+
+    resource = Getter()
+    for method in ('GET', 'PROPFIND'):
+        ctxt = HandlerContext(method, '/', {})
+        ctxt.response = NullResponse()
+
+        print method
+        report('getattr() (original)', number,
+               timeit_best(lambda: handle_reference(resource, ctxt), number))
+        report('Resource.handle()', number,
+               timeit_best(lambda: resource.handle(ctxt), number))
+
+
+
+class NullReporter(ResourceReporter):
+    """
+    A reporter that ignores everything.
+    """
+    def register_handled(self, resid):
+        pass
+
+    def register_rendered(self, resid):
+        pass
+
+def bench_reporters(number):
+    """
+    Measure mapurl() and handling a request with 0, 1 and 3 reporters.
+    """
+    response = NullResponse()
+    for nbreporters in (0, 1, 3):
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        for i in xrange(nbreporters):
+            mapper.add_reporter(NullReporter())
+        page = demoapp.PageLayout(mapper)
+        mapurl = mapper.mapurl
+
+        print '%d reporters' % nbreporters
+        report("mapurl('@@PrintName', 'martin')", number,
+               timeit_best(lambda: mapurl('@@PrintName', 'martin'), number))
+        report("handle_request('/users/martin/username')", number // 10,
+               timeit_best(lambda: mapper.handle_request(
+                   'GET', '/users/martin/username', {}, response, page=page),
+                           number // 10))
+
+
+
+def bench_coverage(number):
+    """
+    Compare handling requests with a dbm coverage reporter that writes the
+    counts on every request, a buffered one that writes them in batches, the
+    shared-memory one, and the dbm one sampling 1% of the requests.
+    """
+    uris = ['/users/martin/username', '/users/martin/data/school', '/wopts',
+            '/lcomp/president', '/rest/a/b/c/d']
+    response = NullResponse()
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for title in ('DbmCoverageReporter', 'BufferedCoverageReporter',
+                      'MmapCoverageReporter', 'SamplingReporter'):
+            mapper = UrlMapper()
+            demoapp.create_application(mapper)
+            backend = DbmCoverageReporter(join(tmpdir, title))
+            if title == 'BufferedCoverageReporter':
+                reporter = BufferedCoverageReporter(backend)
+            elif title == 'MmapCoverageReporter':
+                reporter = MmapCoverageReporter(join(tmpdir, 'mmap'), mapper)
+            elif title == 'SamplingReporter':
+                reporter = SamplingReporter(backend, 100, randomize=True)
+            else:
+                reporter = backend
+            mapper.add_reporter(reporter)
+            page = demoapp.PageLayout(mapper)
+
+            def handle():
+                for uri in uris:
+                    mapper.handle_request('GET', uri, {}, response, page=page)
+
+            nbatches = max(number // 100 // len(uris), 1)
+            report('%s (per request)' % title, nbatches * len(uris),
+                   timeit_best(handle, nbatches))
+            if reporter is not backend and hasattr(reporter, 'close'):
+                reporter.close()
+            backend.dbm.close()
+    finally:
+        for fn in os.listdir(tmpdir):
+            os.remove(join(tmpdir, fn))
+        os.rmdir(tmpdir)
+
+
+
+def bench_static(number):
+    """
+    Compare serving a static file with StaticFiles through the WSGI adapter
+    with the stat() results cached and revalidated on every request.
+    """
+    from wsgiref.util import setup_testing_defaults
+    from ranvier.wsgiproxy import WSGIApplication
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        open(join(tmpdir, 'style.css'), 'w').write('body {}\n' * 100)
+        for check_interval in (0, 2.0):
+            app = WSGIApplication(UrlMapper(Folder(
+                static=StaticFiles(tmpdir, check_interval=check_interval))))
+            environ = {'PATH_INFO': '/static/style.css', 'SCRIPT_NAME': ''}
+            setup_testing_defaults(environ)
+
+            def handle():
+                for data in app(environ, lambda status, headers: None):
+                    pass
+
+            report('check_interval=%s (per request)' % check_interval,
+                   number // 10, timeit_best(handle, number // 10))
+    finally:
+        os.remove(join(tmpdir, 'style.css'))
+        os.rmdir(tmpdir)
+
+
+
+benchmarks = [(name[6:], fun) for name, fun in sorted(globals().iteritems())
+              if name.startswith('bench_')]
+
+def main():
+    import optparse
+    parser = optparse.OptionParser(__doc__.strip())
+
+    parser.add_option('-n', '--number', action='store', type='int',
+                      default=100000,
+                      help="Number of iterations for each timing.")
+
+    opts, args = parser.parse_args()
+
+    names = [name for name, fun in benchmarks]
+    for name in args:
+        if name not in names:
+            parser.error("Unknown benchmark '%s' (available: %s)." %
+                         (name, ', '.join(names)))
+
+    for name, fun in benchmarks:
+        if args and name not in args:
+            continue
+        print '== %s' % name
+        fun(opts.number)
+
+if __name__ == '__main__':
+    main()
+
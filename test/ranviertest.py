@@ -7,7 +7,8 @@ Simple automated tests, based on the demoapp resource tree for the most part.
 """
 
 # stdlib imports
-import sys, os, unittest
+import sys, os, time, unittest, StringIO, tempfile, threading, BaseHTTPServer
+import wsgiref.util, wsgiref.validate
 from os.path import *
 # Allow import demoapp.
 sys.path.append(join(dirname(dirname(abspath(__file__))), 'demo'))
@@ -15,7 +16,11 @@ sys.path.append(join(dirname(dirname(abspath(__file__))), 'demo'))
 # ranvier imports
 from ranvier import *
 from ranvier.enumerator import VarComponent, FixedComponent
+from ranvier.reporters.callgraph import callgraph_pack_record
+from ranvier.reporters.shmcoverage import MmapCoverageReporter
 import ranvier.mapper
+from ranvier.wsgiproxy import WSGIApplication
+import ranvier.wsgiproxy
 
 # ranvier demo imports
 import demoapp
@@ -76,6 +81,95 @@ class TestMappings(testBaseCls):
         # Load from a file.
         fromfile_mapper = UrlMapper.urlload('example-resources.txt')
 
+        # Identical patterns and components are shared.
+        loaded_mapper = UrlMapper.load(['@@A : /users/(username)/name',
+                                        '',
+                                        '@@B:/users/(username)/name',
+                                        '@@C : /users/(username)/data'])
+        a, b, c = [loaded_mapper[x] for x in ('@@A', '@@B', '@@C')]
+        self.assert_(a.components is b.components)
+        self.assert_(a.components[1] is c.components[1])
+        assertEquals(loaded_mapper.mapurl('@@B', 'martin'),
+                     '/users/martin/name')
+
+        # Invalid lines.
+        for lines in (['@@A /users'], [' : /users'], ['@@A B : /users'],
+                      ['@@A : /users', '@@A : /users']):
+            assertRaises(RanvierError, UrlMapper.load, lines)
+
+    def test_urlload_cache(self):
+        "Testing fetching the mapper conditionally and compressed."
+
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        server = EnumTestServer(mapper)
+        cachedir = tempfile.mkdtemp()
+        try:
+            url = 'http://127.0.0.1:%d/resources' % server.server_port
+
+            # The first fetch fills the cache and is compressed.
+            loaded = UrlMapper.urlload(url, cachedir)
+            assertEquals(loaded.render(), mapper.render())
+            assertEquals(server.statuses, [200])
+            assertEquals(server.encodings, ['gzip'])
+            assertEquals(len(os.listdir(cachedir)), 1)
+
+            # The next ones are revalidated.
+            loaded = UrlMapper.urlload(url, cachedir)
+            assertEquals(loaded.render(), mapper.render())
+            assertEquals(server.statuses, [200, 304])
+
+            # Changing the mappings invalidates the cached copy.
+            mapper.add_alias('@@NewAlias', '@@Home')
+            loaded = UrlMapper.urlload(url, cachedir)
+            self.assert_('@@NewAlias' in loaded)
+            assertEquals(server.statuses, [200, 304, 200])
+
+            # Without a cache directory, the list is always transferred.
+            UrlMapper.urlload(url)
+            assertEquals(server.statuses, [200, 304, 200, 200])
+        finally:
+            server.shutdown()
+            server.server_close()
+            for fn in os.listdir(cachedir):
+                os.remove(join(cachedir, fn))
+            os.rmdir(cachedir)
+
+    def test_snapshot(self):
+        "Testing dumping and reloading a snapshot of the mapper."
+
+        mapper = UrlMapper(rootloc='/demo')
+        mapper, root = demoapp.create_application(mapper)
+        mapper.add_static('@@Fragment', 'http://furius.ca/(page)#top')
+
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            mapper.dump_snapshot(filename)
+            resources = [x.resource for x in mapper.itervalues()
+                         if x.resource is not None]
+            loaded_mapper = UrlMapper.load_snapshot(filename, root, resources)
+        finally:
+            os.remove(filename)
+
+        assertEquals(loaded_mapper.rootloc, '/demo')
+        assertEquals(loaded_mapper.render(), mapper.render())
+        for mapping in mapper.itervalues():
+            loaded = loaded_mapper[mapping.resid]
+            assertEquals(loaded.resource, mapping.resource)
+            assertEquals(loaded.alias_of, mapping.alias_of)
+        assertEquals(loaded_mapper.mapurl('@@OptionalParams', nbanimals=42),
+                     '/demo/wopts?nbanimals=00042')
+        assertEquals(loaded_mapper.mapurl('@@Fragment', 'faq'),
+                     'http://furius.ca/faq#top')
+        assertEquals(loaded_mapper.match('@@IntegerComponent',
+                                         '/demo/formatted/00001042'),
+                     {'uid': 1042})
+
+        # Invalid files.
+        assertRaises(RanvierError, UrlMapper.load_snapshot, filename)
+        assertRaises(RanvierError, UrlMapper.load_snapshot, __file__)
+
     def test_static(self):
         self._test_static(None)
         self._test_static('/root')
@@ -148,6 +242,177 @@ class TestMappings(testBaseCls):
 
 
 
+    def test_mapurl_many(self):
+        "Testing batched backmapping of URLs."
+
+        mapper = UrlMapper(rootloc='/demo')
+        demoapp.create_application(mapper)
+        reporter = SimpleReporter()
+        mapper.add_reporter(reporter)
+
+        # Rows of positional arguments, dicts and instances.
+        class Dummy: pass
+        o = Dummy()
+        o.username, o.userdata = 'rachel', 'school'
+        urls = mapper.mapurl_many('@@UserData',
+                                  [('martin', 'work'),
+                                   {'username': 'blais', 'userdata': 'home'},
+                                   o])
+        assertEquals(reporter.rendered_list, [])
+        assertEquals(list(urls), ['/demo/users/martin/data/work',
+                                  '/demo/users/blais/data/home',
+                                  '/demo/users/rachel/data/school'])
+        assertEquals(reporter.rendered_list, ['@@UserData'] * 3)
+
+        # Single scalar arguments, and common keyword arguments.
+        assertEquals(list(mapper.mapurl_many('@@PrintName', ['a', 'b'])),
+                     ['/demo/users/a/name', '/demo/users/b/name'])
+        assertEquals(list(mapper.mapurl_many('@@UserData', ['a', 'b'],
+                                             username='martin')),
+                     ['/demo/users/martin/data/a', '/demo/users/martin/data/b'])
+        assertEquals(list(mapper.mapurl_many('@@OptionalParams', [()] * 2,
+                                             cat='Miaouw')),
+                     ['/demo/wopts?cat=Miaouw'] * 2)
+        assertEquals(list(mapper.mapurl_many('@@Home', [])), [])
+
+        # Errors.
+        assertRaises(RanvierError, mapper.mapurl_many, '@@Nonexistent', [])
+        assertRaises(RanvierError, mapper.mapurl_many, '@@Home', [],
+                     symbol='lambda')
+        assertRaises(RanvierError, list,
+                     mapper.mapurl_many('@@UserData', [('martin',)]))
+        assertRaises(RanvierError, list,
+                     mapper.mapurl_many('@@UserData', ['martin']))
+        assertRaises(RanvierError, list,
+                     mapper.mapurl_many('@@UserData', [{'username': 'a'}]))
+
+
+    def test_cache(self):
+        "Testing the cache of backmapped URLs."
+
+        mapper = UrlMapper(rootloc='/demo', cache_size=2)
+        demoapp.create_application(mapper)
+        reporter = SimpleReporter()
+        mapper.add_reporter(reporter)
+        mapurl = mapper.mapurl
+        assertEquals(mapper.cache_info(), (0, 0, 2, 0))
+
+        assertEquals(mapurl('@@Home'), '/demo/home')
+        assertEquals(mapurl('@@Home'), '/demo/home')
+        assertEquals(mapurl('@@PrintName', 'martin'), '/demo/users/martin/name')
+        assertEquals(mapurl('@@PrintName', username='martin'),
+                     '/demo/users/martin/name')
+        assertEquals(mapper.cache_info(), (1, 3, 2, 2))
+
+        # The reporters are notified on hits as well.
+        assertEquals(reporter.rendered_list,
+                     ['@@Home', '@@Home', '@@PrintName', '@@PrintName'])
+
+        # The least recently used entry gets evicted.
+        assertEquals(mapurl('@@OptionalParams', cat='Miaouw'),
+                     '/demo/wopts?cat=Miaouw')
+        assertEquals(mapurl('@@PrintName', username='martin'),
+                     '/demo/users/martin/name')
+        assertEquals(mapurl('@@Home'), '/demo/home')
+        assertEquals(mapper.cache_info(), (2, 5, 2, 2))
+
+        # Containers and values that render differently are not cached.
+        assertEquals(mapurl('@@PrintName', {'username': 'martin'}),
+                     '/demo/users/martin/name')
+        assertEquals(mapurl('@@IntegerComponent', 1),
+                     '/demo/formatted/00000001')
+        assertEquals(mapurl('@@OptionalParams', cat=True),
+                     '/demo/wopts?cat=True')
+        assertEquals(mapper.cache_info(), (2, 6, 2, 2))
+
+        # Adding mappings invalidates the cache.
+        mapper.add_static('@@Static1', '/static')
+        assertEquals(mapper.cache_info(), (2, 6, 2, 0))
+        mapurl('@@Home')
+        mapper.add_alias('@@HomeAlias', '@@Home')
+        assertEquals(mapper.cache_info(), (2, 7, 2, 0))
+
+        # Errors are not cached.
+        assertRaises(RanvierError, mapurl, '@@Home', 'extraparam')
+        assertRaises(RanvierError, mapurl, '@@Home', 'extraparam')
+
+        mapper.set_cache_size(0)
+        assertEquals(mapper.cache_info(), None)
+        assertEquals(mapurl('@@Home'), '/demo/home')
+
+    def test_cache_threads(self):
+        "Testing the cache of backmapped URLs from several threads."
+
+        mapper = UrlMapper(rootloc='/demo', cache_size=4)
+        demoapp.create_application(mapper)
+
+        errors = []
+        def render():
+            try:
+                for i in xrange(2000):
+                    name = str(i % 50)
+                    url = mapper.mapurl('@@PrintName', name)
+                    assertEquals(url, '/demo/users/%s/name' % name)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=render) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assertEquals(errors, [])
+
+        hits, misses, maxsize, size = mapper.cache_info()
+        assertEquals(hits + misses, 4 * 2000)
+        assertEquals(size, 4)
+
+
+    def test_reporters(self):
+        "Testing switching the reporting hooks on and off."
+
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        mapper.inject_builtins('test_mapurl')
+        mapurl = mapper.mapurl
+        try:
+            # The functions bound before adding the reporters report too.
+            reporter = SimpleReporter()
+            mapper.add_reporter(reporter)
+            assertEquals(test_mapurl('@@Home'), '/home')
+            assertEquals(mapurl('@@PrintName', 'martin'),
+                         '/users/martin/name')
+            assertEquals(reporter.rendered_list, ['@@Home', '@@PrintName'])
+
+            mapper.remove_reporter(reporter)
+            assertEquals(test_mapurl('@@Home'), '/home')
+            assertEquals(len(reporter.rendered_list), 2)
+            assertRaises(RanvierError, mapper.remove_reporter, reporter)
+        finally:
+            import __builtin__
+            del __builtin__.test_mapurl
+
+    def test_enumerate(self):
+        "Testing enumerating the resource tree."
+
+        root = Folder(a=LeafResource(resid='@@A'),
+                      b=VarDelegatorResource(
+                          'x', Folder(c=LeafResource(resid='@@C')),
+                          resid='@@B'),
+                      resid='@@Root')
+        mapper = UrlMapper()
+        assertEquals(mapper.enumerate_resids(root), ['@@A', '@@C'])
+
+        # Deep trees do not hit the recursion limit.
+        depth = sys.getrecursionlimit() * 2
+        node = LeafResource(resid='@@Deep')
+        for i in xrange(depth):
+            node = Folder(sub=node)
+        mapper = UrlMapper(node)
+        assertEquals(mapper.mapurl('@@Deep'), '/sub' * depth)
+
+
+
 class TestConversions(testBaseCls):
     """
     Tests string/pattern conversions.
@@ -294,6 +559,67 @@ class TestConversions(testBaseCls):
         for resid, url, expected in tests:
             assertEquals(match(resid, url), expected)
 
+        # The regexps are compiled once, for a given root location.
+        mre = mapper.get_match_regexp('@@UserData')
+        self.assert_(mre is mapper.get_match_regexp('@@UserData'))
+        self.assert_(mre.search('<a href="/demo/users/rachel/data/school">'))
+        mapper.rootloc = '/other'
+        self.assert_(mre is not mapper.get_match_regexp('@@UserData'))
+        assertEquals(match('@@IntegerComponent', '/other/formatted/00001042'),
+                     {'uid': 1042})
+        assertEquals(match('@@IntegerComponent', '/demo/formatted/00001042'),
+                     None)
+
+    def test_match_any(self):
+        "Test finding the resource-ids of known URLs."
+
+        mapper = UrlMapper(rootloc='/demo')
+        root = demoapp.create_application(mapper)
+        match_any = mapper.match_any
+
+        tests = (
+            ('/demo/', '@@Root', {}),
+            ('/demo/altit', '@@ImSpecial', {}),
+            ('/demo/fold/', '@@DemoFolderWithMenu', {}),
+            ('/demo/fold/think', '@@SimpleThought', {}),
+            ('/demo/formatted/00001042', '@@IntegerComponent', {'uid': 1042}),
+            ('/demo/lcomp/bli', '@@LeafPlusOneComponent', {'comp': 'bli'}),
+            ('/demo/users/rachel/data/school', '@@UserData',
+             {'username': 'rachel', 'userdata': 'school'}),
+            ('http://furius.ca/demo/lcomp/bli?q=1', '@@LeafPlusOneComponent',
+             {'comp': 'bli'}),
+            ('/demo/rest/01/02/03', '@@RemainingComponents',
+             {'rest': '01/02/03'}),
+            ('/demo/style.css', '@@Stylesheet', {}),
+            ('/atocha/index.html', '@@Atocha', {}),
+            )
+        for url, resid, expected in tests:
+            assertEquals(match_any(url), (resid, expected))
+
+        for url in ('/demo/formatted/abc', '/demo/nonexistent',
+                    '/elsewhere/home'):
+            assertEquals(match_any(url), None)
+
+        # The matcher is rebuilt when mappings are added, and the original
+        # mapping has precedence over its aliases.
+        mapper.add_static('@@Elsewhere', '/elsewhere/(page)')
+        mapper.add_alias('@@AltAlias', '@@ImSpecial')
+        assertEquals(match_any('/elsewhere/home'),
+                     ('@@Elsewhere', {'page': 'home'}))
+        assertEquals(match_any('/demo/altit'), ('@@ImSpecial', {}))
+
+        # The external mappings only match the URLs of their own site.
+        mapper.add_static('@@Ext', 'http://furius.ca/(page)')
+        assertEquals(match_any('/favicon.ico'), None)
+        assertEquals(match_any('http://other.com/favicon.ico'), None)
+        assertEquals(match_any('http://furius.ca/favicon.ico'),
+                     ('@@Ext', {'page': 'favicon.ico'}))
+        assertEquals(match_any('http://furius.ca/demo/altit'),
+                     ('@@ImSpecial', {}))
+        assertEquals(match_any('http://paulgraham.com'),
+                     ('@@ExternalExample', {}))
+        assertEquals(match_any('/'), None)
+
 
     def test_optparam(self):
         "Test with optional parameters."
@@ -329,6 +655,1286 @@ class TestConversions(testBaseCls):
         assertEquals(mapurl('@@OptionalParams', dog='Wouf Wouf!'),
                      '/demo/wopts?dog=Wouf+Wouf%21')
 
+    def test_compiled_render(self):
+        "Test that the compiled renderers match the generic rendering."
+
+        for rootloc in (None, '/demo', '/100%'):
+            mapper = UrlMapper(rootloc=rootloc)
+            demoapp.create_application(mapper)
+            mapper.add_static('@@Fragment', 'http://furius.ca/(page)#top')
+            mapper.add_static('@@Trailing', '/docs/(page)/')
+
+            for mapping in mapper.itervalues():
+                posargs = {}
+                for comp in mapping.positional:
+                    if comp.format:
+                        posargs[comp.varname] = 42
+                    else:
+                        posargs[comp.varname] = 'value'
+
+                optargs_list = [None, {}, {'cat': None}]
+                if mapping.optparams:
+                    optargs_list.append({'cat': 'Miaouw', 'nbanimals': 42})
+
+                for optargs in optargs_list:
+                    expected = mapping._render(mapping.urltmpl, posargs,
+                                               optargs, rootloc)
+                    assertEquals(mapping.render(posargs, optargs, rootloc),
+                                 expected)
+
+            # A trailing slash is not doubled by a component value.
+            assertEquals(mapper.mapurl('@@Trailing', 'a/b/'), '/docs/a/b/')
+            assertEquals(mapper.mapurl('@@Trailing', 'a/b'), '/docs/a/b/')
+
+
+
+class TestRoutes(testBaseCls):
+    """
+    Tests resolving URIs to the mappings of the resource tree.
+    """
+    def test_compile_routes(self):
+        "Test compiling the routes that skip the plain resources."
+
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        routes = mapper.compile_routes_trie()
+
+        # The plain folders are skipped, down to the resources which handle the
+        # requests themselves.
+        steps, resource = routes.resolve([])[0]
+        assertEquals((steps, resource.getresid()), ([], '@@Root'))
+        steps, resource = routes.resolve(['fold', 'think'])[0]
+        assertEquals((steps, resource.getresid()), ([None, None],
+                                                    '@@SimpleThought'))
+        steps, resource = routes.resolve(['rest', 'a', 'b'])[0]
+        assertEquals((steps, resource.getresid()), ([None],
+                                                    '@@RemainingComponents'))
+
+        # UsernameRoot validates the username, so it is not skipped.
+        steps, resource = routes.resolve(['users', 'rachel', 'username'])[0]
+        assertEquals((steps, resource.getresid()), ([None], '@@UsernameRoot'))
+
+        # Static mappings and aliases are not routed.
+        assertEquals(routes.resolve(['style.css']), None)
+        mapper.add_alias('@@HomeAlias', '@@Home')
+        assertEquals(mapper.routes, None)
+        assertEquals(len(mapper.compile_routes_trie().resolve(['home'])[0][0]),
+                     1)
+
+        # The plain variable delegators are skipped too.
+        class ViewItem(LeafResource):
+            def handle_GET(self, ctxt):
+                ctxt.response.setContentType('text/plain')
+                ctxt.response.write(ctxt.item)
+
+        root = Folder(items=VarDelegatorResource(
+            'item', Folder(view=ViewItem(resid='@@ViewItem'))))
+        mapper = UrlMapper(root, compile_routes=True)
+        steps, resource = mapper.compile_routes_trie().resolve(
+            ['items', '42', 'view'])[0]
+        assertEquals((steps, resource.getresid()), ([None, 'item', None],
+                                                    '@@ViewItem'))
+
+        outfile = StringIO.StringIO()
+        ctxt = mapper.handle_request('GET', '/items/42/view', {},
+                                     CGIResponse(outfile))
+        self.assert_(mapper.routes is not None)
+        assertEquals(ctxt.item, '42')
+        assertEquals(outfile.getvalue(), 'Content-type: text/plain\n\n42')
+
+    def test_handle_routes(self):
+        "Test that the requests are handled the same with compiled routes."
+
+        uris = ('/fold', '/fold/', '/fold/think',
+                '/users/rachel/username', '/users/rachel/data/school',
+                '/users/nobody/username', '/formatted/00001042', '/rest/a/b',
+                '/wopts', '/internalredir', '/nonexistent', '/home/extra')
+
+        outputs = []
+        for compile_routes in (False, True):
+            mapper = UrlMapper(compile_routes=compile_routes)
+            demoapp.create_application(mapper)
+            page = demoapp.PageLayout(mapper)
+            for uri in uris:
+                outfile = StringIO.StringIO()
+                ctxt = mapper.handle_request('GET', uri, {},
+                                             CGIResponse(outfile), page=page)
+                outputs.append( (uri, ctxt.resid, outfile.getvalue()) )
+        assertEquals(outputs[:len(uris)], outputs[len(uris):])
+
+        # The reporters see all the resources, so they disable the routes.
+        tracer = []
+        mapper.add_reporter(TracerReporter(tracer.append))
+        mapper.handle_request('GET', '/users/rachel/username', {},
+                              CGIResponse(StringIO.StringIO()), page=page)
+        assertEquals(tracer, ['@@Root -> @@UsernameRoot -> '
+                              '@@Folder -> @@PrintUsername'])
+
+    def test_dispatch(self):
+        "Test dispatching to the handler methods by request method."
+
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        resource = demoapp.OptionalParams()
+        assertEquals(demoapp.OptionalParams._dispatch_table.keys(), ['GET'])
+        assertEquals(resource.get_allowed(), ['GET'])
+        assertEquals(resource.get_handler('GET'), resource.handle_GET)
+        self.assert_(resource.get_handler('DELETE') is None)
+
+        outfile = StringIO.StringIO()
+        mapper.handle_request('GET', '/wopts', {'cat': 'Felix'},
+                              CGIResponse(outfile),
+                              page=demoapp.PageLayout(mapper))
+        self.assert_('Cat: Felix' in outfile.getvalue())
+
+        # Unsupported methods are rejected.
+        outfile = StringIO.StringIO()
+        mapper.handle_request('DELETE', '/wopts', {}, CGIResponse(outfile))
+        self.assert_('Status: 405' in outfile.getvalue())
+        self.assert_('Allow: GET' in outfile.getvalue())
+
+        # The handlers which are not plain methods are honored.
+        class Handlers(LeafResource):
+            @classmethod
+            def handle_GET(cls, ctxt):
+                ctxt.response.write('class')
+            @staticmethod
+            def handle_PUT(ctxt):
+                ctxt.response.write('static')
+
+        res = Handlers()
+        res.handle_POST = lambda ctxt: ctxt.response.write('instance')
+        for method, expected in (('GET', 'class'), ('PUT', 'static'),
+                                 ('POST', 'instance')):
+            outfile = StringIO.StringIO()
+            UrlMapper(res).handle_request(method, '/', {}, CGIResponse(outfile))
+            self.assert_(outfile.getvalue().endswith(expected))
+
+        # The handlers of the class have precedence over those of the instance.
+        res.handle_GET = lambda ctxt: ctxt.response.write('override')
+        outfile = StringIO.StringIO()
+        UrlMapper(res).handle_request('DELETE', '/', {}, CGIResponse(outfile))
+        self.assert_('Allow: GET, POST, PUT' in outfile.getvalue())
+        outfile = StringIO.StringIO()
+        UrlMapper(res).handle_request('GET', '/', {}, CGIResponse(outfile))
+        self.assert_(outfile.getvalue().endswith('class'))
+
+        # Any handle_<method> name is a handler, as with getattr().
+        class AnyCase(LeafResource):
+            def handle_get(self, ctxt):
+                ctxt.response.write('lowercase')
+        outfile = StringIO.StringIO()
+        UrlMapper(AnyCase()).handle_request('get', '/', {},
+                                            CGIResponse(outfile))
+        self.assert_(outfile.getvalue().endswith('lowercase'))
+
+    def test_pool_contexts(self):
+        "Test reusing the contexts between requests."
+
+        mapper = UrlMapper(pool_contexts=True)
+        demoapp.create_application(mapper)
+        page = demoapp.PageLayout(mapper)
+
+        ctxt1 = mapper.handle_request('GET', '/users/rachel/username', {},
+                                      CGIResponse(StringIO.StringIO()),
+                                      page=page)
+        assertEquals(ctxt1.username, 'rachel')
+        assertEquals(ctxt1.resid, '@@PrintUsername')
+
+        # The same context is reset for the next request.
+        ctxt2 = mapper.handle_request('GET', '/wopts', {},
+                                      CGIResponse(StringIO.StringIO()),
+                                      page=page)
+        self.assert_(ctxt2 is ctxt1)
+        self.assert_(not hasattr(ctxt2, 'username'))
+        assertEquals(ctxt2.resid, '@@OptionalParams')
+        assertEquals(ctxt2.locator.path, ['wopts'])
+
+        # The context of a redirected request is released, and the one handed
+        # back is valid until the next request.
+        outfile = StringIO.StringIO()
+        ctxt = mapper.handle_request('GET', '/internalredir', {},
+                                     CGIResponse(outfile), page=page)
+        assertEquals(ctxt.resid, '@@PrintUsername')
+        assertEquals(ctxt.username, 'martin')
+        self.assert_(ctxt.response is not None)
+        self.assert_(ctxt.deferred is None)
+
+        # Contexts in use are not shared.
+        pool = mapper.ctxtpool
+        ctxt3 = pool.acquire(HandlerContext, 'GET', '/', {})
+        self.assert_(ctxt3 is ctxt1)
+        self.assert_(pool.acquire(HandlerContext, 'GET', '/', {}) is not ctxt3)
+
+        # The released contexts do not keep the objects of their request.
+        ctxt3.username = 'rachel'
+        pool.release(ctxt3)
+        self.assert_(ctxt3.response is None and ctxt3.args is None)
+        self.assert_(not hasattr(ctxt3, 'username'))
+        self.assert_(not hasattr(ctxt3, 'resid'))
+
+        # Each thread has its own pool.
+        contexts = []
+        thread = threading.Thread(target=lambda: contexts.append(
+            pool.acquire(HandlerContext, 'GET', '/', {})))
+        thread.start()
+        thread.join()
+        self.assert_(contexts[0] is not ctxt1)
+
+
+
+class TestCoverage(testBaseCls):
+    """
+    Tests for the coverage reporters.
+    """
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        for fn in os.listdir(self.tmpdir):
+            os.remove(join(self.tmpdir, fn))
+        os.rmdir(self.tmpdir)
+
+    def handle_requests(self, mapper, uris):
+        page = demoapp.PageLayout(mapper)
+        for uri in uris:
+            mapper.handle_request('GET', uri, {},
+                                  CGIResponse(StringIO.StringIO()), page=page)
+
+    def test_buffered(self):
+        "Test writing the coverage counts in batches."
+
+        backend = DbmCoverageReporter(join(self.tmpdir, 'coverage'))
+        reporter = BufferedCoverageReporter(backend, max_requests=3,
+                                            interval=3600)
+        self.addCleanup(reporter.close)
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        mapper.add_reporter(reporter)
+
+        # The counts accumulate in memory.
+        self.handle_requests(mapper, ['/users/martin/name',
+                                      '/users/martin/name'])
+        assertEquals(backend.get_coverage(), {})
+        assertEquals(reporter.pending['@@PrintName'], (2, 0))
+        assertEquals(reporter.pending['@@Home'], (0, 2))
+
+        # They are written by the background thread when the threshold is
+        # reached.
+        self.handle_requests(mapper, ['/users/rachel/username'])
+        for i in xrange(100):
+            if not reporter.pending:
+                break
+            time.sleep(0.01)
+        assertEquals(reporter.pending, {})
+        coverage = backend.get_coverage()
+        assertEquals(coverage['@@PrintName'], (2, 0))
+        assertEquals(coverage['@@PrintUsername'], (1, 0))
+        assertEquals(coverage['@@Home'], (0, 3))
+
+        # Reading the coverage includes the pending counts.
+        self.handle_requests(mapper, ['/users/martin/name'])
+        assertEquals(reporter.get_coverage()['@@PrintName'], (3, 0))
+
+        # Resetting discards the pending counts.
+        self.handle_requests(mapper, ['/users/martin/name'])
+        reporter.reset()
+        assertEquals(reporter.pending, {})
+
+        # Closing writes the pending counts.
+        self.handle_requests(mapper, ['/users/rachel/username'])
+        reporter.close()
+        self.assert_(not reporter.thread.isAlive())
+        assertEquals(backend.get_coverage()['@@PrintUsername'][0],
+                     coverage['@@PrintUsername'][0] + 1)
+        backend.dbm.close()
+
+    def test_sql(self):
+        "Test the SQL coverage reporter, with SQLite."
+
+        dbfn = join(self.tmpdir, 'coverage.db')
+        reporter = create_coverage_reporter('sqlite://%s' % dbfn)
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        mapper.add_reporter(reporter)
+
+        self.handle_requests(mapper, ['/users/martin/name',
+                                      '/users/martin/name'])
+        coverage = reporter.get_coverage()
+        assertEquals(coverage['@@PrintName'], (2, 0))
+        assertEquals(coverage['@@Home'], (0, 2))
+
+        # The table is not created again.
+        reporter = create_coverage_reporter('sqlite://%s' % dbfn)
+        assertEquals(reporter.get_coverage(), coverage)
+
+        # Writing in batches.
+        reporter.flush_interval = 3600
+        mapper.remove_reporter(mapper.reporters[0])
+        mapper.add_reporter(reporter)
+        self.handle_requests(mapper, ['/users/martin/name'])
+        assertEquals(reporter.pending['@@PrintName'], (1, 0))
+        self.assert_(reporter.flush_at_exit)
+        assertEquals(reporter.get_coverage()['@@PrintName'], (3, 0))
+        assertEquals(reporter.pending, {})
+
+        # The parameters are passed by name for the named styles.
+        import sqlite3
+        class NamedDbModule(object):
+            paramstyle = 'named'
+        conn = sqlite3.connect(dbfn)
+        named = SqlCoverageReporter(NamedDbModule(), lambda: conn,
+                                    lambda conn: None)
+        self.assert_(':resid' in named.upsert)
+        named.add_counts({'@@PrintName': (1, 0)})
+        assertEquals(named.get_coverage()['@@PrintName'], (4, 0))
+        conn.close()
+
+        reporter.reset()
+        assertEquals(reporter.get_coverage(), {})
+
+    def test_mmap(self):
+        "Test the shared-memory coverage reporter."
+
+        fn = join(self.tmpdir, 'coverage')
+        mapper = UrlMapper()
+        reporter = MmapCoverageReporter(fn, mapper)
+        demoapp.create_application(mapper)
+        mapper.add_reporter(reporter)
+
+        # Handle requests from another process as well.
+        self.handle_requests(mapper, ['/users/martin/name'])
+        pid = os.fork()
+        if pid == 0:
+            try:
+                self.handle_requests(mapper, ['/users/martin/name',
+                                              '/users/martin/username'])
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        # Read the counts from a separate reporter.
+        reader = create_coverage_reporter('mmap://%s' % fn)
+        coverage = reader.get_coverage()
+        self.assert_(not reader.writable)
+        assertEquals(coverage['@@PrintName'], (2, 0))
+        assertEquals(coverage['@@PrintUsername'], (1, 0))
+        assertEquals(coverage['@@Home'], (0, 3))
+        assertEquals(reporter.get_coverage(), coverage)
+
+        # The threads of a process do not lose updates.
+        def add():
+            for i in xrange(1000):
+                reporter.add_counts({'@@PrintUsername': (1, 0)})
+        threads = [threading.Thread(target=add) for i in xrange(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assertEquals(reporter.get_coverage()['@@PrintUsername'], (4001, 0))
+
+        # The file must match the mapper.
+        mapper.add_static('@@NewStatic', '/new')
+        assertRaises(RanvierError, MmapCoverageReporter(fn, mapper).open)
+        other = join(self.tmpdir, 'other')
+        assertRaises(RanvierError, MmapCoverageReporter(other).open)
+
+        # A server can create the file from a connection string.
+        creator = create_coverage_reporter('mmap://%s' % other, mapper)
+        creator.add_counts({'@@Home': (1, 2)})
+        assertEquals(MmapCoverageReporter(other).get_coverage(),
+                     {'@@Home': (1, 2)})
+        creator.close()
+
+        reader.reset()
+        self.assert_(reader.writable)
+        assertEquals(reporter.get_coverage(), {})
+        reporter.close()
+        reader.close()
+
+    def test_sampling(self):
+        "Test sampling the requests for the reporters."
+
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        traces = []
+        mapper.add_reporter(SamplingReporter(TracerReporter(traces.append), 3))
+        reporter = SamplingReporter(
+            MmapCoverageReporter(join(self.tmpdir, 'coverage'), mapper), 3)
+        mapper.add_reporter(reporter)
+
+        # The requests are sampled by their path, the same paths every time.
+        uris = ['/rest/%d' % x for x in xrange(300)]
+        sampled = []
+        for uri in uris * 2:
+            ntraces = len(traces)
+            self.handle_requests(mapper, [uri])
+            if len(traces) > ntraces:
+                sampled.append(uri)
+        nsampled = len(sampled) // 2
+        self.assert_(70 < nsampled < 130)
+        assertEquals(sampled[:nsampled], sampled[nsampled:])
+
+        # The counts of the sampled requests are scaled.
+        coverage = reporter.get_coverage()
+        assertEquals(coverage['@@RemainingComponents'], (2 * nsampled * 3, 0))
+        assertEquals(coverage['@@Home'], (0, 2 * nsampled * 3))
+        self.assert_('@@PrintName' not in coverage)
+        reporter.close()
+
+        # The interleaved requests are sampled independently.
+        traces = []
+        reporter = SamplingReporter(TracerReporter(traces.append), 3)
+        contexts = [ranvier.context.HandlerContext('GET', uri, {})
+                    for uri in uris[:20]]
+        ctxt1 = [x for x in contexts if reporter.sample(x)][0]
+        ctxt2 = [x for x in contexts if not reporter.sample(x)][0]
+        reporter.register_entered('@@Root', ctxt1)
+        reporter.register_entered('@@Root', ctxt2)
+        reporter.register_entered('@@Other', ctxt2)
+        reporter.register_entered('@@Leaf', ctxt1)
+        reporter.register_returned('@@Leaf', ctxt1)
+        reporter.register_returned('@@Other', ctxt2)
+        reporter.register_returned('@@Root', ctxt2)
+        assertEquals(traces, [])
+        reporter.register_returned('@@Root', ctxt1)
+        assertEquals(traces, ['@@Root -> @@Leaf'])
+        assertEquals(reporter.requests, {})
+
+        # Random sampling.
+        traces = []
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        mapper.add_reporter(SamplingReporter(TracerReporter(traces.append), 2,
+                                             randomize=True))
+        self.handle_requests(mapper, ['/users/martin/name'] * 1000)
+        self.assert_(400 < len(traces) < 600)
+
+    def test_latency(self):
+        "Test measuring the latencies of the resources."
+
+        # Use a clock that advances by a millisecond on every reading.
+        ticks = iter(xrange(1000000)).next
+        clock = lambda: ticks() * 0.001
+
+        mapper = UrlMapper()
+        demoapp.create_application(mapper)
+        reporter = LatencyReporter(clock, clock)
+        mapper.add_reporter(reporter)
+        self.handle_requests(mapper, ['/users/martin/name'] * 10)
+
+        latencies = reporter.get_latencies()
+        leaf = latencies['@@PrintName']
+        assertEquals(leaf['wall'][0], 10)
+        assertEquals(leaf['wall'], leaf['wall_excl'])
+        assertEquals(leaf['cpu'], leaf['cpu_excl'])
+
+        # The exclusive times of the chain add up to the inclusive time of its
+        # first resource, which is larger than that of all the others.
+        root = max(latencies, key=lambda x: latencies[x]['wall'][1])
+        total = sum(x['wall_excl'][1] for x in latencies.itervalues())
+        self.assertAlmostEqual(latencies[root]['wall'][1], total)
+        for resid, measures in latencies.iteritems():
+            self.assert_(measures['wall_excl'][1] <= measures['wall'][1])
+
+        # The report pages.
+        mapper = UrlMapper()
+        root = Folder(report=ReportLatency(reporter.get_latencies),
+                      dump=DumpLatency(reporter.get_latencies))
+        mapper.initialize(root)
+        oss = StringIO.StringIO()
+        mapper.handle_request('GET', '/report', {}, CGIResponse(oss))
+        self.assert_('<td class="lat-resid">@@PrintName</td>' in oss.getvalue())
+        oss = StringIO.StringIO()
+        mapper.handle_request('GET', '/dump', {}, CGIResponse(oss))
+        lines = [x for x in oss.getvalue().splitlines()
+                 if x.startswith('@@PrintName wall ')]
+        assertEquals(len(lines), 1)
+        assertEquals(lines[0].split()[2], '10')
+
+        reporter.reset()
+        assertEquals(reporter.get_latencies(), {})
+
+    def test_callgraph_log(self):
+        "Test the binary call graph log."
+
+        filename = join(self.tmpdir, 'callgraph')
+        for flush_interval in (None, 3600):
+            mapper = UrlMapper()
+            demoapp.create_application(mapper)
+            reporter = LogCallGraphReporter(filename, flush_interval)
+            mapper.add_reporter(reporter)
+            self.handle_requests(mapper, ['/users/martin/name'] * 3 +
+                                 ['/users/martin/username'])
+            reporter.close()
+
+        edges = read_callgraph_log(filename)
+        assertEquals(edges[('@@PrintName', '@@Home')], 6)
+        assertEquals(edges[('@@PrintUsername', '@@Home')], 2)
+
+        # An incomplete record at the end is ignored.
+        size = os.path.getsize(filename)
+        f = open(filename, 'ab')
+        f.write(callgraph_pack_record({('@@A', '@@B'): 1})[:-1])
+        f.close()
+        assertEquals(read_callgraph_log(filename), edges)
+        self.assert_(os.path.getsize(filename) > size)
+
+        # The unicode resource-ids are encoded in UTF-8.
+        ufilename = join(self.tmpdir, 'callgraph-unicode')
+        reporter = LogCallGraphReporter(ufilename, None)
+        reporter.publish_relation(u'@@Caf\xe9', '@@Home')
+        reporter.publish_relation('@@Home', u'@@Home')
+        reporter.close()
+        assertEquals(read_callgraph_log(ufilename),
+                     {('@@Caf\xc3\xa9', '@@Home'): 1, ('@@Home', '@@Home'): 1})
+
+        dot = callgraph_render_dot(edges, min_count=3)
+        self.assert_('"@@PrintName" -> "@@Home" [label="6"' in dot)
+        self.assert_('@@PrintUsername' not in dot)
+
+        # The quotes and backslashes of the resource-ids are escaped.
+        dot = callgraph_render_dot({('@@Say"Hi"', '@@Back\\slash'): 1})
+        self.assert_('"@@Say\\"Hi\\"" -> "@@Back\\\\slash"' in dot)
+
+    def test_histogram(self):
+        "Test the quantiles of the latency histograms."
+
+        from ranvier.reporters.latency import Histogram
+        hist = Histogram()
+        assertEquals(hist.quantile(0.5), 0.0)
+        for i in xrange(90):
+            hist.add(0.0015)
+        for i in xrange(10):
+            hist.add(0.3)
+        assertEquals(hist.quantile(0.5), 0.002)
+        assertEquals(hist.quantile(0.95), 0.3)
+        hist.add(60.0)
+        assertEquals(hist.quantile(1.0), 60.0)
+
+
+
+try:
+    from twisted.internet import defer
+except ImportError:
+    defer = None
+
+class AsyncAugmenter(DelegatorResource):
+    "A delegator that completes asynchronously and records its post-handling."
+    def __init__(self, next_resource, deferreds, log, **kwds):
+        DelegatorResource.__init__(self, next_resource, **kwds)
+        self.deferreds = deferreds
+        self.log = log
+
+    def handle(self, ctxt):
+        d = defer.Deferred()
+        self.deferreds.append(d)
+        return d
+
+    def post_handle(self, ctxt):
+        self.log.append('post_handle')
+
+class AsyncLeaf(LeafResource):
+    "A leaf that writes its output asynchronously."
+    def __init__(self, deferreds, text, **kwds):
+        LeafResource.__init__(self, **kwds)
+        self.deferreds = deferreds
+        self.text = text
+
+    def handle(self, ctxt):
+        d = defer.Deferred()
+        d.addCallback(lambda x: ctxt.response.write(self.text))
+        self.deferreds.append(d)
+        return d
+
+class AsyncRedirect(LeafResource):
+    "A leaf that redirects internally after a while."
+    def handle(self, ctxt):
+        return defer.fail(InternalRedirect('/other'))
+
+class LogReporter(ResourceReporter):
+    "A reporter that records the notifications it receives."
+    def __init__(self, log):
+        self.log = log
+
+    def register_handled(self, resid):
+        self.log.append(('handled', resid))
+
+    def register_returned(self, resid, ctxt):
+        self.log.append(('returned', resid))
+
+    def register_rendered(self, resid):
+        pass
+
+    def end(self):
+        self.log.append('end')
+
+class TestAsync(testBaseCls):
+    """
+    Tests for the handlers that complete asynchronously.
+    """
+    def setUp(self):
+        if defer is None:
+            self.skipTest("Twisted is not installed.")
+
+        self.deferreds, self.log = [], []
+        root = Folder(
+            slow=AsyncAugmenter(AsyncLeaf(self.deferreds, 'Done.',
+                                          resid='@@Leaf'),
+                                self.deferreds, self.log, resid='@@Slow'),
+            redir=AsyncRedirect(),
+            other=AsyncLeaf(self.deferreds, 'Other.', resid='@@Other'))
+        self.mapper = UrlMapper(root)
+        self.mapper.add_reporter(LogReporter(self.log))
+
+    def test_deferred(self):
+        "Test delegating across asynchronous handlers."
+
+        oss = StringIO.StringIO()
+        ctxt = self.mapper.handle_request('GET', '/slow', {}, CGIResponse(oss))
+        self.assert_(ctxt.deferred is not None)
+        assertEquals(len(self.deferreds), 1)
+        assertEquals(self.log, [('handled', '@@Folder'), ('handled', '@@Slow')])
+
+        # The delegator forwards when its handler completes.
+        self.deferreds.pop(0).callback(None)
+        assertEquals(len(self.deferreds), 1)
+        assertEquals(oss.getvalue(), '')
+
+        # The post-handling and the reporters complete with the leaf.
+        results = []
+        ctxt.deferred.addCallback(results.append)
+        self.deferreds.pop(0).callback(None)
+        self.assert_(oss.getvalue().endswith('Done.'))
+        assertEquals(results, [None])
+        assertEquals(self.log[2:], [('handled', '@@Leaf'),
+                                    ('returned', '@@Leaf'),
+                                    'post_handle',
+                                    ('returned', '@@Slow'),
+                                    ('returned', '@@Folder'),
+                                    'end'])
+
+        # Synchronous handlers do not return a Deferred.
+        ctxt = self.mapper.handle_request('GET', '/nothere', {},
+                                          CGIResponse(StringIO.StringIO()))
+        self.assert_(ctxt.deferred is None)
+
+    def test_folder(self):
+        "Test folders and variable delegators with asynchronous handlers."
+
+        deferreds = self.deferreds
+        class AsyncFolder(Folder):
+            def handle(self, ctxt):
+                d = defer.Deferred()
+                deferreds.append(d)
+                return d
+
+        class AsyncVar(VarDelegatorResource):
+            def handle(self, ctxt):
+                d = defer.Deferred()
+                deferreds.append(d)
+                return d
+
+        mapper = UrlMapper(AsyncFolder(
+            leaf=AsyncLeaf(deferreds, 'Leaf.', resid='@@FolderLeaf'),
+            var=AsyncVar('name', AsyncLeaf(deferreds, 'Var.',
+                                           resid='@@VarLeaf')),
+            default=Folder(_default=AsyncLeaf(deferreds, 'Default.',
+                                              resid='@@DefaultLeaf'))))
+        for uri, ncalls, expected in (('/leaf', 2, 'Leaf.'),
+                                      ('/var/joe', 3, 'Var.'),
+                                      ('/default/', 2, 'Default.')):
+            oss = StringIO.StringIO()
+            ctxt = mapper.handle_request('GET', uri, {}, CGIResponse(oss))
+            self.assert_(ctxt.deferred is not None)
+            done = []
+            ctxt.deferred.addCallback(done.append)
+            for i in xrange(ncalls):
+                assertEquals(done, [])
+                self.deferreds.pop(0).callback(None)
+            assertEquals(len(done), 1)
+            assertEquals(self.deferreds, [])
+            self.assert_(oss.getvalue().endswith(expected))
+            if uri.startswith('/var/'):
+                assertEquals(ctxt.name, 'joe')
+
+    def test_latency(self):
+        "Test measuring the latencies of interleaved asynchronous requests."
+
+        reporter = LatencyReporter()
+        self.mapper.add_reporter(reporter)
+        ctxt1 = self.mapper.handle_request('GET', '/slow', {},
+                                           CGIResponse(StringIO.StringIO()))
+        ctxt2 = self.mapper.handle_request('GET', '/slow', {},
+                                           CGIResponse(StringIO.StringIO()))
+        done = []
+        ctxt1.deferred.addCallback(lambda x: done.append(1))
+        ctxt2.deferred.addCallback(lambda x: done.append(2))
+
+        # Complete the second request first, in steps.
+        first, second = self.deferreds.pop(0), self.deferreds.pop(0)
+        second.callback(None)
+        first.callback(None)
+        second, first = self.deferreds.pop(0), self.deferreds.pop(0)
+        second.callback(None)
+        first.callback(None)
+        assertEquals(done, [2, 1])
+
+        latencies = reporter.get_latencies()
+        for resid in ('@@Folder', '@@Slow', '@@Leaf'):
+            assertEquals(latencies[resid]['wall'][0], 2)
+        assertEquals(reporter.stacks, {})
+
+        # The notifications of unknown requests are ignored.
+        reporter.register_returned('@@Leaf', ctxt1)
+        assertEquals(latencies, reporter.get_latencies())
+
+    def test_redirect(self):
+        "Test internal redirects raised asynchronously."
+
+        oss = StringIO.StringIO()
+        ctxt = self.mapper.handle_request('GET', '/redir', {}, CGIResponse(oss))
+        assertEquals(self.log.count('end'), 1)
+        self.assert_(('handled', '@@Other') in self.log)
+
+        failures = []
+        ctxt.deferred.addErrback(failures.append)
+        self.deferreds.pop(0).callback(None)
+        assertEquals(failures, [])
+        self.assert_(oss.getvalue().endswith('Other.'))
+        assertEquals(self.log.count('end'), 2)
+
+    def test_dispatch(self):
+        "Test the Twisted.Web dispatch resource with asynchronous handlers."
+
+        from twisted.web.test.requesthelper import DummyRequest
+        from twisted.web import server
+        from ranvier.twistwebproxy import DispatchResource
+
+        for streaming in (False, True):
+            request = DummyRequest(['slow'])
+            request.path, request.code = '/slow', 200
+            request.received_headers, request.headers = {}, {}
+            resource = DispatchResource(None, self.mapper,
+                                        tempfile.gettempdir(),
+                                        streaming=streaming)
+            assertEquals(resource.render(request), server.NOT_DONE_YET)
+            self.deferreds.pop(0).callback(None)
+            assertEquals(request.finished, 0)
+            self.deferreds.pop(0).callback(None)
+            assertEquals(''.join(request.written), 'Done.')
+            assertEquals(request.finished, 1)
+
+    def test_static(self):
+        "Test sending static files with Twisted.Web producers."
+
+        from twisted.web.test.requesthelper import DummyRequest
+        from twisted.web import server
+        from ranvier.twistwebproxy import DispatchResource
+
+        mapper = UrlMapper(Folder(static=StaticFiles(dirname(__file__))))
+        contents = open(__file__, 'rb').read()
+        for rng, expected in ((None, contents),
+                              ('bytes=5-9', contents[5:10])):
+            request = DummyRequest(['static', basename(__file__)])
+            request.path = '/static/%s' % basename(__file__)
+            request.code, request.headers = 200, {}
+            request.received_headers = {'range': rng} if rng else {}
+            resource = DispatchResource(None, mapper, None)
+            assertEquals(resource.render(request), server.NOT_DONE_YET)
+            assertEquals(''.join(request.written), expected)
+            assertEquals(request.finished, 1)
+
+        # The file is closed if the handler fails after sending it.
+        files = []
+        class Failing(LeafResource):
+            def handle(self, ctxt):
+                files.append(open(__file__, 'rb'))
+                ctxt.response.sendFile(files[-1])
+                raise ValueError
+        request = DummyRequest([''])
+        request.path, request.code, request.headers = '/', 200, {}
+        request.received_headers = {}
+        resource = DispatchResource(None, UrlMapper(Failing()), None)
+        assertRaises(ValueError, resource.render, request)
+        self.assert_(files[0].closed)
+
+    def test_streaming(self):
+        "Test streaming the responses to Twisted.Web."
+
+        from twisted.web.test.requesthelper import DummyRequest
+        from twisted.web import server
+        from ranvier.twistwebproxy import (DispatchResource,
+                                           TwistedWebResponseProxy)
+
+        # The beginning of the text is buffered, so that headers can be set.
+        request = DummyRequest([''])
+        request.headers = {}
+        response = TwistedWebResponseProxy(request, streaming=True)
+        response.write('Small.')
+        response.addHeader('X-Late', 'yes')
+        assertEquals(request.written, [])
+        assertEquals(request.responseHeaders.getRawHeaders('X-Late'), ['yes'])
+
+        text = 'x' * response.stream_threshold
+        response.write(text)
+        assertEquals(''.join(request.written), 'Small.' + text)
+        assertRaises(RanvierError, response.addHeader, 'X-Later', 'no')
+        assertRaises(RanvierError, response.bufferOutput)
+        response.write('More.')
+        assertEquals(request.written[-1], 'More.')
+
+        # The large responses are streamed, the small ones are buffered.
+        class Chunks(LeafResource):
+            def __init__(self, chunks, **kwds):
+                LeafResource.__init__(self, **kwds)
+                self.chunks = chunks
+            def handle(self, ctxt):
+                for chunk in self.chunks:
+                    ctxt.response.write(chunk)
+
+        mapper = UrlMapper(Folder(
+            big=Chunks([text, 'Done.'], resid='@@Big'),
+            small=Chunks(['Small.', 'Done.'], resid='@@Small')))
+        resource = DispatchResource(None, mapper, None, streaming=True)
+        for name, expected in (('big', server.NOT_DONE_YET),
+                               ('small', 'Small.Done.')):
+            request = DummyRequest([name])
+            request.path, request.code = '/' + name, 200
+            request.received_headers, request.headers = {}, {}
+            assertEquals(resource.render(request), expected)
+            if name == 'big':
+                assertEquals(request.written, [text, 'Done.'])
+                assertEquals(request.finished, 1)
+
+    def test_sendfile(self):
+        "Test sending files with the Twisted.Web response proxy."
+
+        from twisted.web.test.requesthelper import DummyRequest
+        from twisted.web import static
+        from ranvier.twistwebproxy import TwistedWebResponseProxy
+
+        contents = open(__file__, 'rb').read()
+        request = DummyRequest([''])
+        response = TwistedWebResponseProxy(request)
+        response.sendFile(open(__file__, 'rb'))
+        self.assert_(isinstance(response.producer,
+                                static.NoRangeStaticProducer))
+        response.producer.start()
+        assertEquals(''.join(request.written), contents)
+
+        f = open(__file__, 'rb')
+        f.seek(5)
+        response = TwistedWebResponseProxy(DummyRequest(['']))
+        response.sendFile(f, length=5)
+        self.assert_(isinstance(response.producer,
+                                static.SingleRangeStaticProducer))
+
+        # The files are copied after some text.
+        response = TwistedWebResponseProxy(DummyRequest(['']))
+        response.write('Text.')
+        response.sendFile(open(__file__, 'rb'))
+        self.assert_(response.producer is None)
+        assertEquals(response.value(), 'Text.' + contents)
+
+    def test_failed(self):
+        "Test the Twisted.Web requests whose handlers fail asynchronously."
+
+        from twisted.web.test.requesthelper import DummyRequest
+        from twisted.web import server, http
+        from ranvier.twistwebproxy import DispatchResource
+
+        class AsyncFailure(LeafResource):
+            def handle(self, ctxt):
+                return defer.fail(ValueError("Failed."))
+
+        class AsyncRedirectOut(LeafResource):
+            def handle(self, ctxt):
+                return defer.maybeDeferred(ctxt.response.redirect, '/there')
+
+        mapper = UrlMapper(Folder(fail=AsyncFailure(),
+                                  redir=AsyncRedirectOut()))
+        resource = DispatchResource(None, mapper, None)
+        for name in ('fail', 'redir'):
+            request = DummyRequest([name])
+            request.path, request.code = '/' + name, 200
+            request.received_headers, request.headers = {}, {}
+            failures = []
+            request.notifyFinish().addErrback(failures.append)
+            assertEquals(resource.render(request), server.NOT_DONE_YET)
+            if name == 'fail':
+                assertEquals(len(failures), 1)
+                self.assert_(failures[0].check(ValueError))
+            else:
+                assertEquals(failures, [])
+                assertEquals(request.responseCode, http.FOUND)
+                assertEquals(request.finished, 1)
+
+class FileResource(LeafResource):
+    "A resource that sends this file."
+    def handle(self, ctxt):
+        ctxt.response.setContentType('text/x-python')
+        ctxt.response.sendFile(open(__file__, 'rb'), 1024)
+
+class BlockingInput(object):
+    "An input stream that fails if it is read, as if it blocked."
+    def read(self, *args):
+        raise AssertionError("The input was read.")
+    readline = readlines = __iter__ = read
+
+
+class TestWSGI(testBaseCls):
+    """
+    Tests for the WSGI adapter.
+    """
+    def setUp(self):
+        mapper = UrlMapper(rootloc='/demo')
+        mapper, root = demoapp.create_application(mapper)
+        self.app = WSGIApplication(mapper, page=demoapp.PageLayout(mapper))
+
+    def request(self, path, query='', app=None, **environ):
+        """
+        Handle a request with the application, checking that it conforms to
+        WSGI, and return the status line, the dict of headers and the body.
+        """
+        app = app or self.app
+        environ.update(SCRIPT_NAME='', PATH_INFO=path, QUERY_STRING=query)
+        wsgiref.util.setup_testing_defaults(environ)
+        status = []
+        def start_response(s, headers):
+            status[:] = [s, dict(headers)]
+            return lambda x: None
+
+        body = wsgiref.validate.validator(app)(dict(environ), start_response)
+        list(body)
+        body.close()
+
+        if hasattr(environ['wsgi.input'], 'seek'):
+            environ['wsgi.input'].seek(0)
+        body = app(environ, start_response)
+        return status[0], status[1], body
+
+    def test_wsgi(self):
+        "Test handling requests through the WSGI application."
+
+        status, headers, body = self.request('/demo/users/martin/name')
+        assertEquals(status, '200 OK')
+        assertEquals(headers['Content-type'], 'text/html')
+        self.assert_(not isinstance(body, list))
+        chunks = list(body)
+        self.assert_(len(chunks) > 1)
+        self.assert_('Mr or Mrs Martin' in ''.join(chunks))
+        assertEquals(int(headers['Content-Length']), len(''.join(chunks)))
+
+        status, headers, body = self.request('/demo/wopts', 'cat=Miaouw')
+        self.assert_('Miaouw' in ''.join(body))
+
+        # The body is only read if its length is known.
+        class Form(LeafResource):
+            def handle_POST(self, ctxt):
+                ctxt.response.write(ctxt.args['cat'])
+        app = WSGIApplication(UrlMapper(Form()))
+        status, headers, body = self.request(
+            '/', app=app, REQUEST_METHOD='POST', CONTENT_LENGTH='9',
+            CONTENT_TYPE='application/x-www-form-urlencoded',
+            **{'wsgi.input': StringIO.StringIO('cat=Felix')})
+        assertEquals(list(body), ['Felix'])
+        status, headers, body = self.request(
+            '/', 'cat=Miaouw', app=app, REQUEST_METHOD='POST',
+            **{'wsgi.input': BlockingInput()})
+        assertEquals(list(body), ['Miaouw'])
+
+        # The command-line arguments are not taken as the query string.
+        class Args(LeafResource):
+            def handle(self, ctxt):
+                ctxt.response.write(repr(sorted(ctxt.args)))
+        environ = {'PATH_INFO': '/'}
+        wsgiref.util.setup_testing_defaults(environ)
+        environ.pop('QUERY_STRING', None)
+        argv = sys.argv
+        sys.argv = ['server', 'cat=Server']
+        try:
+            body = WSGIApplication(UrlMapper(Args()))(environ,
+                                                      lambda s, h: None)
+        finally:
+            sys.argv = argv
+        assertEquals(list(body), ['[]'])
+
+        status, headers, body = self.request('/demo/nothere')
+        assertEquals(status, '404 Not Found')
+        status, headers, body = self.request('/elsewhere')
+        assertEquals(status, '404 Not Found')
+
+        status, headers, body = self.request('/demo/redirtest')
+        assertEquals(status, '302 Found')
+        assertEquals(headers['Location'], '/demo/home')
+
+    def test_sendfile(self):
+        "Test sending files through the WSGI application."
+
+        app = WSGIApplication(UrlMapper(Folder(file=FileResource())))
+        contents = open(__file__, 'rb').read()
+
+        status, headers, body = self.request(
+            '/file', app=app,
+            **{'wsgi.file_wrapper': wsgiref.util.FileWrapper})
+        assertEquals(status, '200 OK')
+        self.assert_(isinstance(body, wsgiref.util.FileWrapper))
+        assertEquals(headers['Content-Length'], str(len(contents)))
+        assertEquals(''.join(body), contents)
+
+        # Without a file wrapper, the file is read in chunks as the body is
+        # iterated, and closed at the end.
+        status, headers, body = self.request('/file', app=app)
+        assertEquals(headers['Content-Length'], str(len(contents)))
+        chunks = list(body)
+        assertEquals(''.join(chunks), contents)
+        self.assert_(len(chunks) > 1)
+        body.close()
+
+        # The files are closed even if the body is not iterated.
+        files = []
+        class Opener(LeafResource):
+            def handle(self, ctxt):
+                files.append(open(__file__, 'rb'))
+                ctxt.response.sendFile(files[-1], 1024)
+                if ctxt.args.get('fail'):
+                    raise ValueError(ctxt.args['fail'])
+        app = WSGIApplication(UrlMapper(Opener()))
+        status, headers, body = self.request('/', app=app)
+        body.close()
+        self.assert_(files[-1].closed)
+
+        # And when the handlers fail.
+        environ = {'PATH_INFO': '/', 'QUERY_STRING': 'fail=1'}
+        wsgiref.util.setup_testing_defaults(environ)
+        assertRaises(ValueError, app, environ, lambda s, h: None)
+        self.assert_(files[-1].closed)
+
+        # The files which are not on disk are copied.
+        response = ranvier.wsgiproxy.WSGIResponse({})
+        response.write(u'Caf\xe9 ')
+        response.sendFile(StringIO.StringIO('Text.'))
+        assertEquals(''.join(response.getbody()), 'Caf\xc3\xa9 Text.')
+        assertEquals(dict(response.getheaders())['Content-Length'], '11')
+
+    def test_streaming(self):
+        "Test streaming the text of the responses to the WSGI server."
+
+        class Writer(LeafResource):
+            def handle(self, ctxt):
+                ctxt.response.write('a' * int(ctxt.args['size']))
+                ctxt.response.write('b')
+                if ctxt.args.get('header'):
+                    ctxt.response.addHeader('X-Late', 'yes')
+        app = WSGIApplication(UrlMapper(Writer()), streaming=True)
+        threshold = ranvier.wsgiproxy.WSGIResponse.stream_threshold
+
+        started, written = [], []
+        def start_response(status, headers):
+            started.append( (status, dict(headers)) )
+            return written.append
+        def request(query):
+            del started[:], written[:]
+            environ = {'PATH_INFO': '/', 'QUERY_STRING': query}
+            wsgiref.util.setup_testing_defaults(environ)
+            return list(app(environ, start_response))
+
+        # The small responses are buffered.
+        assertEquals(request('size=10'), ['a' * 10, 'b'])
+        assertEquals(written, [])
+        assertEquals(started[0][1]['Content-Length'], '11')
+
+        # The large ones are written as they are produced, without a length.
+        assertEquals(request('size=%d' % threshold), [])
+        assertEquals(written, ['a' * threshold, 'b'])
+        self.assert_('Content-Length' not in started[0][1])
+        status, headers, body = self.request('/', 'size=%d' % threshold,
+                                             app=app)
+        assertEquals(status, '200 OK')
+
+        # The headers cannot be set once the response has started.
+        assertRaises(RanvierError, request, 'size=%d&header=1' % threshold)
+        assertEquals(len(request('size=10&header=1')), 2)
+
+        # The messages are logged as lines.
+        errors = StringIO.StringIO()
+        response = ranvier.wsgiproxy.WSGIResponse({'wsgi.errors': errors})
+        response.log('First.')
+        response.log('Second.\n')
+        assertEquals(errors.getvalue(), 'First.\nSecond.\n')
+
+    def test_static(self):
+        "Test serving static files."
+
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(lambda: [os.remove(join(tmpdir, x))
+                                 for x in os.listdir(tmpdir)] and
+                        os.rmdir(tmpdir))
+        fn = join(tmpdir, 'data.txt')
+        open(fn, 'w').write('0123456789')
+        open(join(tmpdir, '.hidden'), 'w').write('secret')
+
+        static = StaticFiles(tmpdir, check_interval=3600)
+        app = WSGIApplication(UrlMapper(Folder(static=static)))
+        wrapper = {'wsgi.file_wrapper': wsgiref.util.FileWrapper}
+
+        status, headers, body = self.request('/static/data.txt', app=app,
+                                             **wrapper)
+        assertEquals(status, '200 OK')
+        assertEquals(headers['Content-type'], 'text/plain')
+        assertEquals(headers['Content-Length'], '10')
+        self.assert_(isinstance(body, wsgiref.util.FileWrapper))
+        assertEquals(''.join(body), '0123456789')
+        etag = headers['ETag']
+
+        for path in ('/static/nothere', '/static/.hidden', '/static/../x',
+                     '/static/'):
+            status, headers, body = self.request(path, app=app)
+            assertEquals(status, '404 Not Found')
+
+        # Conditional requests.
+        status, headers, body = self.request(
+            '/static/data.txt', app=app, HTTP_IF_NONE_MATCH=etag)
+        assertEquals(status, '304 Not Modified')
+        assertEquals(list(body), [])
+        status, headers, body = self.request(
+            '/static/data.txt', app=app,
+            HTTP_IF_MODIFIED_SINCE=headers['Last-Modified'])
+        assertEquals(status, '304 Not Modified')
+
+        # Range requests.
+        for rng, expected in (('bytes=2-5', '2345'),
+                              ('bytes=7-', '789'),
+                              ('bytes=-3', '789'),
+                              ('bytes=8-100', '89')):
+            status, headers, body = self.request(
+                '/static/data.txt', app=app, HTTP_RANGE=rng, **wrapper)
+            assertEquals(status, '206 Partial Content')
+            assertEquals(''.join(body), expected)
+            assertEquals(headers['Content-Length'], str(len(expected)))
+        assertEquals(headers['Content-Range'], 'bytes 8-9/10')
+
+        status, headers, body = self.request(
+            '/static/data.txt', app=app, HTTP_RANGE='bytes=10-')
+        assertEquals(status, '416 Requested Range Not Satisfiable')
+        assertEquals(headers['Content-Range'], 'bytes */10')
+        for rng in ('bytes=5-2', 'bytes=0-1,4-5', 'lines=1-2'):
+            status, headers, body = self.request(
+                '/static/data.txt', app=app, HTTP_RANGE=rng)
+            assertEquals(status, '200 OK')
+        status, headers, body = self.request(
+            '/static/data.txt', app=app, HTTP_RANGE='bytes=2-5',
+            HTTP_IF_RANGE='"stale"')
+        assertEquals(''.join(body), '0123456789')
+
+        status, headers, body = self.request('/static/data.txt', app=app,
+                                             REQUEST_METHOD='HEAD')
+        assertEquals(headers['Content-Length'], '10')
+        assertEquals(list(body), [])
+
+        # The stat results are cached until they are revalidated.
+        open(fn, 'w').write('abc')
+        status, headers, body = self.request('/static/data.txt', app=app)
+        assertEquals(headers['ETag'], etag)
+        static.check_interval = 0
+        status, headers, body = self.request('/static/data.txt', app=app)
+        assertEquals(''.join(body), 'abc')
+        self.assert_(headers['ETag'] != etag)
+
+        # The headers are output for HEAD requests with CGI.
+        mapper = app.mapper
+        outfile = StringIO.StringIO()
+        mapper.handle_request('HEAD', '/static/data.txt', {},
+                              CGIResponse(outfile), headers={})
+        head, sep, body = outfile.getvalue().partition('\n\n')
+        self.assert_('Content-Length: 3' in head.split('\n'))
+        assertEquals(body, '')
+        outfile = StringIO.StringIO()
+        mapper.handle_request('GET', '/static/data.txt', {},
+                              CGIResponse(outfile), headers={})
+        head, sep, body = outfile.getvalue().partition('\n\n')
+        self.assert_('Content-Length: 3' in head.split('\n'))
+        assertEquals(body, 'abc')
+        outfile = StringIO.StringIO()
+        mapper.handle_request('GET', '/static/data.txt', {},
+                              CGIResponse(outfile),
+                              headers={'if-none-match': '*'})
+        self.assert_('Status: 304' in outfile.getvalue())
+        self.assert_('Content-Length' not in outfile.getvalue())
+
+        # The files are closed once they have been copied.
+        fileobj = open(fn, 'rb')
+        outfile = StringIO.StringIO()
+        CGIResponse(outfile).sendFile(fileobj, length=2)
+        assertEquals(outfile.getvalue(), 'Content-type: text/plain\n\nab')
+        self.assert_(fileobj.closed)
+
+        # A file which disappears is not found, without a stale length.
+        static.check_interval = 3600
+        os.remove(fn)
+        outfile = StringIO.StringIO()
+        mapper.handle_request('GET', '/static/data.txt', {},
+                              CGIResponse(outfile), headers={})
+        self.assert_('Status: 404' in outfile.getvalue())
+        self.assert_('Content-Length' not in outfile.getvalue())
+        status, headers, body = self.request('/static/data.txt', app=app)
+        assertEquals(status, '404 Not Found')
+        body = ''.join(body)
+        assertEquals(headers['Content-Length'], str(len(body)))
+
+
+
+class EnumTestServer(BaseHTTPServer.HTTPServer):
+    """
+    A local HTTP server that serves the resource list of a mapper from a
+    thread, and records the responses it sent.
+    """
+    def __init__(self, mapper):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           EnumTestRequestHandler)
+        self.enumres = EnumResource(mapper)
+        self.statuses = []
+        self.encodings = []
+        thread = threading.Thread(target=self.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+
+class EnumTestRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler,
+                             ResponseProxy):
+
+    def do_GET(self):
+        self.status, self.outheaders, self.buffer = 200, [], []
+        ctxt = HandlerContext('GET', self.path, {})
+        ctxt.response = self
+        ctxt.headers = dict(self.headers)
+        self.server.enumres.handle(ctxt)
+
+        self.server.statuses.append(self.status)
+        self.server.encodings.extend(content for header, content
+                                     in self.outheaders
+                                     if header == 'Content-Encoding')
+        self.send_response(self.status)
+        for header, content in self.outheaders:
+            self.send_header(header, content)
+        self.end_headers()
+        self.wfile.write(''.join(self.buffer))
+
+    def setContentType(self, contype):
+        self.addHeader('Content-Type', contype)
+
+    def addHeader(self, header, content):
+        self.outheaders.append( (header, content) )
+
+    def write(self, text):
+        self.buffer.append(text)
+
+    def notModified(self):
+        self.status = 304
+
+    def log_message(self, format, *args):
+        pass
+
 
 
 def assertRaises(excClass, callableObj, *args, **kwargs):
@@ -352,10 +1958,43 @@ def suite():
     suite.addTest(TestMappings("test_backmaps"))
     suite.addTest(TestMappings("test_render_reload"))
     suite.addTest(TestMappings("test_static"))
+    suite.addTest(TestMappings("test_urlload_cache"))
+    suite.addTest(TestMappings("test_snapshot"))
+    suite.addTest(TestMappings("test_mapurl_many"))
+    suite.addTest(TestMappings("test_cache"))
+    suite.addTest(TestMappings("test_cache_threads"))
+    suite.addTest(TestMappings("test_reporters"))
+    suite.addTest(TestMappings("test_enumerate"))
     suite.addTest(TestConversions("test_urlpattern"))
     suite.addTest(TestConversions("test_template"))
     suite.addTest(TestConversions("test_match"))
+    suite.addTest(TestConversions("test_match_any"))
     suite.addTest(TestConversions("test_optparam"))
+    suite.addTest(TestConversions("test_compiled_render"))
+    suite.addTest(TestRoutes("test_compile_routes"))
+    suite.addTest(TestRoutes("test_handle_routes"))
+    suite.addTest(TestRoutes("test_dispatch"))
+    suite.addTest(TestRoutes("test_pool_contexts"))
+    suite.addTest(TestCoverage("test_buffered"))
+    suite.addTest(TestCoverage("test_sql"))
+    suite.addTest(TestCoverage("test_mmap"))
+    suite.addTest(TestCoverage("test_sampling"))
+    suite.addTest(TestCoverage("test_latency"))
+    suite.addTest(TestCoverage("test_histogram"))
+    suite.addTest(TestCoverage("test_callgraph_log"))
+    suite.addTest(TestAsync("test_deferred"))
+    suite.addTest(TestAsync("test_folder"))
+    suite.addTest(TestAsync("test_latency"))
+    suite.addTest(TestAsync("test_redirect"))
+    suite.addTest(TestAsync("test_dispatch"))
+    suite.addTest(TestAsync("test_static"))
+    suite.addTest(TestAsync("test_streaming"))
+    suite.addTest(TestAsync("test_sendfile"))
+    suite.addTest(TestAsync("test_failed"))
+    suite.addTest(TestWSGI("test_wsgi"))
+    suite.addTest(TestWSGI("test_sendfile"))
+    suite.addTest(TestWSGI("test_streaming"))
+    suite.addTest(TestWSGI("test_static"))
     return suite
 
 if __name__ == '__main__':